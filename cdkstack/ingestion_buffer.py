@@ -0,0 +1,129 @@
+import aws_cdk as cdk
+from aws_cdk import (
+    aws_iam as iam,
+    aws_iot as iot,
+    aws_kinesis as kinesis,
+    aws_lambda as _lambda,
+    aws_lambda_event_sources as event_sources,
+    aws_sqs as sqs
+)
+from cdk_nag import NagSuppressions
+from constructs import Construct
+
+### "direct" invokes the telemetry lambda once per MQTT message from the IoT rule,
+### "kinesis" and "sqs" buffer messages and invoke it with batches through an event source mapping
+INGESTION_MODES = ("direct", "kinesis", "sqs")
+
+
+class TelemetryIngestionBuffer(Construct):
+    ### Puts a Kinesis stream or SQS queue between the IoT rules and the telemetry lambda
+    ###   batch_size              - maximum records per invocation
+    ###   batching_window_seconds - how long to wait for a batch to fill before invoking
+    ###   parallelization_factor  - concurrent batches per Kinesis shard (1-10)
+    ###   shard_count             - Kinesis shards, each accepts 1000 records or 1 MB per second
+    ### Failed items are reported back by the lambda (ReportBatchItemFailures) so only those are retried.
+    ### Records that keep failing go to the buffer's own dead_letter_queue, which holds a different format
+    ### per mode: Kinesis invocation records that point at the failed shard range, or the original SQS messages.
+
+    def __init__(self, scope: Construct, construct_id: str, *, mode: str, function: _lambda.IFunction,
+                 batch_size: int = 100, batching_window_seconds: int = 1,
+                 parallelization_factor: int = 1, shard_count: int = 1, max_retries: int = 5) -> None:
+        super().__init__(scope, construct_id)
+
+        if mode not in ("kinesis", "sqs"):
+            raise ValueError("ingestion buffer mode must be kinesis or sqs, got " + str(mode))
+        self.mode = mode
+
+        ### create queue for buffered messages the lambda kept failing on ###
+        self.dead_letter_queue = sqs.Queue(self, "buffer-dead-letter-queue",
+                                           encryption=sqs.QueueEncryption.SQS_MANAGED,
+                                           enforce_ssl=True,
+                                           retention_period=cdk.Duration.days(14)
+                                           )
+        self.dead_letter_queue.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+
+        NagSuppressions.add_resource_suppressions(self.dead_letter_queue,
+                                                  [{
+                                                      "id": "AwsSolutions-SQS3",
+                                                      "reason": "This queue is the dead-letter destination of the ingestion buffer"
+                                                    }]
+                                                  )
+
+        cdk.CfnOutput(self, "BufferDeadLetterQueue", value=self.dead_letter_queue.queue_url)
+
+        ### role the IoT rules assume to put messages into the buffer ###
+        self.rule_role = iam.Role(self, "iot-rule-role",
+                                  assumed_by=iam.ServicePrincipal("iot.amazonaws.com"),
+                                  description="Allows IoT rules to buffer telemetry for the telemetry lambda"
+                                  )
+
+        if mode == "kinesis":
+            ### create kinesis stream, records are partitioned by device so each device is processed in order ###
+            self.stream = kinesis.Stream(self, "telemetry-stream",
+                                         shard_count=shard_count,
+                                         encryption=kinesis.StreamEncryption.MANAGED,
+                                         retention_period=cdk.Duration.hours(24)
+                                         )
+            self.stream.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+            self.stream.grant_write(self.rule_role)
+
+            function.add_event_source(event_sources.KinesisEventSource(
+                self.stream,
+                starting_position=_lambda.StartingPosition.LATEST,
+                batch_size=batch_size,
+                max_batching_window=cdk.Duration.seconds(batching_window_seconds),
+                parallelization_factor=parallelization_factor,
+                report_batch_item_failures=True,
+                bisect_batch_on_error=True,
+                retry_attempts=max_retries,
+                on_failure=event_sources.SqsDlq(self.dead_letter_queue)
+            ))
+
+            cdk.CfnOutput(self, "TelemetryStream", value=self.stream.stream_name)
+        else:
+            ### create sqs queue, messages that fail max_retries times are moved to the dead-letter queue ###
+            ### the visibility timeout follows the recommended 6 times the function timeout ###
+            self.queue = sqs.Queue(self, "telemetry-queue",
+                                   encryption=sqs.QueueEncryption.SQS_MANAGED,
+                                   enforce_ssl=True,
+                                   visibility_timeout=cdk.Duration.seconds(function.timeout.to_seconds() * 6),
+                                   dead_letter_queue=sqs.DeadLetterQueue(
+                                       queue=self.dead_letter_queue, max_receive_count=max_retries)
+                                   )
+            self.queue.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+            self.queue.grant_send_messages(self.rule_role)
+
+            function.add_event_source(event_sources.SqsEventSource(
+                self.queue,
+                batch_size=batch_size,
+                max_batching_window=cdk.Duration.seconds(batching_window_seconds),
+                report_batch_item_failures=True
+            ))
+
+            cdk.CfnOutput(self, "TelemetryQueue", value=self.queue.queue_url)
+
+        NagSuppressions.add_resource_suppressions(self.rule_role,
+                                                  [{
+                                                      "id": "AwsSolutions-IAM5",
+                                                      "reason": "Generated grants for the telemetry buffer"
+                                                    }],
+                                                  apply_to_children=True
+                                                  )
+
+    def rule_action(self, partition_key: str = "${newuuid()}") -> iot.CfnTopicRule.ActionProperty:
+        ### IoT rule action that puts the rule output into the buffer ###
+        if self.mode == "kinesis":
+            return iot.CfnTopicRule.ActionProperty(
+                kinesis=iot.CfnTopicRule.KinesisActionProperty(
+                    role_arn=self.rule_role.role_arn,
+                    stream_name=self.stream.stream_name,
+                    partition_key=partition_key
+                )
+            )
+        return iot.CfnTopicRule.ActionProperty(
+            sqs=iot.CfnTopicRule.SqsActionProperty(
+                role_arn=self.rule_role.role_arn,
+                queue_url=self.queue.queue_url,
+                use_base64=False
+            )
+        )
@@ -0,0 +1,95 @@
+import os
+import shutil
+
+import aws_cdk as cdk
+import jsii
+
+from cdkstack.telemetry_package import build_package
+
+
+@jsii.implements(cdk.ILocalBundling)
+class TelemetryLambdaBundler:
+    ### Packages resources/lambda/process_iot_telemetry with cdkstack/telemetry_package.py, which adds a
+    ### compact device metadata file and a pinned, trimmed botocore to shorten the function's init.
+    ### The docker fallback runs the same script in the bundling image, it is used when local bundling
+    ### fails, including when the local Python is not the runtime's (see telemetry_package.py).
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+
+    def try_bundle(self, output_dir, *args, **kwargs):
+        try:
+            build_package(self.source_dir, output_dir)
+            return True
+        except Exception as err:
+            print("Local bundling failed, falling back to docker:", err)
+            return False
+
+
+def telemetry_lambda_code(source_dir):
+    ### lambda code asset for the telemetry function, bundled locally without docker when possible
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "telemetry_package.py")
+    return cdk.aws_lambda.Code.from_asset(
+        source_dir,
+        bundling=cdk.BundlingOptions(
+            image=cdk.aws_lambda.Runtime.PYTHON_3_11.bundling_image,
+            local=TelemetryLambdaBundler(source_dir),
+            volumes=[cdk.DockerVolume(host_path=os.path.dirname(script), container_path="/packaging")],
+            command=["bash", "-c", "python /packaging/%s /asset-input /asset-output" % os.path.basename(script)],
+        ),
+    )
+
+
+@jsii.implements(cdk.ILocalBundling)
+class ExtraFilesBundler:
+    ### Packages a source directory together with files kept elsewhere in the repository,
+    ### extra_files maps the file name in the package to the path of the file to copy
+
+    def __init__(self, source_dir, extra_files):
+        self.source_dir = source_dir
+        self.extra_files = extra_files
+
+    def try_bundle(self, output_dir, *args, **kwargs):
+        try:
+            shutil.copytree(self.source_dir, output_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns("__pycache__"))
+            for name, path in self.extra_files.items():
+                shutil.copy(path, os.path.join(output_dir, name))
+            return True
+        except Exception as err:
+            print("Local bundling failed, falling back to docker:", err)
+            return False
+
+
+def code_with_extra_files(source_dir, extra_files):
+    ### lambda code asset of source_dir including extra_files, bundled locally without docker when possible
+    ### the asset is hashed after bundling, so a changed extra file redeploys the function
+    volumes = []
+    commands = ["cp -r /asset-input/. /asset-output/"]
+    for index, (name, path) in enumerate(sorted(extra_files.items())):
+        container_path = "/extra-%d" % index
+        volumes.append(cdk.DockerVolume(host_path=os.path.dirname(os.path.abspath(path)), container_path=container_path))
+        commands.append("cp %s/%s /asset-output/%s" % (container_path, os.path.basename(path), name))
+    return cdk.aws_lambda.Code.from_asset(
+        source_dir,
+        asset_hash_type=cdk.AssetHashType.OUTPUT,
+        bundling=cdk.BundlingOptions(
+            image=cdk.aws_lambda.Runtime.PYTHON_3_11.bundling_image,
+            local=ExtraFilesBundler(source_dir, extra_files),
+            volumes=volumes,
+            command=["bash", "-c", " && ".join(commands)],
+        ),
+    )
+
+
+def dashboard_setup_code(source_dir, device_metadata_file):
+    ### lambda code asset for the dashboard setup function including the device metadata file the
+    ### multi-tenant mode reads its customers from, see resources/grafana/tenant_dashboards.py.
+    ### A changed metadata file redeploys and reruns the setup
+    return code_with_extra_files(source_dir, {"device-meta.json": device_metadata_file})
+
+
+def query_cache_code(source_dir, aws_clients_file):
+    ### lambda code asset for the query cache function, which creates its clients through the
+    ### aws_clients.py module of the telemetry function
+    return code_with_extra_files(source_dir, {"aws_clients.py": aws_clients_file})
@@ -1,3 +1,5 @@
+import json
+
 import aws_cdk as cdk
 from aws_cdk import (
     Stack,
@@ -7,10 +9,16 @@ from aws_cdk import (
     aws_iot as iot,
     aws_grafana as grafana,
     triggers,
-    aws_logs as logs
+    aws_logs as logs,
+    aws_sqs as sqs,
+    aws_dynamodb as dynamodb,
+    aws_secretsmanager as secretsmanager
 )
 from cdk_nag import NagSuppressions
 
+from cdkstack.ingestion_buffer import INGESTION_MODES, TelemetryIngestionBuffer
+from cdkstack.lambda_packaging import dashboard_setup_code, query_cache_code, telemetry_lambda_code
+
 
 class monitor_iot_with_grafana(Stack):
     def __init__(self, scope: cdk.App, construct_id: str, **kwargs) -> None:
@@ -28,18 +36,121 @@ class monitor_iot_with_grafana(Stack):
 
         cdk.CfnOutput(self, "TimestreamTelemetryDatabase", value=iot_telemetry_database.ref)
 
+        ### optional multi-tenant mode, customerid becomes a dimension and the partition key of every table ###
+        ### so per customer dashboards prune to one partition, see resources/grafana/tenant_dashboards.py ###
+        ### the partition key is fixed when a table is created ###
+        tenant_dimension = "customerid" if self.node.try_get_context("multi_tenant") else None
+        tenant_schema = timestream.CfnTable.SchemaProperty(
+            composite_partition_key=[timestream.CfnTable.PartitionKeyProperty(
+                type="DIMENSION",
+                name=tenant_dimension,
+                ### devices without metadata are still written ###
+                enforcement_in_record="OPTIONAL"
+            )]
+        ) if tenant_dimension else None
+
         ### Create timestream table ###
         telemetry_timestream_table = timestream.CfnTable(
             self,
             "device-telemetry",
             database_name=iot_telemetry_database.ref,
-            table_name="device-telemetry"
+            table_name="device-telemetry",
+            schema=tenant_schema
         )
 
         telemetry_timestream_table.add_dependency(iot_telemetry_database)
         telemetry_timestream_table.apply_removal_policy(
             cdk.RemovalPolicy.DESTROY)
 
+        ### every timestream table in the database, the setup lambda drops dashboard panels of tables ###
+        ### that are not deployed, see resources/grafana/dashboard_setup.py ###
+        timestream_tables = [telemetry_timestream_table.table_name]
+
+        ### optionally write 1 minute and 1 hour rollups from the telemetry lambda ###
+        ### long range dashboard panels query this table instead of scanning raw telemetry ###
+        rollup_timestream_table = None
+        if self.node.try_get_context("rollups"):
+            rollup_timestream_table = timestream.CfnTable(
+                self,
+                "device-telemetry-rollup",
+                database_name=iot_telemetry_database.ref,
+                table_name="device-telemetry-rollup",
+                schema=tenant_schema,
+                retention_properties={
+                    "MemoryStoreRetentionPeriodInHours": "24",
+                    "MagneticStoreRetentionPeriodInDays": "3650"
+                }
+            )
+
+            rollup_timestream_table.add_dependency(iot_telemetry_database)
+            rollup_timestream_table.apply_removal_policy(
+                cdk.RemovalPolicy.DESTROY)
+            timestream_tables.append(rollup_timestream_table.table_name)
+
+        ### optionally write the last known state of each device from the telemetry lambda ###
+        ### rows are only written on change or heartbeat, so "fleet now" panels read a few rows per device ###
+        ### without it the setup lambda points those panels at the telemetry table ###
+        state_timestream_table = None
+        if self.node.try_get_context("device_state"):
+            state_timestream_table = timestream.CfnTable(
+                self,
+                "device-state",
+                database_name=iot_telemetry_database.ref,
+                table_name="device-state",
+                schema=tenant_schema,
+                retention_properties={
+                    "MemoryStoreRetentionPeriodInHours": "24",
+                    "MagneticStoreRetentionPeriodInDays": "30"
+                }
+            )
+
+            state_timestream_table.add_dependency(iot_telemetry_database)
+            state_timestream_table.apply_removal_policy(
+                cdk.RemovalPolicy.DESTROY)
+            timestream_tables.append(state_timestream_table.table_name)
+
+        ### optionally write per device health scores computed at ingest ###
+        ### drain rates, time to empty, signal percentiles and anomaly flags, see device_health.py ###
+        health_timestream_table = None
+        if self.node.try_get_context("health"):
+            health_timestream_table = timestream.CfnTable(
+                self,
+                "device-health",
+                database_name=iot_telemetry_database.ref,
+                table_name="device-health",
+                schema=tenant_schema,
+                retention_properties={
+                    "MemoryStoreRetentionPeriodInHours": "24",
+                    "MagneticStoreRetentionPeriodInDays": "365"
+                }
+            )
+
+            health_timestream_table.add_dependency(iot_telemetry_database)
+            health_timestream_table.apply_removal_policy(
+                cdk.RemovalPolicy.DESTROY)
+            timestream_tables.append(health_timestream_table.table_name)
+
+        ### optionally write device counts and positions per geohash tile ###
+        ### the fleet map reads one row per tile instead of raw positions, see geo_tiles.py ###
+        tile_timestream_table = None
+        if self.node.try_get_context("geo_tiles"):
+            tile_timestream_table = timestream.CfnTable(
+                self,
+                "device-geo-tiles",
+                database_name=iot_telemetry_database.ref,
+                table_name="device-geo-tiles",
+                schema=tenant_schema,
+                retention_properties={
+                    "MemoryStoreRetentionPeriodInHours": "24",
+                    "MagneticStoreRetentionPeriodInDays": "7"
+                }
+            )
+
+            tile_timestream_table.add_dependency(iot_telemetry_database)
+            tile_timestream_table.apply_removal_policy(
+                cdk.RemovalPolicy.DESTROY)
+            timestream_tables.append(tile_timestream_table.table_name)
+
 
 ##############################################
 #  Amazon Managed Grafana workspace setup
@@ -156,17 +267,113 @@ class monitor_iot_with_grafana(Stack):
                                                   apply_to_children=True
                                                   )
 
+        ### optionally read device metadata from an existing DynamoDB table instead of device-meta.json ###
+        device_metadata_table_name = self.node.try_get_context("device_metadata_table")
+
+        ### optional buffer between the IoT rules and the telemetry lambda, see cdkstack/ingestion_buffer.py ###
+        ingestion_mode = self.node.try_get_context("ingestion_mode") or "direct"
+        if ingestion_mode not in INGESTION_MODES:
+            raise ValueError("ingestion_mode must be one of " + ", ".join(INGESTION_MODES))
+
+        ### create queue for telemetry records timestream permanently rejected or that ran out of retries ###
+        telemetry_dead_letter_queue = sqs.Queue(self, "telemetry-dead-letter-queue",
+                                                encryption=sqs.QueueEncryption.SQS_MANAGED,
+                                                enforce_ssl=True,
+                                                retention_period=cdk.Duration.days(14)
+                                                )
+        telemetry_dead_letter_queue.apply_removal_policy(
+            cdk.RemovalPolicy.DESTROY)
+
+        NagSuppressions.add_resource_suppressions(telemetry_dead_letter_queue,
+                                                  [{
+                                                      "id": "AwsSolutions-SQS3",
+                                                      "reason": "This queue is the dead-letter destination for rejected telemetry"
+                                                    }]
+                                                    )
+
+        cdk.CfnOutput(self, "TelemetryDeadLetterQueue", value=telemetry_dead_letter_queue.queue_url)
+
+        ### create queue for telemetry payloads that failed schema validation in the telemetry lambda ###
+        telemetry_quarantine_queue = sqs.Queue(self, "telemetry-quarantine-queue",
+                                               encryption=sqs.QueueEncryption.SQS_MANAGED,
+                                               enforce_ssl=True,
+                                               retention_period=cdk.Duration.days(14)
+                                               )
+        telemetry_quarantine_queue.apply_removal_policy(
+            cdk.RemovalPolicy.DESTROY)
+
+        NagSuppressions.add_resource_suppressions(telemetry_quarantine_queue,
+                                                  [{
+                                                      "id": "AwsSolutions-SQS3",
+                                                      "reason": "This queue is the quarantine destination for invalid telemetry payloads"
+                                                    }]
+                                                    )
+
+        cdk.CfnOutput(self, "TelemetryQuarantineQueue", value=telemetry_quarantine_queue.queue_url)
+
+        ### create table for the health estimator state of each device, so it survives lambda cold starts ###
+        health_checkpoint_table = None
+        if health_timestream_table:
+            health_checkpoint_table = dynamodb.Table(self, "device-health-checkpoint",
+                                                     partition_key=dynamodb.Attribute(
+                                                         name="deviceid", type=dynamodb.AttributeType.STRING),
+                                                     billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                                                     point_in_time_recovery=True,
+                                                     time_to_live_attribute="expires",
+                                                     removal_policy=cdk.RemovalPolicy.DESTROY
+                                                     )
+
+        ### optionally share the keys of written messages between lambda instances to drop redeliveries, see dedup.py ###
+        dedup_table = None
+        if self.node.try_get_context("shared_dedup"):
+            dedup_table = dynamodb.Table(self, "telemetry-dedup",
+                                         partition_key=dynamodb.Attribute(
+                                             name="key", type=dynamodb.AttributeType.STRING),
+                                         billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                                         point_in_time_recovery=True,
+                                         time_to_live_attribute="expires",
+                                         removal_policy=cdk.RemovalPolicy.DESTROY
+                                         )
+
+        process_telemetry_environment = {
+            "TimestreamDatabase": iot_telemetry_database.ref,
+            "TimestreamTable": telemetry_timestream_table.table_name,
+            "DeadLetterQueueUrl": telemetry_dead_letter_queue.queue_url,
+            "QuarantineQueueUrl": telemetry_quarantine_queue.queue_url,
+            ### the telemetry table keeps the Timestream default memory store retention ###
+            "MemoryStoreRetentionHours": "6",
+            "WriteConcurrency": str(self.node.try_get_context("write_concurrency") or 8)
+        }
+        if rollup_timestream_table:
+            process_telemetry_environment["RollupTable"] = rollup_timestream_table.table_name
+        if state_timestream_table:
+            process_telemetry_environment["StateTable"] = state_timestream_table.table_name
+        if health_timestream_table:
+            process_telemetry_environment["HealthTable"] = health_timestream_table.table_name
+            process_telemetry_environment["HealthCheckpointTable"] = health_checkpoint_table.table_name
+            process_telemetry_environment["HealthIntervalSeconds"] = str(self.node.try_get_context("health_interval_seconds") or 300)
+        if tile_timestream_table:
+            process_telemetry_environment["GeoTileTable"] = tile_timestream_table.table_name
+        if device_metadata_table_name:
+            process_telemetry_environment["DeviceMetadataTable"] = device_metadata_table_name
+        if dedup_table:
+            process_telemetry_environment["DedupTable"] = dedup_table.table_name
+        if tenant_dimension:
+            process_telemetry_environment["TenantDimension"] = tenant_dimension
+        ### profile a fraction of invocations and log the profile of slow ones, see metrics.py ###
+        if self.node.try_get_context("profile_sample_rate"):
+            process_telemetry_environment["ProfileSampleRate"] = str(self.node.try_get_context("profile_sample_rate"))
+
         ### create lambda function to process data from iot core ###
         process_telemetry_lambda_function = _lambda.Function(self, "IotTelemetryToTimestream",
                                                              runtime=_lambda.Runtime.PYTHON_3_11,
-                                                             code=_lambda.Code.from_asset(
+                                                             code=telemetry_lambda_code(
                                                                  "resources/lambda/process_iot_telemetry"),
                                                              handler="process-telemetry-data.lambda_handler",
                                                              description="Process IoT telemetry data and send to timestream",
-                                                             environment={
-                                                                 "TimestreamDatabase": iot_telemetry_database.ref,
-                                                                 "TimestreamTable": telemetry_timestream_table.table_name
-                                                             },
+                                                             environment=process_telemetry_environment,
+                                                             ### batches from the ingestion buffer need more than the default 3 seconds ###
+                                                             timeout=cdk.Duration.seconds(3 if ingestion_mode == "direct" else 60),
                                                              role=process_telemetry_lambda_role
                                                             #  log_retention=logs.RetentionDays.ONE_DAY
                                                              )
@@ -213,19 +420,175 @@ class monitor_iot_with_grafana(Stack):
                                                   apply_to_children=True
                                                   )
 
+        telemetry_dead_letter_queue.grant_send_messages(process_telemetry_lambda_function)
+        telemetry_quarantine_queue.grant_send_messages(process_telemetry_lambda_function)
+
+        ### add permissions to load and save health checkpoints ###
+        if health_checkpoint_table:
+            process_telemetry_lambda_function.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions=["dynamodb:BatchGetItem", "dynamodb:BatchWriteItem"],
+                    resources=[health_checkpoint_table.table_arn]
+                )
+            )
+
+        ### add permissions to look up and record message keys in the shared dedup table ###
+        if dedup_table:
+            process_telemetry_lambda_function.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions=["dynamodb:BatchGetItem", "dynamodb:BatchWriteItem"],
+                    resources=[dedup_table.table_arn]
+                )
+            )
+
+        ### add permissions to read device metadata from dynamodb ###
+        if device_metadata_table_name:
+            process_telemetry_lambda_function.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions=["dynamodb:BatchGetItem"],
+                    resources=[Stack.of(self).format_arn(
+                        service="dynamodb",
+                        resource="table",
+                        resource_name=device_metadata_table_name
+                    )]
+                )
+            )
+
+        ### optionally serve dashboard queries through a coalescing query cache, see resources/lambda/query_cache ###
+        ### the grafana data source uses its function url as custom timestream endpoint ###
+        dashboard_setup_environment = {
+            "grafana_workspace_id": grafana_workspace_id,
+            "TimestreamDatabase": iot_telemetry_database.ref,
+            "TimestreamTable": telemetry_timestream_table.table_name,
+            "TimestreamTables": json.dumps(timestream_tables)
+        }
+        if self.node.try_get_context("query_cache"):
+            query_cache_table = dynamodb.Table(self, "dashboard-query-cache",
+                                               partition_key=dynamodb.Attribute(
+                                                   name="key", type=dynamodb.AttributeType.STRING),
+                                               billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                                               point_in_time_recovery=True,
+                                               time_to_live_attribute="expires",
+                                               removal_policy=cdk.RemovalPolicy.DESTROY
+                                               )
+
+            ### every request must carry this token in the x-query-cache-token header ###
+            query_cache_token = secretsmanager.Secret(self, "query-cache-token",
+                                                      description="Header token of the dashboard query cache function url",
+                                                      generate_secret_string=secretsmanager.SecretStringGenerator(
+                                                          exclude_punctuation=True, password_length=40),
+                                                      removal_policy=cdk.RemovalPolicy.DESTROY
+                                                      )
+
+            NagSuppressions.add_resource_suppressions(query_cache_token,
+                                                      [{
+                                                          "id": "AwsSolutions-SMG4",
+                                                          "reason": "Token is regenerated by redeploying the stack, the query cache only reads telemetry"
+                                                      }]
+                                                      )
+
+            query_cache_role = iam.Role(self, "query-cache-lambda-role",
+                                        assumed_by=iam.ServicePrincipal(
+                                            "lambda.amazonaws.com")
+                                        )
+            query_cache_role.add_to_policy(
+                cloudwatch_lambda_policy_statement)
+            query_cache_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=["timestream:Select"],
+                    resources=[iot_telemetry_database.attr_arn + "/*"]
+                )
+            )
+            query_cache_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=["timestream:DescribeEndpoints"],
+                    resources=["*"]
+                )
+            )
+            query_cache_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=["dynamodb:GetItem", "dynamodb:PutItem", "dynamodb:UpdateItem", "dynamodb:DeleteItem"],
+                    resources=[query_cache_table.table_arn]
+                )
+            )
+            query_cache_token.grant_read(query_cache_role)
+
+            NagSuppressions.add_resource_suppressions(query_cache_role,
+                                                      [{
+                                                          "id": "AwsSolutions-IAM5",
+                                                          "reason": "Lambda function needs to create CloudWatch logs, query the database tables and describe Timestream endpoints",
+                                                          "appliesTo": ['Resource::arn:<AWS::Partition>:logs:<AWS::Region>:<AWS::AccountId>:log-group:/aws/lambda/*',
+                                                                        'Resource::<iottelemetry.Arn>/*', 'Resource::*']
+                                                      }],
+                                                      apply_to_children=True
+                                                      )
+
+            query_cache_function = _lambda.Function(self, "DashboardQueryCache",
+                                                    runtime=_lambda.Runtime.PYTHON_3_11,
+                                                    code=query_cache_code(
+                                                        "resources/lambda/query_cache",
+                                                        "resources/lambda/process_iot_telemetry/aws_clients.py"),
+                                                    handler="query-cache-proxy.lambda_handler",
+                                                    description="Coalescing cache for Grafana Timestream queries",
+                                                    memory_size=512,
+                                                    timeout=cdk.Duration.seconds(30),
+                                                    environment={
+                                                        "QueryCacheTable": query_cache_table.table_name,
+                                                        "QueryCacheTokenSecret": query_cache_token.secret_arn,
+                                                        ### should match the dashboard refresh interval ###
+                                                        "QueryCacheAlignSeconds": str(self.node.try_get_context("query_cache_align_seconds") or 10),
+                                                        ### rollup rows are updated until their hour has been flushed ###
+                                                        "QueryCacheTableLateSeconds": json.dumps(
+                                                            {rollup_timestream_table.table_name: 3660} if rollup_timestream_table else {})
+                                                    },
+                                                    role=query_cache_role
+                                                    )
+
+            NagSuppressions.add_resource_suppressions(query_cache_function,
+                                                      [{
+                                                          "id": "AwsSolutions-L1",
+                                                          "reason": "Function has been validated with Python 3.11"
+                                                        }]
+                                                        )
+
+            query_cache_url = query_cache_function.add_function_url(
+                auth_type=_lambda.FunctionUrlAuthType.NONE)
+            cdk.CfnOutput(self, "QueryCacheUrl", value=query_cache_url.url)
+
+            dashboard_setup_environment["QueryCacheEndpoint"] = query_cache_url.url
+            dashboard_setup_environment["QueryCacheTokenSecret"] = query_cache_token.secret_arn
+            query_cache_token.grant_read(initialize_grafana_lambda_role)
+
+        ### in multi-tenant mode the setup lambda also provisions one dashboard per customer ###
+        ### customers are read from the device metadata table or the packaged device-meta.json ###
+        if tenant_dimension:
+            dashboard_setup_environment["TenantDimension"] = tenant_dimension
+            if device_metadata_table_name:
+                dashboard_setup_environment["DeviceMetadataTable"] = device_metadata_table_name
+                initialize_grafana_lambda_role.add_to_policy(
+                    iam.PolicyStatement(
+                        actions=["dynamodb:Scan"],
+                        resources=[Stack.of(self).format_arn(
+                            service="dynamodb",
+                            resource="table",
+                            resource_name=device_metadata_table_name
+                        )]
+                    )
+                )
+            dashboard_setup_asset = dashboard_setup_code(
+                "resources/grafana", "resources/lambda/process_iot_telemetry/device-meta.json")
+        else:
+            dashboard_setup_asset = _lambda.Code.from_asset("resources/grafana")
+
         ### create lambda function to initialize grafana workspace ###
         initialize_grafana_dashboard = triggers.TriggerFunction(self, "InitializeGrafanaDashboard",
                                                                 handler="dashboard_setup.lambda_handler",
                                                                 runtime=_lambda.Runtime.PYTHON_3_11,
-                                                                timeout=cdk.Duration.seconds(20),
-                                                                code=_lambda.Code.from_asset(
-                                                                    "resources/grafana"),
+                                                                ### thousands of customer dashboards take minutes ###
+                                                                timeout=cdk.Duration.seconds(900 if tenant_dimension else 60),
+                                                                code=dashboard_setup_asset,
                                                                 description="initialize grafana workspace",
-                                                                environment={
-                                                                    "grafana_workspace_id": grafana_workspace_id,
-                                                                    "TimestreamDatabase": iot_telemetry_database.ref,
-                                                                    "TimestreamTable": telemetry_timestream_table.table_name
-                                                                },
+                                                                environment=dashboard_setup_environment,
                                                                 role=initialize_grafana_lambda_role
                                                                 # log_retention=logs.RetentionDays.ONE_DAY
                                                                 )
@@ -270,14 +633,32 @@ class monitor_iot_with_grafana(Stack):
 #  AWS IoT Core Rule setup
 ##############################################
 
+        ### ingestion_mode "direct" invokes the lambda per message, "kinesis" or "sqs" buffers messages ###
+        ### and invokes it with batches, see cdkstack/ingestion_buffer.py ###
+        if ingestion_mode == "direct":
+            json_rule_action = iot.CfnTopicRule.ActionProperty(
+                lambda_=iot.CfnTopicRule.LambdaActionProperty(
+                    function_arn=process_telemetry_lambda_function.function_arn
+                )
+            )
+            binary_rule_action = json_rule_action
+        else:
+            telemetry_ingestion_buffer = TelemetryIngestionBuffer(self, "telemetry-ingestion-buffer",
+                                                                  mode=ingestion_mode,
+                                                                  function=process_telemetry_lambda_function,
+                                                                  batch_size=int(self.node.try_get_context("batch_size") or 100),
+                                                                  batching_window_seconds=int(self.node.try_get_context("batching_window_seconds") or 1),
+                                                                  parallelization_factor=int(self.node.try_get_context("parallelization_factor") or 1),
+                                                                  shard_count=int(self.node.try_get_context("kinesis_shards") or 1)
+                                                                  )
+            ### json payloads are partitioned by device, binary payloads can only be spread randomly ###
+            json_rule_action = telemetry_ingestion_buffer.rule_action("${deviceid}")
+            binary_rule_action = telemetry_ingestion_buffer.rule_action()
+
         ### create iot rule to push to lambda handler ###
         iot_to_lambda_topic_rule = iot.CfnTopicRule(self, "telematics-rule",
                                                     topic_rule_payload=iot.CfnTopicRule.TopicRulePayloadProperty(
-                                                        actions=[iot.CfnTopicRule.ActionProperty(
-                                                            lambda_=iot.CfnTopicRule.LambdaActionProperty(
-                                                                function_arn=process_telemetry_lambda_function.function_arn
-                                                            )
-                                                        )],
+                                                        actions=[json_rule_action],
                                                         description="send to lambda handler",
                                                         rule_disabled=False,
                                                         sql='SELECT * from \'sampledevice/data\''
@@ -287,9 +668,30 @@ class monitor_iot_with_grafana(Stack):
         iot_to_lambda_topic_rule.apply_removal_policy(
             cdk.RemovalPolicy.DESTROY)
 
-        ### add permission for iot rule to lambda function - this allows iot to invoke the lambda function ###
-        process_telemetry_lambda_function.add_permission("grant iot rule access",
-                                                         principal=iam.ServicePrincipal(
-                                                             "iot.amazonaws.com"),
-                                                         source_arn=iot_to_lambda_topic_rule.attr_arn
-                                                         )
+        ### create iot rule for compact binary (packed struct) payloads ###
+        ### the payload is forwarded base64 encoded with its MQTT 5 content type, the lambda decodes it ###
+        iot_binary_to_lambda_topic_rule = iot.CfnTopicRule(self, "telematics-binary-rule",
+                                                           topic_rule_payload=iot.CfnTopicRule.TopicRulePayloadProperty(
+                                                               actions=[binary_rule_action],
+                                                               description="send binary payloads to lambda handler",
+                                                               rule_disabled=False,
+                                                               aws_iot_sql_version="2016-03-23",
+                                                               sql='SELECT encode(*, \'base64\') AS payload, get_mqtt_property(\'content_type\') AS contentType FROM \'sampledevice/data/bin\''
+                                                           )
+                                                           )
+
+        iot_binary_to_lambda_topic_rule.apply_removal_policy(
+            cdk.RemovalPolicy.DESTROY)
+
+        if ingestion_mode == "direct":
+            ### add permission for iot rules to lambda function - this allows iot to invoke the lambda function ###
+            process_telemetry_lambda_function.add_permission("grant iot rule access",
+                                                             principal=iam.ServicePrincipal(
+                                                                 "iot.amazonaws.com"),
+                                                             source_arn=iot_to_lambda_topic_rule.attr_arn
+                                                             )
+            process_telemetry_lambda_function.add_permission("grant iot binary rule access",
+                                                             principal=iam.ServicePrincipal(
+                                                                 "iot.amazonaws.com"),
+                                                             source_arn=iot_binary_to_lambda_topic_rule.attr_arn
+                                                             )
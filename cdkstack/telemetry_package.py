@@ -0,0 +1,108 @@
+import argparse
+import compileall
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+
+### Builds the telemetry Lambda package. Only uses the standard library, so the same step runs in
+### cdkstack/lambda_packaging.py during local bundling and inside the docker bundling image:
+###   python telemetry_package.py <source dir> <output dir>
+
+### Python of the Lambda runtime. The precompiled botocore and device-meta.marshal are only usable by
+### this version, so the package is only built by it, keep in line with the telemetry function's runtime
+LAMBDA_PYTHON_VERSION = (3, 11)
+
+### botocore version vendored into the package, keep in line with requirements.txt
+BOTOCORE_VERSION = "1.43.113"
+
+### AWS services the telemetry Lambda creates clients for, only their models are kept in the vendored botocore
+LAMBDA_CLIENT_SERVICES = ("timestream-write", "dynamodb", "sqs")
+
+### endpoints.json names services by endpoint prefix, which differs from the model directory for some
+ENDPOINT_PREFIXES = {"timestream-write": "ingest.timestream"}
+
+
+class PythonVersionError(RuntimeError):
+    pass
+
+
+def check_python_version():
+    ### bytecode and marshal files of another Python are ignored or fail to load in the function
+    if sys.version_info[:2] != LAMBDA_PYTHON_VERSION:
+        raise PythonVersionError("the telemetry package must be built with Python %d.%d, not %d.%d" % (
+            LAMBDA_PYTHON_VERSION + tuple(sys.version_info[:2])))
+
+
+def copy_botocore(output_dir, version=BOTOCORE_VERSION):
+    ### copy botocore into output_dir, from the build environment when it has the pinned version
+    ### and otherwise installed with pip
+    try:
+        import botocore
+    except ImportError:
+        botocore = None
+    if botocore is not None and botocore.__version__ == version:
+        shutil.copytree(os.path.dirname(botocore.__file__), os.path.join(output_dir, "botocore"),
+                        ignore=shutil.ignore_patterns("__pycache__"))
+        return
+    subprocess.run([sys.executable, "-m", "pip", "install", "--quiet", "--no-deps", "--no-compile",
+                    "--target", output_dir, "botocore==" + version], check=True)
+
+
+def trim_botocore_data(data_dir, services=LAMBDA_CLIENT_SERVICES):
+    ### drop the models of services the function does not use and their endpoints.json entries,
+    ### botocore otherwise parses the full (over 1MB) endpoints file on every cold start
+    for name in os.listdir(data_dir):
+        if os.path.isdir(os.path.join(data_dir, name)) and name not in services:
+            shutil.rmtree(os.path.join(data_dir, name))
+
+    prefixes = {ENDPOINT_PREFIXES.get(service, service) for service in services}
+    with open(os.path.join(data_dir, "endpoints.json"), encoding="utf-8") as f:
+        endpoints = json.load(f)
+    for partition in endpoints["partitions"]:
+        partition["services"] = {
+            name: service for name, service in partition["services"].items() if name in prefixes
+        }
+    with open(os.path.join(data_dir, "endpoints.json"), "w", encoding="utf-8") as f:
+        json.dump(endpoints, f, separators=(",", ":"))
+
+
+def vendor_botocore(output_dir, version=BOTOCORE_VERSION, services=LAMBDA_CLIENT_SERVICES):
+    ### the package imports this botocore ahead of the runtime's, so the trimmed data always matches the code
+    ### reading it. It is precompiled because the function cannot write bytecode to its read-only package.
+    copy_botocore(output_dir, version)
+    botocore_dir = os.path.join(output_dir, "botocore")
+    trim_botocore_data(os.path.join(botocore_dir, "data"), services)
+    compileall.compile_dir(botocore_dir, quiet=1)
+
+
+def build_package(source_dir, output_dir):
+    ### copy the function source and add the artifacts that shorten its init:
+    ###   device-meta.marshal - compact device metadata, see device_metadata.CompactFileBackend
+    ###   botocore/           - pinned botocore with the models of LAMBDA_CLIENT_SERVICES, see aws_clients.py
+    ### Both are specific to the interpreter, so any other Python than LAMBDA_PYTHON_VERSION is refused
+    check_python_version()
+    shutil.copytree(source_dir, output_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns("__pycache__"))
+
+    sys.path.insert(0, source_dir)
+    try:
+        from device_metadata import build_compact_file
+    finally:
+        sys.path.remove(source_dir)
+    build_compact_file(os.path.join(output_dir, "device-meta.json"), os.path.join(output_dir, "device-meta.marshal"))
+
+    vendor_botocore(output_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the telemetry Lambda package")
+    parser.add_argument("source_dir")
+    parser.add_argument("output_dir")
+    args = parser.parse_args()
+    build_package(args.source_dir, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,588 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+### Backfills historical telemetry files into the Timestream telemetry table
+### Input files are streamed in batches, validated, enriched and encoded with the same modules as the
+### ingestion Lambda, and written in concurrent 100 record WriteRecords chunks. The write rate starts at
+### --rate records per second, backs off when writes are throttled and recovers while they succeed.
+### Records older than the memory store window cannot be written with WriteRecords, they are staged as
+### CSV files with a data model for a Timestream batch load task instead.
+### Progress is checkpointed per input file after every batch, rerunning the same command resumes.
+### Records of the batch in flight can be written twice after an interruption, which Timestream
+### treats as an idempotent upsert. Staged rows of that batch are cut from the staging files on resume,
+### so the batch load task sees every row once.
+###
+### Inputs: .jsonl/.json (one payload per line), .csv (columns named after the payload fields, location
+### as location.latitude/location.longitude or latitude/longitude) and .parquet (needs pyarrow).
+###
+### Examples:
+###   python backfill_telemetry.py --database <database> --table device-telemetry telemetry.jsonl
+###   python backfill_telemetry.py --database <database> --table device-telemetry --workers 4 --staging-dir staging exports/*.parquet
+
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+BACKFILL_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(BACKFILL_DIR, "..", "lambda", "process_iot_telemetry")
+
+sys.path.insert(0, LAMBDA_DIR)
+from aws_clients import create_client  # noqa: E402
+from dead_letter import dead_letter_entry  # noqa: E402
+from device_metadata import DynamoDBBackend, JsonFileBackend, MetadataCache, MetadataResolver  # noqa: E402
+from telemetry_schema import MAX_FUTURE_MS, RecordEncoder, compile_validator, load_schema  # noqa: E402
+from timestream_writer import MAX_RECORDS_PER_WRITE, TimestreamWriter  # noqa: E402
+
+try:
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+### payloads read, validated and encoded per batch, bounds the memory used per input file
+DEFAULT_BATCH_SIZE = 10000
+
+### records this close to the end of the memory store window are staged, they could age out while queued
+RETENTION_MARGIN_MS = 15 * 60 * 1000
+
+### CSV staging files are rotated after this many rows
+STAGING_ROWS_PER_FILE = 1000000
+
+### converters for CSV values by Timestream type, empty cells are treated as missing
+CSV_CONVERTERS = {"BIGINT": int, "DOUBLE": float, "BOOLEAN": lambda value: value.lower() == "true", "VARCHAR": str}
+
+
+def field_types(schema):
+    ### payload source path -> Timestream type for every field the schema reads
+    types = {dimension["source"]: "VARCHAR" for dimension in schema["dimensions"]}
+    types[schema["time"]["source"]] = "BIGINT"
+    types.update({measure["source"]: measure["type"] for measure in schema["measures"]})
+    return types
+
+
+def column_paths(schema):
+    ### accepted column names -> payload source path, the path itself or the measure name
+    paths = {source: source for source in field_types(schema)}
+    for measure in schema["measures"]:
+        paths.setdefault(measure["name"], measure["source"])
+    return paths
+
+
+def to_epoch_ms(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(value.timestamp() * 1000)
+    return value
+
+
+def row_normalizer(schema, convert_strings):
+    ### returns a function turning a flat row into a payload shaped like the MQTT messages
+    paths = column_paths(schema)
+    types = field_types(schema)
+    time_source = schema["time"]["source"]
+
+    def normalize(row):
+        payload = {}
+        for column, value in row.items():
+            path = paths.get(column, column)
+            if convert_strings and isinstance(value, str) and path in types:
+                if value == "":
+                    continue
+                try:
+                    value = CSV_CONVERTERS[types[path]](value)
+                except ValueError:
+                    pass  # left as a string, validation reports it
+            if path == time_source:
+                value = to_epoch_ms(value)
+            keys = path.split(".")
+            target = payload
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+        return payload
+
+    return normalize
+
+
+### Readers yield (position, payloads) batches starting at a checkpointed position
+### JSONL positions are byte offsets, CSV and Parquet positions are row counts
+
+def read_jsonl(path, schema, start, batch_size):
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        batch = []
+        for line in f:
+            position += len(line)
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield position, batch
+                batch = []
+        if batch:
+            yield position, batch
+
+
+def read_csv(path, schema, start, batch_size):
+    normalize = row_normalizer(schema, convert_strings=True)
+    with open(path, newline="", encoding="utf-8") as f:
+        position = 0
+        batch = []
+        for row in csv.DictReader(f):
+            position += 1
+            if position <= start:
+                continue
+            batch.append(normalize(row))
+            if len(batch) >= batch_size:
+                yield position, batch
+                batch = []
+        if batch:
+            yield position, batch
+
+
+def read_parquet(path, schema, start, batch_size):
+    if parquet is None:
+        raise RuntimeError("reading Parquet files needs pyarrow, pip install pyarrow")
+    normalize = row_normalizer(schema, convert_strings=False)
+    parquet_file = parquet.ParquetFile(path)
+
+    ### skip whole row groups before the checkpoint without decoding them
+    skip = start
+    row_groups = []
+    for index in range(parquet_file.num_row_groups):
+        rows = parquet_file.metadata.row_group(index).num_rows
+        if not row_groups and skip >= rows:
+            skip -= rows
+            continue
+        row_groups.append(index)
+
+    position = start - skip
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups):
+        rows = record_batch.to_pylist()
+        position += len(rows)
+        if skip:
+            rows = rows[skip:]
+            skip = 0
+        if rows:
+            yield position, [normalize(row) for row in rows]
+
+
+READERS = {".jsonl": read_jsonl, ".json": read_jsonl, ".ndjson": read_jsonl, ".csv": read_csv, ".parquet": read_parquet}
+
+
+def reader_for(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise ValueError("unsupported input file %s, expected one of %s" % (path, ", ".join(READERS)))
+    return READERS[extension]
+
+
+class AdaptiveRateLimiter:
+    ### Token bucket limiting records per second. The rate is halved when a write was throttled and
+    ### grows by increase while writes succeed (AIMD), so the backfill settles just below the
+    ### throughput the table accepts. Throttles within cooldown seconds of a decrease are the same
+    ### congestion and do not lower the rate again. Bursts are limited to one second worth of records.
+
+    def __init__(self, rate, min_rate=100.0, max_rate=None, increase=0.05, decrease=0.5, cooldown=1.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.allowance = 0.0
+        self.last = clock()
+        self.last_decrease = None
+
+    def acquire(self, count):
+        now = self.clock()
+        self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+        self.last = now
+        if self.allowance < count:
+            self.sleep((count - self.allowance) / self.rate)
+            self.last = self.clock()
+            self.allowance = 0.0
+        else:
+            self.allowance -= count
+
+    def update(self, throttled):
+        if throttled:
+            now = self.clock()
+            if self.last_decrease is None or now - self.last_decrease >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.last_decrease = now
+        else:
+            self.rate *= 1 + self.increase
+            if self.max_rate is not None:
+                self.rate = min(self.max_rate, self.rate)
+
+
+class RejectFile:
+    ### Dead-letter sink writing one JSON line per rejected payload or record, see dead_letter.py
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.count = 0
+
+    def send(self, entries, database, table):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        for record, code, message in entries:
+            self.file.write(json.dumps(dead_letter_entry(record, code, message, database, table)) + "\n")
+        self.count += len(entries)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class BatchLoadStaging:
+    ### Writes encoded records as CSV files for a Timestream batch load task, together with the
+    ### data model that maps the columns back to the multi-measure record. Upload the directory
+    ### to S3 and create the task with the printed command.
+
+    def __init__(self, directory, schema, prefix, sequence=0, rows_per_file=STAGING_ROWS_PER_FILE,
+                 tenant_dimension=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.sequence = sequence
+        self.rows_per_file = rows_per_file
+        self.dimensions = [dimension["name"] for dimension in schema["dimensions"]]
+        self.measures = [(measure["name"], measure["type"]) for measure in schema["measures"]]
+        if tenant_dimension:
+            self.dimensions.append(tenant_dimension)
+        self.measures += [
+            (field["name"], field["type"]) for field in schema.get("metadata", []) if field["name"] != tenant_dimension
+        ]
+        self.measure_name = schema["measure_name"]
+        self.columns = self.dimensions + ["time"] + [name for name, _ in self.measures]
+        self.file = None
+        self.writer = None
+        self.rows = 0
+        self.count = 0
+
+    def file_path(self, sequence):
+        return os.path.join(self.directory, "%s-%05d.csv" % (self.prefix, sequence))
+
+    def open_next(self):
+        self.close()
+        self.sequence += 1
+        os.makedirs(self.directory, exist_ok=True)
+        self.file = open(self.file_path(self.sequence), "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+        self.rows = 0
+
+    def resume(self, sequence, rows, size):
+        ### continue the staging file at the position of the last checkpoint. Rows staged after the
+        ### checkpoint and files opened after it are dropped, the batch in flight is staged again.
+        ### Checkpoints without a size (or of a run that never staged) start a new file.
+        self.sequence = sequence
+        following = sequence + 1
+        while os.path.exists(self.file_path(following)):
+            os.remove(self.file_path(following))
+            following += 1
+        path = self.file_path(sequence)
+        if size is None or not sequence or not os.path.exists(path):
+            return
+        with open(path, "r+b") as f:
+            f.truncate(size)
+        self.file = open(path, "a", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.rows = rows
+
+    def checkpoint(self):
+        ### staging position saved with the input position, so both always describe the same batches
+        self.flush()
+        return {
+            "staging_sequence": self.sequence,
+            "staging_rows": self.rows,
+            "staging_bytes": self.file.tell() if self.file is not None else None,
+        }
+
+    def write(self, records):
+        for record in records:
+            if self.file is None or self.rows >= self.rows_per_file:
+                self.open_next()
+            values = {dimension["Name"]: dimension["Value"] for dimension in record["Dimensions"]}
+            values["time"] = record["Time"]
+            values.update((measure["Name"], measure["Value"]) for measure in record["MeasureValues"])
+            self.writer.writerow([values.get(column, "") for column in self.columns])
+            self.rows += 1
+        self.count += len(records)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def data_model(self):
+        return {
+            "TimeColumn": "time",
+            "TimeUnit": "MILLISECONDS",
+            "DimensionMappings": [{"SourceColumn": name, "DestinationColumn": name} for name in self.dimensions],
+            "MultiMeasureMappings": {
+                "TargetMultiMeasureName": self.measure_name,
+                "MultiMeasureAttributeMappings": [
+                    {"SourceColumn": name, "TargetMultiMeasureAttributeName": name, "MeasureValueType": measure_type}
+                    for name, measure_type in self.measures
+                ],
+            },
+        }
+
+    def write_data_model(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "data-model.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.data_model(), f, indent=2)
+        return path
+
+
+def checkpoint_path(checkpoint_dir, input_path):
+    ### one checkpoint file per input so files can be processed by separate workers
+    digest = hashlib.sha1(os.path.abspath(input_path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(checkpoint_dir, "%s-%s.json" % (os.path.basename(input_path), digest))
+
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path, state):
+    ### written to a temporary file and renamed so an interruption never leaves a partial checkpoint
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(temporary, path)
+
+
+def create_resolver(options):
+    if options.device_metadata_table:
+        backend = DynamoDBBackend(create_client("dynamodb"), options.device_metadata_table)
+    else:
+        backend = JsonFileBackend(options.device_metadata)
+    return MetadataResolver(backend, MetadataCache(max_size=100000, ttl=3600))
+
+
+def backfill_file(path, options, write_client=None):
+    ### backfill one input file, returns a summary dict
+    schema = load_schema(options.schema)
+    encoder = RecordEncoder(schema, dimension_metadata=(options.tenant_dimension,))
+    validate = compile_validator(schema)
+    resolver = create_resolver(options)
+    read = reader_for(path)
+    time_source = schema["time"]["source"]
+    key_source = schema["dimensions"][0]["source"]
+
+    state_path = checkpoint_path(options.checkpoint_dir, path)
+    state = load_checkpoint(state_path)
+    if state.get("done"):
+        return dict(state, path=path, skipped=True)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    rejects = RejectFile(os.path.join(options.checkpoint_dir, name + "-rejected.jsonl"))
+    staging = BatchLoadStaging(options.staging_dir, schema, name, rows_per_file=options.staging_rows_per_file,
+                               tenant_dimension=options.tenant_dimension)
+    staging.resume(state.get("staging_sequence", 0), state.get("staging_rows", 0), state.get("staging_bytes"))
+    writer = TimestreamWriter(
+        write_client or create_client("timestream-write", max_pool_connections=options.concurrency * 2,
+                                      retries={"max_attempts": 2, "mode": "standard"}),
+        options.database, options.table, rejects, max_concurrency=options.concurrency,
+        ### no invocation deadline here, so throttled records are retried longer than in the Lambda
+        max_attempts=10, max_delay=5.0,
+    )
+    limiter = AdaptiveRateLimiter(options.rate, max_rate=options.max_rate)
+    memory_store_ms = int(options.memory_store_hours * 3600 * 1000)
+    group_size = options.concurrency * MAX_RECORDS_PER_WRITE
+
+    totals = {key: state.get(key, 0) for key in ("read", "written", "staged", "rejected", "retries")}
+    start = position = state.get("position", 0)
+    started = time.monotonic()
+    last_report = started
+
+    def prepare(payloads):
+        ### validate, enrich and encode a batch, split by whether the memory store still accepts it
+        now = int(time.time() * 1000)
+        cutoff = now - memory_store_ms + RETENTION_MARGIN_MS
+        valid = []
+        invalid = []
+        for payload in payloads:
+            reasons = validate(payload, 0, now + MAX_FUTURE_MS)
+            if reasons:
+                invalid.append((payload, "INVALID_PAYLOAD", "; ".join(reasons)))
+            else:
+                valid.append(payload)
+        metadata = resolver.resolve_many(payload[key_source] for payload in valid)
+        recent = []
+        old = []
+        for payload in valid:
+            record = encoder.encode(payload, metadata.get(payload[key_source]) or {})
+            (recent if payload[time_source] >= cutoff else old).append(record)
+        recent.sort(key=lambda record: record["Dimensions"][0]["Value"])
+        return recent, old, invalid
+
+    def write(recent):
+        written = 0
+        for offset in range(0, len(recent), group_size):
+            group = recent[offset:offset + group_size]
+            limiter.acquire(len(group))
+            result = writer.write(group)
+            limiter.update(result.retries > 0)
+            if result.failed:
+                rejects.send([(group[index], code, message) for index, code, message in result.failed],
+                             options.database, options.table)
+            written += result.written
+            totals["retries"] += result.retries
+        return written
+
+    ### reading and encoding overlaps with writing, the queue holds at most two prepared batches
+    prepared = queue.Queue(maxsize=2)
+    errors = []
+
+    def produce():
+        try:
+            for end, payloads in read(path, schema, start, options.batch_size):
+                prepared.put((end, len(payloads)) + prepare(payloads))
+        except BaseException as err:
+            errors.append(err)
+        finally:
+            prepared.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = prepared.get()
+            if item is None:
+                break
+            position, count, recent, old, invalid = item
+            if invalid:
+                rejects.send(invalid, options.database, options.table)
+            totals["written"] += write(recent)
+            staging.write(old)
+            rejects.flush()
+            totals["read"] += count
+            totals["staged"] += len(old)
+            totals["rejected"] = state.get("rejected", 0) + rejects.count
+            save_checkpoint(state_path, dict(totals, position=position, **staging.checkpoint()))
+
+            now = time.monotonic()
+            if now - last_report >= options.report_seconds:
+                last_report = now
+                print("%s: %d read, %d written, %d staged, %d rejected, %.0f records/s (rate limit %.0f/s)" % (
+                    path, totals["read"], totals["written"], totals["staged"], totals["rejected"],
+                    totals["written"] / (now - started), limiter.rate), file=sys.stderr)
+        if errors:
+            raise errors[0]
+    finally:
+        staging.close()
+        rejects.close()
+        if writer.executor is not None:
+            writer.executor.shutdown()
+
+    if staging.count or state.get("staged"):
+        staging.write_data_model()
+    elapsed = time.monotonic() - started
+    save_checkpoint(state_path, dict(totals, position=position, staging_sequence=staging.sequence, done=True))
+    return dict(totals, path=path, seconds=round(elapsed, 3),
+                records_per_second=round(totals["written"] / elapsed, 1) if elapsed else 0.0)
+
+
+def batch_load_command(options):
+    return ("aws timestream-write create-batch-load-task --target-database-name %s --target-table-name %s "
+            "--data-source-configuration 'DataSourceS3Configuration={BucketName=<bucket>,ObjectKeyPrefix=<prefix>},"
+            "DataFormat=CSV' --data-model-configuration 'DataModel=file://%s' "
+            "--report-configuration 'ReportS3Configuration={BucketName=<bucket>}'") % (
+        options.database, options.table, os.path.join(options.staging_dir, "data-model.json"))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill historical telemetry into Timestream")
+    parser.add_argument("inputs", nargs="+", help="JSONL, CSV or Parquet telemetry files")
+    parser.add_argument("--database", required=True, help="Timestream database")
+    parser.add_argument("--table", default="device-telemetry", help="Timestream table")
+    parser.add_argument("--schema", default=os.path.join(LAMBDA_DIR, "telemetry-schema.json"))
+    parser.add_argument("--device-metadata", default=os.path.join(LAMBDA_DIR, "device-meta.json"),
+                        help="device metadata JSON file")
+    parser.add_argument("--device-metadata-table", default=None, help="read device metadata from this DynamoDB table")
+    parser.add_argument("--tenant-dimension", default=None,
+                        help="metadata field written as a dimension, customerid for stacks deployed with multi_tenant=true")
+    parser.add_argument("--memory-store-hours", type=float, default=6.0,
+                        help="memory store retention of the table, older records are staged for batch load")
+    parser.add_argument("--rate", type=float, default=5000.0, help="initial records per second")
+    parser.add_argument("--max-rate", type=float, default=None, help="records per second the rate never exceeds")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent WriteRecords calls per worker")
+    parser.add_argument("--workers", type=int, default=1, help="input files processed in parallel")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="payloads read per batch")
+    parser.add_argument("--checkpoint-dir", default=".backfill", help="checkpoints and rejected records")
+    parser.add_argument("--staging-dir", default="batch-load", help="CSV files for records older than the memory store")
+    parser.add_argument("--staging-rows-per-file", type=int, default=STAGING_ROWS_PER_FILE,
+                        help="rows per staged CSV file")
+    parser.add_argument("--report-seconds", type=float, default=10.0, help="progress report interval")
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_args()
+
+    for path in options.inputs:
+        reader_for(path)
+
+    if options.workers > 1 and len(options.inputs) > 1:
+        with ProcessPoolExecutor(max_workers=options.workers) as executor:
+            summaries = list(executor.map(backfill_file, options.inputs, [options] * len(options.inputs)))
+    else:
+        summaries = [backfill_file(path, options) for path in options.inputs]
+
+    for summary in summaries:
+        print(json.dumps(summary))
+    if any(summary.get("staged") for summary in summaries):
+        print("Records older than the memory store were staged in %s, upload them to S3 and run:\n  %s" % (
+            options.staging_dir, batch_load_command(options)), file=sys.stderr)
+    if any(summary.get("rejected") for summary in summaries):
+        print("Rejected records are listed in %s/*-rejected.jsonl" % options.checkpoint_dir, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+### Benchmarks the telemetry ingestion Lambda locally with a fake Timestream write client
+### Measures module init (cold start), per-message and per-batch handler latency percentiles,
+### peak traced memory in total and per message of a batch, memory blocks allocated per message and
+### still held after the invocations (a tracemalloc snapshot diff), and WriteRecords calls per 1k messages,
+### across payload sizes and batch sizes. Results are written as JSON and can be compared
+### with a stored baseline to catch hot path regressions before deploying.
+###
+### Examples:
+###   python benchmark_ingestion.py --output results.json --save-baseline
+###   python benchmark_ingestion.py --baseline baseline.json --tolerance 0.25
+### No baseline is committed, timings depend on the machine, so save one before comparing.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(BENCHMARK_DIR, "..", "lambda", "process_iot_telemetry")
+HANDLER_PATH = os.path.join(LAMBDA_DIR, "process-telemetry-data.py")
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "simulator"))
+from telemetry_generator import LocalContext, TelemetryGenerator, history_start_ms, load_handler_module, load_schema  # noqa: E402
+sys.path.insert(0, LAMBDA_DIR)
+from dedup import Deduplicator  # noqa: E402
+
+### payload size variants, padded payloads carry extra fields the schema ignores
+PAYLOAD_PADDING = {"small": 0, "medium": 20, "large": 200}
+BATCH_SIZES = [1, 10, 100, 1000]
+
+### fraction of redelivered messages in the duplicates case, the other cases carry no duplicates
+DUPLICATE_RATIO = 0.1
+DUPLICATE_BATCH_SIZE = 100
+
+### metrics where a higher value than the baseline is a regression
+REGRESSION_METRICS = ("p50_ms", "p99_ms", "per_message_us", "peak_memory_kb", "peak_bytes_per_message",
+                      "allocations_per_message", "write_calls_per_1k", "init_ms")
+
+### allocations of tracemalloc itself are left out of the snapshot diff
+TRACEMALLOC_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def sqs_event(payloads, padding):
+    ### wrap payloads in an SQS style envelope so JSON parsing is part of the measurement
+    records = []
+    for index, payload in enumerate(payloads):
+        if padding:
+            payload = dict(payload, **{"extra_%d" % i: "x" * 16 for i in range(padding)})
+        records.append({"messageId": str(index), "body": json.dumps(payload)})
+    return {"Records": records}
+
+
+def measure_cold_start(runs):
+    ### import the handler module in fresh interpreters and report the init time
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--cold-start-probe"],
+            capture_output=True, text=True, check=True, env=os.environ.copy(),
+        )
+        timings.append(json.loads(output.stdout.strip().splitlines()[-1])["init_ms"])
+    return {"init_ms": statistics.median(timings), "init_ms_runs": timings}
+
+
+def cold_start_probe():
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):
+        load_handler_module(HANDLER_PATH)
+    print(json.dumps({"init_ms": (time.perf_counter() - started) * 1000}))
+
+
+def reset_deduplicator(module):
+    ### every pass replays the same events, a fresh deduplicator keeps later passes from
+    ### dropping them all as redeliveries of the earlier ones
+    module.deduplicator = Deduplicator()
+    return module.deduplicator
+
+
+def run_case(module, fake_client, events):
+    ### invoke the handler for each event and collect latency, memory, write call and duplicate metrics
+    handler = module.lambda_handler
+    message_count = sum(len(event["Records"]) for event in events)
+
+    latencies = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        reset_deduplicator(module)
+        handler(events[0], LocalContext())  # warm up
+
+        deduplicator = reset_deduplicator(module)
+        fake_client.calls = 0
+        for event in events:
+            started = time.perf_counter()
+            handler(event, LocalContext())
+            latencies.append((time.perf_counter() - started) * 1000)
+        write_calls = fake_client.calls
+
+        reset_deduplicator(module)
+        tracemalloc.start()
+        for event in events:
+            handler(event, LocalContext())
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        ### a separate pass, the snapshots would otherwise count towards the peak. Blocks freed within
+        ### an invocation cancel out, what remains is held by caches, buffers and state per message
+        reset_deduplicator(module)
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS)
+        for event in events:
+            handler(event, LocalContext())
+        after = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS)
+        tracemalloc.stop()
+        allocations = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+
+    return {
+        "p50_ms": percentile(latencies, 0.50),
+        "p90_ms": percentile(latencies, 0.90),
+        "p99_ms": percentile(latencies, 0.99),
+        "per_message_us": sum(latencies) * 1000 / message_count,
+        "peak_memory_kb": peak / 1024,
+        ### the peak is reached inside one invocation, so it is divided by the messages of one batch
+        "peak_bytes_per_message": peak / (message_count / len(events)),
+        "allocations_per_message": max(0, allocations) / message_count,
+        "write_calls_per_1k": write_calls * 1000 / message_count,
+        "duplicates_dropped": deduplicator.duplicates / message_count,
+    }
+
+
+def run_benchmarks(messages, cold_start_runs):
+    ### load_handler_module points the handler at a RecordingWriteClient
+    with contextlib.redirect_stdout(sys.stderr):
+        module = load_handler_module(HANDLER_PATH)
+    fake_client = module.write_client
+
+    ### timestamps of all cases end now, later ones would be quarantined as too far in the future
+    generated = len(PAYLOAD_PADDING) * sum(max(5, messages // batch_size) * batch_size for batch_size in BATCH_SIZES)
+    generator = TelemetryGenerator(load_schema(), start_time_ms=history_start_ms(generated, 1000.0), seed=7)
+    results = {"cold_start": measure_cold_start(cold_start_runs), "cases": {}}
+
+    cases = [("%s/batch-%d" % (payload_name, batch_size), generator, padding, batch_size)
+             for payload_name, padding in PAYLOAD_PADDING.items() for batch_size in BATCH_SIZES]
+    ### the duplicate drop path, a fraction of messages is redelivered a few positions after the original
+    duplicates = TelemetryGenerator(load_schema(), duplicates=DUPLICATE_RATIO, seed=7,
+                                    start_time_ms=history_start_ms(max(5, messages // DUPLICATE_BATCH_SIZE)
+                                                                   * DUPLICATE_BATCH_SIZE, 1000.0))
+    cases.append(("duplicates-%d%%/batch-%d" % (DUPLICATE_RATIO * 100, DUPLICATE_BATCH_SIZE), duplicates, 0,
+                  DUPLICATE_BATCH_SIZE))
+
+    for name, source, padding, batch_size in cases:
+        invocations = max(5, messages // batch_size)
+        events = [sqs_event(batch, padding) for batch in source.iter_batches(invocations * batch_size, batch_size)]
+        results["cases"][name] = run_case(module, fake_client, events)
+        print("%-24s %s" % (name, json.dumps({k: round(v, 3) for k, v in results["cases"][name].items()})),
+              file=sys.stderr)
+
+    results["environment"] = {"python": platform.python_version(), "machine": platform.machine()}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    ### returns a list of regressions where a metric grew by more than tolerance over the baseline
+    regressions = []
+    pairs = [("cold_start", results["cold_start"], baseline.get("cold_start", {}))]
+    pairs += [(name, case, baseline.get("cases", {}).get(name, {})) for name, case in results["cases"].items()]
+    for name, current, previous in pairs:
+        for metric in REGRESSION_METRICS:
+            if metric in current and previous.get(metric):
+                change = current[metric] / previous[metric] - 1
+                if change > tolerance:
+                    regressions.append("%s %s: %.3f -> %.3f (+%.0f%%)" % (
+                        name, metric, previous[metric], current[metric], change * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the telemetry ingestion Lambda")
+    parser.add_argument("--messages", type=int, default=2000, help="messages per case")
+    parser.add_argument("--cold-start-runs", type=int, default=5)
+    parser.add_argument("--output", default="-", help="results JSON file, - for stdout")
+    parser.add_argument("--baseline", default=None, help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative growth per metric")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as " + DEFAULT_BASELINE)
+    parser.add_argument("--cold-start-probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_start_probe:
+        cold_start_probe()
+        return
+
+    if args.baseline and not os.path.exists(args.baseline):
+        parser.error("no baseline at %s, save one first with --save-baseline" % args.baseline)
+
+    results = run_benchmarks(args.messages, args.cold_start_runs)
+
+    serialized = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(serialized)
+    else:
+        with open(args.output, "w", encoding="utf-8") as output:
+            output.write(serialized)
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, "w", encoding="utf-8") as output:
+            output.write(serialized)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+### Compares the packed struct payload encoding with JSON for the sample device payload
+### Reports bytes per message (raw and base64 as forwarded by the binary IoT Rule) and the
+### per message decode cost of the decoders used by the ingestion Lambda.
+###
+### Examples:
+###   python benchmark_payloads.py
+###   python benchmark_payloads.py --messages 100000 --output results.json
+
+import argparse
+import base64
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "simulator"))
+from telemetry_generator import ENCODINGS, TelemetryGenerator, load_codecs, load_schema  # noqa: E402
+
+codecs = load_codecs()
+
+
+def decoders():
+    ### (name, encoding, decode) for every decoder to measure, JSON as parsed by the Lambda runtime
+    return [
+        ("json", "json", codecs.decode_json),
+        ("packed", "packed", codecs.decode_packed),
+    ]
+
+
+def time_decode(decode, payloads, repeats):
+    ### best of repeats, in microseconds per message
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for payload in payloads:
+            decode(payload)
+        timings.append((time.perf_counter() - started) * 1000000 / len(payloads))
+    return min(timings)
+
+
+def run_benchmarks(messages, repeats):
+    generator = TelemetryGenerator(load_schema(), seed=7)
+    payloads = generator.generate(messages)
+    encoded = {encoding: [codecs.encode_payload(payload, encoding) for payload in payloads] for encoding in ENCODINGS}
+
+    for encoding, values in encoded.items():
+        if any(codecs.decode_payload(value) != payload for value, payload in zip(values[:100], payloads)):
+            raise AssertionError("%s does not round trip" % encoding)
+
+    json_bytes = statistics.mean(map(len, encoded["json"]))
+    json_decode = None
+    results = {"cases": {}}
+    for name, encoding, decode in decoders():
+        values = encoded[encoding]
+        decode_us = time_decode(decode, values, repeats)
+        if name == "json":
+            json_decode = decode_us
+        results["cases"][name] = {
+            "bytes_per_message": statistics.mean(map(len, values)),
+            "base64_bytes_per_message": statistics.mean(len(base64.b64encode(value)) for value in values),
+            "size_vs_json": statistics.mean(map(len, values)) / json_bytes,
+            "decode_us": decode_us,
+            "decode_vs_json": decode_us / json_decode,
+        }
+        print("%-16s %s" % (name, json.dumps({k: round(v, 3) for k, v in results["cases"][name].items()})),
+              file=sys.stderr)
+
+    results["environment"] = {"python": platform.python_version(), "machine": platform.machine()}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the packed telemetry payload encoding with JSON")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default="-", help="results JSON file, - for stdout")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.messages, args.repeats)
+
+    serialized = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(serialized)
+    else:
+        with open(args.output, "w", encoding="utf-8") as output:
+            output.write(serialized)
+
+
+if __name__ == "__main__":
+    main()
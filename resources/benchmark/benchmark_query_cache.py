@@ -0,0 +1,187 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+### Benchmarks the dashboard query cache against the local Timestream stand-in
+### Fills the stand-in through the telemetry Lambda, then simulates viewers refreshing the dashboard:
+### every refresh new telemetry is ingested and each viewer sends all panel queries, in groups of
+### viewers that refresh at the same moment, through the query cache Lambda (function URL events).
+### Reports upstream queries, rows and query time with and without the cache, and checks every cached
+### response against a direct run of the same aligned query.
+###
+### Examples:
+###   python benchmark_query_cache.py
+###   python benchmark_query_cache.py --viewers 50 --concurrent 10 --refreshes 30 --output results.json
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROXY_PATH = os.path.join(BENCHMARK_DIR, "..", "lambda", "query_cache", "query-cache-proxy.py")
+DASHBOARD_PATH = os.path.join(BENCHMARK_DIR, "..", "grafana", "grafana_dashboard.json")
+
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "emulator"))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "simulator"))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "lambda", "process_iot_telemetry"))
+sys.path.insert(0, os.path.dirname(PROXY_PATH))
+from query_cache import plan_query  # noqa: E402
+from telemetry_generator import TelemetryGenerator, load_schema  # noqa: E402
+from timestream_local import (LocalTimestream, configure_handler_environment, dashboard_queries,  # noqa: E402
+                              expand_macros, ingest, load_dashboard, load_ingestion_handler,
+                              parse_relative)
+
+TOKEN = "benchmark"
+
+
+class SimulatedClock:
+    ### shared by the stand-in and the cache, advanced by the benchmark
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def load_proxy(local, clock, refresh):
+    os.environ["QueryCacheToken"] = TOKEN
+    os.environ["QueryCacheAlignSeconds"] = str(refresh)
+    os.environ.setdefault("QueryCacheTableLateSeconds", json.dumps({"device-telemetry-rollup": 3660}))
+    spec = importlib.util.spec_from_file_location("query_cache_proxy", PROXY_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.query_cache.client = local
+    module.query_cache.clock = clock.time
+    return module
+
+
+def aligned_query(cache, sql):
+    ### the query the cache answers sql with
+    return plan_query(sql, int(cache.clock() * 10 ** 9), cache.align_ns, cache.late_ns, cache.settled_ttl_ns,
+                      cache.table_late_ns).sql
+
+
+def url_event(sql):
+    return {
+        "rawPath": "/",
+        "headers": {"X-Amz-Target": "Timestream_20181101.Query", "Host": "localhost", "X-Query-Cache-Token": TOKEN},
+        "body": json.dumps({"QueryString": sql}),
+        "isBase64Encoded": False,
+    }
+
+
+def row_values(rows):
+    return sorted(tuple(datum.get("ScalarValue") for datum in row["Data"]) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard query cache against a local Timestream")
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50.0, help="telemetry messages per second")
+    parser.add_argument("--history", type=int, default=1800, help="seconds of telemetry ingested before the first refresh")
+    parser.add_argument("--viewers", type=int, default=10, help="viewers with the dashboard open")
+    parser.add_argument("--concurrent", type=int, default=5, help="viewers refreshing at the same moment")
+    parser.add_argument("--refreshes", type=int, default=6)
+    parser.add_argument("--refresh", type=int, default=10, help="dashboard refresh interval in seconds")
+    parser.add_argument("--range", default="20m", help="dashboard time range for panels without a time override")
+    parser.add_argument("--output", default="-", help="results JSON file, - for stdout")
+    args = parser.parse_args()
+
+    database = "local"
+    configure_handler_environment(database)
+    ### refreshes start on cache interval boundaries, so every response can be checked against the data
+    ### ingested at the start of its interval
+    start = time.time() - args.refreshes * args.refresh
+    clock = SimulatedClock(start - start % args.refresh)
+    local = LocalTimestream(clock=clock.time)
+    handler = load_ingestion_handler(local)
+    proxy = load_proxy(local, clock, args.refresh)
+
+    generator = TelemetryGenerator(load_schema(), device_count=args.devices, rate=args.rate,
+                                   start_time_ms=int((clock.now - args.history) * 1000), seed=7)
+    ingest(handler, generator, int(args.history * args.rate), 500, flush=True)
+
+    queries = list(dashboard_queries(load_dashboard(DASHBOARD_PATH, database)))
+    variables = {"deviceid": str(generator.device_ids[0]), "tileprecision": "3"}
+    range_ns = parse_relative(args.range)
+    groups = [list(range(start, min(start + args.concurrent, args.viewers)))
+              for start in range(0, args.viewers, args.concurrent)]
+
+    direct = {"queries": 0, "rows": 0, "seconds": 0.0}
+    cached = {"requests": 0, "seconds": 0.0, "errors": 0}
+    mismatches = []
+    executor = ThreadPoolExecutor(max_workers=32)
+    refresh_start = clock.now
+    for refresh in range(args.refreshes):
+        ### telemetry of the last refresh interval arrives before the viewers refresh
+        ingest(handler, generator, int(args.refresh * args.rate), 500)
+        for index, group in enumerate(groups):
+            clock.now = refresh_start + refresh * args.refresh + index * args.refresh / len(groups)
+            end_ns = int(clock.now * 10 ** 9)
+            sqls = []
+            for _ in group:
+                for _, time_from, target in queries:
+                    start_ns = end_ns - (parse_relative(time_from) if time_from else range_ns)
+                    sqls.append(expand_macros(target["rawQuery"], start_ns, end_ns, variables))
+
+            started = time.perf_counter()
+            for sql in sqls:
+                direct["rows"] += len(local.query(QueryString=sql)["Rows"])
+            direct["seconds"] += time.perf_counter() - started
+            direct["queries"] += len(sqls)
+
+            started = time.perf_counter()
+            responses = list(executor.map(lambda sql: proxy.lambda_handler(url_event(sql), None), sqls))
+            cached["seconds"] += time.perf_counter() - started
+            cached["requests"] += len(sqls)
+
+            for sql, response in zip(sqls, responses):
+                if response["statusCode"] != 200:
+                    cached["errors"] += 1
+                    continue
+                expected = local.query(QueryString=aligned_query(proxy.query_cache, sql))["Rows"]
+                if row_values(json.loads(response["body"])["Rows"]) != row_values(expected):
+                    mismatches.append(sql)
+    executor.shutdown()
+
+    stats = proxy.query_cache.stats
+    results = {
+        "viewers": args.viewers,
+        "refreshes": args.refreshes,
+        "direct": dict(direct, seconds=round(direct["seconds"], 3)),
+        "cached": dict(cached, seconds=round(cached["seconds"], 3), **stats),
+        "upstream_query_reduction": round(1 - stats["upstreamQueries"] / direct["queries"], 4),
+        "upstream_row_reduction": round(1 - stats["upstreamRows"] / direct["rows"], 4) if direct["rows"] else 0.0,
+        "mismatches": len(mismatches),
+    }
+    for sql in mismatches[:5]:
+        print("mismatch:", sql, file=sys.stderr)
+
+    if args.output == "-":
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
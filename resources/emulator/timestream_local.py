@@ -0,0 +1,743 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+### Local stand-in for the Timestream WriteRecords and Query APIs, backed by SQLite
+### LocalTimestream can replace both the timestream-write client of the ingestion Lambda and a
+### timestream-query client, so the handler and the dashboard rawQuery statements run end to end
+### without AWS. It models:
+###   records     - multi-measure and single-measure records, CommonAttributes, TimeUnit
+###   identity    - dimensions, measure name and time identify a record, Version decides upserts:
+###                 identical values are accepted, a higher version replaces the record, anything
+###                 else is rejected with ExistingVersion like Timestream
+###   rejections  - memory store window, future timestamps, type and name conflicts, invalid values,
+###                 raised as RejectedRecordsException after the accepted records were stored
+###   faults      - write_rate/query_rate token buckets raising ThrottlingException, error_rate
+###                 InternalServerException and latency_ms +- latency_jitter_ms per call
+### Exceptions are the botocore classes of the real clients, so retry and error handling code paths
+### behave as they do against the service. Queries are translated to SQLite: ago(), now(), bin(),
+### duration literals, max_by/min_by and approx_percentile are provided as SQL functions and
+### expand_macros() expands the Grafana $__timeFilter style macros.
+###
+### Examples:
+###   python timestream_local.py --count 100000 --devices 1000
+###   python timestream_local.py --count 200000 --write-rate 20000 --latency-ms 15 --output results.json
+
+import argparse
+import contextlib
+import datetime
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+import botocore.session
+
+EMULATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(EMULATOR_DIR, "..", "lambda", "process_iot_telemetry")
+DASHBOARD_PATH = os.path.join(EMULATOR_DIR, "..", "grafana", "grafana_dashboard.json")
+
+### Timestream limits and defaults
+MAX_RECORDS_PER_WRITE = 100
+MAX_FUTURE_NS = 15 * 60 * 10 ** 9
+DEFAULT_MEMORY_STORE_HOURS = 6
+
+TIME_UNITS = {"MILLISECONDS": 10 ** 6, "SECONDS": 10 ** 9, "MICROSECONDS": 10 ** 3, "NANOSECONDS": 1}
+DURATION_UNITS = {"ns": 1, "us": 10 ** 3, "ms": 10 ** 6, "s": 10 ** 9, "m": 60 * 10 ** 9, "h": 3600 * 10 ** 9,
+                  "d": 86400 * 10 ** 9}
+SQLITE_TYPES = {"DOUBLE": "REAL", "BIGINT": "INTEGER", "VARCHAR": "TEXT", "BOOLEAN": "INTEGER", "TIMESTAMP": "TEXT"}
+
+### string literals are matched first so rewrites never touch them
+QUERY_TOKENS = re.compile(
+    r"(?P<string>'(?:[^']|'')*')"
+    r"|(?P<table>\"(?P<database>[^\"]+)\"\s*\.\s*\"(?P<name>[^\"]+)\")"
+    r"|(?P<measure_value>\bmeasure_value::(?P<value_type>\w+))"
+    r"|(?P<duration>\b(?P<amount>\d+(?:\.\d+)?)(?P<unit>ns|us|ms|s|m|h|d)\b)"
+)
+TIME_TEXT = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{9}$")
+
+
+def service_exceptions(service_name):
+    ### exception classes of a botocore client, creating the client does not call AWS
+    client = botocore.session.get_session().create_client(
+        service_name, region_name="us-east-1", aws_access_key_id="local", aws_secret_access_key="local"
+    )
+    return client.exceptions
+
+
+def format_time(ns):
+    ### Timestream renders timestamps as "YYYY-MM-DD HH:MM:SS.nnnnnnnnn", which also sorts chronologically
+    seconds, fraction = divmod(int(ns), 10 ** 9)
+    moment = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)
+    return moment.strftime("%Y-%m-%d %H:%M:%S") + ".%09d" % fraction
+
+
+def parse_time(text):
+    date, _, fraction = text.partition(".")
+    moment = datetime.datetime.strptime(date.replace("T", " ").rstrip("Z"), "%Y-%m-%d %H:%M:%S")
+    seconds = int((moment - datetime.datetime(1970, 1, 1)).total_seconds())
+    digits = fraction.rstrip("Z")[:9].ljust(9, "0") if fraction else "0"
+    return seconds * 10 ** 9 + int(digits)
+
+
+def parse_iso8601(text):
+    ### from_iso8601_timestamp('2024-01-01T00:00:00.000Z')
+    return format_time(parse_time(text))
+
+
+def bin_time(text, size_ns):
+    if text is None:
+        return None
+    ns = parse_time(text)
+    return format_time(ns - ns % int(size_ns))
+
+
+def date_trunc(unit, text):
+    sizes = {"second": 10 ** 9, "minute": 60 * 10 ** 9, "hour": 3600 * 10 ** 9, "day": 86400 * 10 ** 9}
+    return bin_time(text, sizes[unit.lower()])
+
+
+class MaxBy:
+    ### max_by(value, key) aggregate, min_by reverses the comparison
+    sign = 1
+
+    def __init__(self):
+        self.key = None
+        self.value = None
+
+    def step(self, value, key):
+        if key is not None and (self.key is None or (key > self.key if self.sign > 0 else key < self.key)):
+            self.key = key
+            self.value = value
+
+    def finalize(self):
+        return self.value
+
+
+class MinBy(MaxBy):
+    sign = -1
+
+
+class ApproxPercentile:
+    def __init__(self):
+        self.values = []
+
+    def step(self, value, fraction):
+        if value is not None:
+            self.values.append(value)
+            self.fraction = fraction
+
+    def finalize(self):
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        return ordered[min(len(ordered) - 1, int(round(self.fraction * (len(ordered) - 1))))]
+
+
+class TokenBucket:
+    ### allows rate units per second with bursts of one second worth of units
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = float(rate)
+        self.clock = clock
+        self.tokens = self.rate
+        self.last = clock()
+
+    def take(self, count):
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if count > self.tokens:
+            return False
+        self.tokens -= count
+        return True
+
+
+class LocalTable:
+    ### column layout of one Timestream table, stored as a SQLite table with a view for queries
+
+    def __init__(self, database, name, memory_store_hours, magnetic_store_writes):
+        self.database = database
+        self.name = name
+        self.memory_store_ns = int(memory_store_hours * 3600 * 10 ** 9)
+        self.magnetic_store_writes = magnetic_store_writes
+        self.storage = "_data_%s_%s" % (re.sub(r"\W", "_", database), re.sub(r"\W", "_", name))
+        self.view = "%s.%s" % (database, name)
+        self.dimensions = []
+        self.measures = {}
+        self.versions = {}
+        self.insert_statements = {}
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class LocalTimestream:
+    ### In-process Timestream write and query API, see the module comment
+
+    def __init__(self, path=":memory:", memory_store_hours=DEFAULT_MEMORY_STORE_HOURS, magnetic_store_writes=False,
+                 write_rate=None, query_rate=None, latency_ms=0.0, latency_jitter_ms=0.0, error_rate=0.0,
+                 auto_create=True, clock=time.time, sleep=time.sleep, seed=None):
+        self.memory_store_hours = memory_store_hours
+        self.magnetic_store_writes = magnetic_store_writes
+        self.write_bucket = TokenBucket(write_rate) if write_rate else None
+        self.query_bucket = TokenBucket(query_rate) if query_rate else None
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.auto_create = auto_create
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random.Random(seed)
+        self.exceptions = service_exceptions("timestream-write")
+        self.query_exceptions = service_exceptions("timestream-query")
+        self.lock = threading.RLock()
+        self.tables = {}
+        self.pages = {}
+        self.stats = {"write_calls": 0, "records_written": 0, "records_rejected": 0, "throttled": 0,
+                      "errors": 0, "queries": 0, "query_seconds": 0.0}
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        ### deterministic lets SQLite evaluate constant calls such as ago(1h) once per query, like Timestream
+        functions = {
+            "ago": lambda size: format_time(self.now_ns() - int(size)),
+            "now": lambda: format_time(self.now_ns()),
+            "bin": bin_time,
+            "date_trunc": date_trunc,
+            "from_iso8601_timestamp": parse_iso8601,
+            "from_milliseconds": lambda ms: format_time(int(ms) * 10 ** 6),
+            "to_milliseconds": lambda text: parse_time(text) // 10 ** 6 if text else None,
+        }
+        for name, function in functions.items():
+            self.db.create_function(name, function.__code__.co_argcount, function, deterministic=True)
+        self.db.create_aggregate("max_by", 2, MaxBy)
+        self.db.create_aggregate("min_by", 2, MinBy)
+        self.db.create_aggregate("approx_percentile", 2, ApproxPercentile)
+
+    def now_ns(self):
+        return int(self.clock() * 10 ** 9)
+
+    ### tables
+
+    def create_table(self, database, table, memory_store_hours=None, magnetic_store_writes=None):
+        with self.lock:
+            key = (database, table)
+            if key not in self.tables:
+                state = LocalTable(
+                    database, table,
+                    self.memory_store_hours if memory_store_hours is None else memory_store_hours,
+                    self.magnetic_store_writes if magnetic_store_writes is None else magnetic_store_writes,
+                )
+                self.db.execute(
+                    "CREATE TABLE %s (_series TEXT NOT NULL, measure_name TEXT NOT NULL, time TEXT NOT NULL, "
+                    "_version INTEGER NOT NULL, PRIMARY KEY (_series, measure_name, time))" % quote(state.storage)
+                )
+                self.db.execute("CREATE INDEX %s ON %s (time)" % (
+                    quote(state.storage + "_time"), quote(state.storage)))
+                self.tables[key] = state
+                self.refresh_view(state)
+            return self.tables[key]
+
+    def table(self, database, table, operation):
+        state = self.tables.get((database, table))
+        if state is None:
+            if not self.auto_create:
+                raise self.exceptions.ResourceNotFoundException(
+                    {"Error": {"Code": "ResourceNotFoundException",
+                               "Message": "The table %s does not exist in database %s." % (table, database)}},
+                    operation)
+            state = self.create_table(database, table)
+        return state
+
+    def add_column(self, state, name, sqlite_type):
+        self.db.execute("ALTER TABLE %s ADD COLUMN %s %s" % (quote(state.storage), quote(name), sqlite_type))
+        state.insert_statements.clear()
+
+    def refresh_view(self, state):
+        ### the view hides the internal columns, so SELECT * returns what Timestream would
+        columns = [quote(name) for name in state.dimensions] + ["measure_name", "time"]
+        columns += [quote(name) for name in state.measures]
+        self.db.execute("DROP VIEW IF EXISTS %s" % quote(state.view))
+        self.db.execute("CREATE VIEW %s AS SELECT %s FROM %s" % (
+            quote(state.view), ", ".join(columns), quote(state.storage)))
+
+    ### WriteRecords
+
+    def draw_faults(self, bucket, units, operation, exceptions):
+        ### decides the injected latency and error of one call, under the lock as it updates the
+        ### token bucket, the random state and the stats. inject_faults applies them after the lock is released.
+        delay = 0.0
+        if self.latency_ms or self.latency_jitter_ms:
+            delay = max(0.0, self.latency_ms + self.random.uniform(-1, 1) * self.latency_jitter_ms) / 1000.0
+        if bucket is not None and not bucket.take(units):
+            self.stats["throttled"] += 1
+            return delay, exceptions.ThrottlingException(
+                {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, operation)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return delay, exceptions.InternalServerException(
+                {"Error": {"Code": "InternalServerException", "Message": "Injected internal error"}}, operation)
+        return delay, None
+
+    def inject_faults(self, bucket, units, operation, exceptions):
+        ### the sleep happens without holding the lock, so concurrent callers overlap their latency
+        with self.lock:
+            delay, error = self.draw_faults(bucket, units, operation, exceptions)
+        if delay:
+            self.sleep(delay)
+        if error is not None:
+            raise error
+
+    def write_records(self, DatabaseName, TableName, Records, CommonAttributes=None):
+        if not Records or len(Records) > MAX_RECORDS_PER_WRITE:
+            raise self.exceptions.ValidationException(
+                {"Error": {"Code": "ValidationException",
+                           "Message": "Records must contain between 1 and %d items" % MAX_RECORDS_PER_WRITE}},
+                "WriteRecords")
+        with self.lock:
+            self.stats["write_calls"] += 1
+        self.inject_faults(self.write_bucket, len(Records), "WriteRecords", self.exceptions)
+        with self.lock:
+            state = self.table(DatabaseName, TableName, "WriteRecords")
+            rejected = []
+            rows = []
+            now = self.now_ns()
+            for index, record in enumerate(Records):
+                try:
+                    row = self.prepare(state, self.merge(CommonAttributes or {}, record), now)
+                except ValueError as err:
+                    rejected.append({"RecordIndex": index, "Reason": str(err)})
+                    continue
+                ### records of this request are applied in order, later ones see earlier ones
+                existing = state.versions.get(row[0])
+                if existing is not None:
+                    if existing[1] == row[2]:
+                        continue
+                    if row[1] <= existing[0]:
+                        rejected.append({"RecordIndex": index, "ExistingVersion": existing[0], "Reason": (
+                            "A record with version %d already exists with different measure values. "
+                            "Use a higher version to update it." % existing[0])})
+                        continue
+                state.versions[row[0]] = (row[1], row[2])
+                rows.append(row)
+            self.store(state, rows)
+            self.stats["records_written"] += len(Records) - len(rejected)
+            self.stats["records_rejected"] += len(rejected)
+
+        if rejected:
+            raise self.exceptions.RejectedRecordsException(
+                {"Error": {"Code": "RejectedRecordsException",
+                           "Message": "One or more records have been rejected. See RejectedRecords for details."},
+                 "RejectedRecords": rejected},
+                "WriteRecords")
+        accepted = len(Records) - len(rejected)
+        return {"RecordsIngested": {"Total": accepted, "MemoryStore": accepted, "MagneticStore": 0},
+                "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def merge(self, common, record):
+        merged = dict(common)
+        merged.update(record)
+        merged["Dimensions"] = list(common.get("Dimensions", [])) + list(record.get("Dimensions", []))
+        if "MeasureValues" in common and "MeasureValues" in record:
+            merged["MeasureValues"] = list(common["MeasureValues"]) + list(record["MeasureValues"])
+        return merged
+
+    def prepare(self, state, record, now):
+        ### validates one record, returns (identity, version, values) or raises ValueError with the reason
+        unit = TIME_UNITS.get(record.get("TimeUnit", "MILLISECONDS"))
+        if unit is None or "Time" not in record:
+            raise ValueError("Time and a valid TimeUnit are required.")
+        try:
+            ns = int(record["Time"]) * unit
+        except (TypeError, ValueError):
+            raise ValueError("Time %r is not a valid timestamp." % record["Time"])
+        earliest = now - state.memory_store_ns
+        latest = now + MAX_FUTURE_NS
+        if ns >= latest or (ns < earliest and not state.magnetic_store_writes):
+            raise ValueError("The record timestamp is outside the time range [%s, %s) of the memory store." % (
+                format_time(earliest), format_time(latest)))
+
+        dimensions = {}
+        for dimension in record["Dimensions"]:
+            name, value = dimension.get("Name"), dimension.get("Value")
+            if not name or not value:
+                raise ValueError("Dimensions must have a non-empty Name and Value.")
+            if name in dimensions:
+                raise ValueError("Duplicate dimension name %s." % name)
+            if state.measures.get(name):
+                raise ValueError("Dimension name %s is already used as a measure name." % name)
+            dimensions[name] = value
+
+        measure_name = record.get("MeasureName")
+        value_type = record.get("MeasureValueType", "DOUBLE")
+        if not measure_name:
+            raise ValueError("MeasureName is required.")
+        if value_type == "MULTI":
+            measures = record.get("MeasureValues") or []
+            if not measures:
+                raise ValueError("MeasureValues are required for MULTI records.")
+            values = [(measure.get("Name"), measure.get("Type"), measure.get("Value")) for measure in measures]
+        else:
+            values = [("measure_value::" + value_type.lower(), value_type, record.get("MeasureValue"))]
+
+        converted = {}
+        for name, measure_type, value in values:
+            if not name or name in converted:
+                raise ValueError("Measure names must be present and unique, got %r." % name)
+            if name in dimensions or name in state.dimensions:
+                raise ValueError("Measure name %s is already used as a dimension name." % name)
+            if measure_type not in SQLITE_TYPES:
+                raise ValueError("Measure %s has an invalid type %r." % (name, measure_type))
+            existing = state.measures.get(name)
+            if existing is not None and existing != measure_type:
+                raise ValueError("Measure %s already exists with type %s, cannot write %s." % (
+                    name, existing, measure_type))
+            converted[name] = self.convert(name, measure_type, value)
+
+        ### the new names are only added once the record is known to be valid
+        for name in dimensions:
+            if name not in state.dimensions:
+                state.dimensions.append(name)
+                self.add_column(state, name, "TEXT")
+                self.refresh_view(state)
+        for name, measure_type, _ in values:
+            if name not in state.measures:
+                state.measures[name] = measure_type
+                self.add_column(state, name, SQLITE_TYPES[measure_type])
+                self.refresh_view(state)
+
+        series = "\x1f".join("%s=%s" % item for item in sorted(dimensions.items()))
+        time_text = format_time(ns)
+        identity = (series, measure_name, time_text)
+        version = int(record.get("Version", 1))
+        row_values = tuple(sorted(dict(dimensions, **converted).items()))
+        return identity, version, row_values
+
+    def convert(self, name, measure_type, value):
+        if not isinstance(value, str):
+            raise ValueError("Measure %s value must be a string." % name)
+        try:
+            if measure_type == "DOUBLE":
+                converted = float(value)
+                if not math.isfinite(converted):
+                    raise ValueError
+                return converted
+            if measure_type == "BIGINT":
+                return int(value)
+            if measure_type == "BOOLEAN":
+                if value.lower() not in ("true", "false"):
+                    raise ValueError
+                return int(value.lower() == "true")
+            if measure_type == "TIMESTAMP":
+                return format_time(int(value) * 10 ** 6)
+        except ValueError:
+            raise ValueError("Measure %s value %r is not a valid %s." % (name, value, measure_type))
+        return value
+
+    def store(self, state, rows):
+        ### rows of the same column layout are inserted together
+        groups = {}
+        for (series, measure_name, time_text), version, values in rows:
+            columns = tuple(name for name, _ in values)
+            groups.setdefault(columns, []).append(
+                (series, measure_name, time_text, version) + tuple(value for _, value in values))
+        for columns, parameters in groups.items():
+            statement = state.insert_statements.get(columns)
+            if statement is None:
+                statement = state.insert_statements[columns] = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (
+                    quote(state.storage),
+                    ", ".join(["_series", "measure_name", "time", "_version"] + [quote(name) for name in columns]),
+                    ", ".join("?" * (len(columns) + 4)),
+                )
+            self.db.executemany(statement, parameters)
+
+    ### Query
+
+    def translate(self, sql):
+        ### rewrites Timestream SQL into SQLite SQL
+        def replace(match):
+            if match.group("string"):
+                return match.group("string")
+            if match.group("table"):
+                return quote("%s.%s" % (match.group("database"), match.group("name")))
+            if match.group("measure_value"):
+                return quote("measure_value::" + match.group("value_type").lower())
+            amount = float(match.group("amount")) * DURATION_UNITS[match.group("unit")]
+            return str(int(amount))
+
+        return QUERY_TOKENS.sub(replace, sql)
+
+    def query(self, QueryString, NextToken=None, MaxRows=None, ClientToken=None):
+        if not NextToken:
+            with self.lock:
+                self.stats["queries"] += 1
+            self.inject_faults(self.query_bucket, 1, "Query", self.query_exceptions)
+        with self.lock:
+            if NextToken:
+                if NextToken not in self.pages:
+                    raise self.query_exceptions.ValidationException(
+                        {"Error": {"Code": "ValidationException", "Message": "Invalid NextToken"}}, "Query")
+                query_id, columns, rows = self.pages.pop(NextToken)
+            else:
+                started = time.perf_counter()
+                try:
+                    cursor = self.db.execute(self.translate(QueryString))
+                    rows = cursor.fetchall()
+                except sqlite3.Error as err:
+                    raise self.query_exceptions.ValidationException(
+                        {"Error": {"Code": "ValidationException", "Message": "line 1: " + str(err)}}, "Query")
+                finally:
+                    self.stats["query_seconds"] += time.perf_counter() - started
+                query_id = uuid.uuid4().hex
+                columns = [
+                    {"Name": description[0], "Type": {"ScalarType": column_type([row[index] for row in rows])}}
+                    for index, description in enumerate(cursor.description or [])
+                ]
+
+            response = {"QueryId": query_id, "ColumnInfo": columns,
+                        "QueryStatus": {"ProgressPercentage": 100.0, "CumulativeBytesScanned": 0,
+                                        "CumulativeBytesMetered": 0}}
+            if MaxRows and len(rows) > MaxRows:
+                token = uuid.uuid4().hex
+                self.pages[token] = (query_id, columns, rows[MaxRows:])
+                response["NextToken"] = token
+                rows = rows[:MaxRows]
+            response["Rows"] = [{"Data": [scalar(value) for value in row]} for row in rows]
+            return response
+
+
+def column_type(values):
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            return "BOOLEAN"
+        if isinstance(value, int):
+            return "BIGINT"
+        if isinstance(value, float):
+            return "DOUBLE"
+        if TIME_TEXT.match(value):
+            return "TIMESTAMP"
+        return "VARCHAR"
+    return "UNKNOWN"
+
+
+def scalar(value):
+    if value is None:
+        return {"NullValue": True}
+    return {"ScalarValue": repr(value) if isinstance(value, float) else str(value)}
+
+
+def rows_as_dicts(response):
+    ### convert a Query response into a list of {column: value string or None}
+    names = [column["Name"] for column in response["ColumnInfo"]]
+    return [
+        {name: datum.get("ScalarValue") for name, datum in zip(names, row["Data"])}
+        for row in response["Rows"]
+    ]
+
+
+def iso8601(ns):
+    return format_time(ns)[:23].replace(" ", "T") + "Z"
+
+
+def expand_macros(sql, start_ns, end_ns, variables=None, interval_ms=None, database=None, table=None, measure=None):
+    ### expands the Grafana Timestream macros and dashboard variables like the data source plugin does
+    interval_ms = interval_ms or max(1, (end_ns - start_ns) // 10 ** 6 // 1000)
+    time_from = "from_iso8601_timestamp('%s')" % iso8601(start_ns)
+    time_to = "from_iso8601_timestamp('%s')" % iso8601(end_ns)
+    replacements = {
+        "$__timeFilter": "time BETWEEN %s AND %s" % (time_from, time_to),
+        "$__timeFrom": time_from,
+        "$__timeTo": time_to,
+        "$__interval_ms": str(interval_ms),
+        "$__interval": "%dms" % interval_ms,
+    }
+    if database:
+        replacements["$__database"] = database
+    if table:
+        replacements["$__table"] = table
+    if measure:
+        replacements["$__measure"] = measure
+    for name, value in (variables or {}).items():
+        replacements["${%s}" % name] = value
+        replacements["$" + name] = value
+    for name in sorted(replacements, key=len, reverse=True):
+        sql = sql.replace(name, replacements[name])
+    return sql
+
+
+def parse_relative(text):
+    ### Grafana relative time such as "1h" or "10m" in nanoseconds
+    match = re.match(r"^(\d+)([smhd])$", text.strip())
+    if not match:
+        raise ValueError("Unsupported relative time %r" % text)
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def dashboard_queries(dashboard):
+    ### yields (title, panel time override, target) for every Timestream query of a dashboard
+    for panel in dashboard["panels"]:
+        for target in panel.get("targets", []):
+            if target.get("rawQuery"):
+                yield panel.get("title", str(panel.get("id"))), panel.get("timeFrom"), target
+
+
+def load_dashboard(dashboard_path, database, rewrite=True):
+    with open(dashboard_path, encoding="utf-8") as dashboard_file:
+        text = dashboard_file.read().replace("IOT_TELEMETRY_DATABASE", database)
+    dashboard = json.loads(text)["dashboard"]
+    if rewrite:
+        ### the dashboard setup Lambda uploads the rewritten queries by default
+        sys.path.insert(0, os.path.join(EMULATOR_DIR, "..", "grafana"))
+        from dashboard_lint import rewrite_dashboard
+        dashboard = rewrite_dashboard(dashboard)
+    return dashboard
+
+
+def run_dashboard(local, dashboard_path, database, variables, range_ns, runs=3, rewrite=True):
+    ### runs every panel query of the dashboard against the stand-in, returns timings per panel
+    results = {}
+    for title, time_from, target in dashboard_queries(load_dashboard(dashboard_path, database, rewrite)):
+        end = local.now_ns()
+        start = end - (parse_relative(time_from) if time_from else range_ns)
+        sql = expand_macros(target["rawQuery"], start, end, variables)
+        timings = []
+        result = {}
+        for _ in range(runs):
+            started = time.perf_counter()
+            try:
+                response = local.query(QueryString=sql)
+            except Exception as err:
+                result = {"error": str(err)}
+                break
+            timings.append((time.perf_counter() - started) * 1000)
+            result = {"rows": len(response["Rows"])}
+        if timings:
+            result["ms"] = round(min(timings), 3)
+        results["%s (%s)" % (title, target.get("refId", "A"))] = result
+    return results
+
+
+def configure_handler_environment(database):
+    ### every derived table is enabled so all dashboard panels have data, no AWS credentials are needed
+    os.environ.setdefault("TimestreamDatabase", database)
+    os.environ.setdefault("TimestreamTable", "device-telemetry")
+    os.environ.setdefault("RollupTable", "device-telemetry-rollup")
+    os.environ.setdefault("StateTable", "device-state")
+    os.environ.setdefault("HealthTable", "device-health")
+    os.environ.setdefault("GeoTileTable", "device-geo-tiles")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_REGION", os.environ["AWS_DEFAULT_REGION"])
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "local")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "local")
+
+
+def load_ingestion_handler(local):
+    ### the telemetry Lambda handler module with every TimestreamWriter writing to local
+    sys.path.insert(0, os.path.join(EMULATOR_DIR, "..", "simulator"))
+    from telemetry_generator import load_handler_module
+
+    with contextlib.redirect_stdout(sys.stderr):
+        return load_handler_module(os.path.join(LAMBDA_DIR, "process-telemetry-data.py"), write_client=local)
+
+
+def ingest(module, generator, count, batch_size, flush=False):
+    ### invokes the handler with count generated messages, returns the number of failed items
+    ### flush writes the rollups and tiles that are still open
+    from telemetry_generator import LocalContext
+
+    failed = 0
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for batch in generator.iter_batches(count, batch_size):
+            response = module.lambda_handler(batch, LocalContext()) or {}
+            failed += len(response.get("batchItemFailures", []))
+        if flush:
+            if module.rollup_aggregator is not None:
+                module.rollup_writer.write(module.add_tenant_dimension(module.rollup_aggregator.flush(force=True)))
+            if module.tile_aggregator is not None:
+                module.tile_writer.write(module.tile_aggregator.flush(force=True))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ingestion Lambda and dashboard queries against a local Timestream")
+    parser.add_argument("--count", type=int, default=100000, help="generated telemetry messages")
+    parser.add_argument("--devices", type=int, default=1000, help="simulated devices")
+    parser.add_argument("--batch-size", type=int, default=500, help="messages per handler invocation")
+    parser.add_argument("--rate", type=float, default=1000.0, help="simulated messages per second")
+    parser.add_argument("--database", default="local")
+    parser.add_argument("--path", default=":memory:", help="SQLite database file")
+    parser.add_argument("--write-rate", type=float, default=None, help="records per second before throttling")
+    parser.add_argument("--query-rate", type=float, default=None, help="queries per second before throttling")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency added to every call")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with InternalServerException")
+    parser.add_argument("--dashboard", default=DASHBOARD_PATH)
+    parser.add_argument("--range", default="1h", help="dashboard time range for panels without a time override")
+    parser.add_argument("--runs", type=int, default=3, help="runs per dashboard query, the fastest is reported")
+    parser.add_argument("--no-rewrite", action="store_true", help="run the dashboard queries as committed, without lint rewrites")
+    parser.add_argument("--output", default="-", help="results JSON file, - for stdout")
+    args = parser.parse_args()
+
+    configure_handler_environment(args.database)
+    local = LocalTimestream(args.path, write_rate=args.write_rate, query_rate=args.query_rate,
+                            latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms,
+                            error_rate=args.error_rate)
+    module = load_ingestion_handler(local)
+
+    ### generated timestamps end now, so every message is inside the memory store window
+    from telemetry_generator import TelemetryGenerator, history_start_ms, load_schema
+
+    generator = TelemetryGenerator(load_schema(), device_count=args.devices, rate=args.rate,
+                                   start_time_ms=history_start_ms(args.count, args.rate), seed=7)
+    started = time.perf_counter()
+    failed = ingest(module, generator, args.count, args.batch_size, flush=True)
+    ingest_seconds = time.perf_counter() - started
+
+    variables = {"deviceid": str(generator.device_ids[0]), "tileprecision": "3"}
+    dashboard = run_dashboard(local, args.dashboard, args.database, variables, parse_relative(args.range), args.runs,
+                              not args.no_rewrite)
+    results = {
+        "ingest": {
+            "messages": args.count,
+            "seconds": round(ingest_seconds, 3),
+            "messages_per_second": round(args.count / ingest_seconds, 1),
+            "failed_items": failed,
+        },
+        "timestream": dict(local.stats, query_seconds=round(local.stats["query_seconds"], 3)),
+        "dashboard": dashboard,
+    }
+    for title, result in results["dashboard"].items():
+        print("%-55s %s" % (title, json.dumps(result)), file=sys.stderr)
+
+    if args.output == "-":
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+# Lints and rewrites the Timestream queries in a Grafana dashboard before it is uploaded.
+# Runs from dashboard_setup.py and standalone in CI:
+#   python dashboard_lint.py grafana_dashboard.json --strict
+#   python dashboard_lint.py grafana_dashboard.json --rewrite grafana_dashboard.json
+
+import argparse
+import copy
+import json
+import re
+import sys
+
+# panel types that show a single value, their queries only need the latest row
+SINGLE_VALUE_PANELS = {"gauge", "stat", "bargauge"}
+
+# row limit added to queries that have none
+DEFAULT_LIMIT = 10000
+
+# dashboard variable that scopes a dashboard to one customer, see tenant_dashboards.py
+TENANT_VARIABLE = "customerid"
+
+# scan cost classes from cheapest to most expensive
+COST_CLASSES = ["low", "medium", "high", "very-high", "full-table"]
+
+CLAUSE_KEYWORDS = ["where", "group by", "order by", "limit"]
+AGGREGATE_PATTERN = re.compile(r"\b(avg|sum|min|max|count|max_by|min_by|approx_percentile|bin)\s*\(", re.I)
+AGO_PATTERN = re.compile(r"\bago\s*\(\s*(\d+)\s*([smhd])\s*\)", re.I)
+TIME_RANGE_PATTERN = re.compile(
+    r"\btime\s+between\s+ago\s*\(\s*(\d+\s*[smhd])\s*\)\s+and\s+now\s*\(\s*\)|\btime\s*>=?\s*ago\s*\(\s*(\d+\s*[smhd])\s*\)",
+    re.I,
+)
+SELECT_STAR_PATTERN = re.compile(r"^\s*select\s+(\*\s*,?\s*)", re.I)
+SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+# blank out string literals and quoted identifiers so keyword searches only see SQL structure
+def mask_literals(sql):
+    return re.sub(r"'[^']*'|\"[^\"]*\"", lambda m: " " * len(m.group(0)), sql)
+
+
+# blank out string literals only
+def mask_strings(sql):
+    return re.sub(r"'[^']*'", lambda m: " " * len(m.group(0)), sql)
+
+
+# return the position of each top level clause keyword, or None when the clause is absent
+def find_clauses(sql):
+    masked = mask_literals(sql)
+    depth = 0
+    top_level = []
+    for char in masked:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        top_level.append(char if depth == 0 and char != ")" else " ")
+    flat = "".join(top_level).lower()
+    positions = {}
+    for keyword in CLAUSE_KEYWORDS:
+        match = re.search(r"\b" + keyword.replace(" ", r"\s+") + r"\b", flat)
+        positions[keyword] = match.start() if match else None
+    return positions
+
+
+def clause_text(sql, clauses, keyword):
+    start = clauses[keyword]
+    if start is None:
+        return ""
+    ends = [position for position in clauses.values() if position is not None and position > start]
+    return sql[start:min(ends) if ends else len(sql)]
+
+
+# queries selecting from a subquery scan the table through it, returns the query whose WHERE bounds the scan
+def scan_query(sql):
+    masked = mask_literals(sql)
+    depth = 0
+    for match in re.finditer(r"\bfrom\s*\(|[()]", masked, re.I):
+        token = match.group(0)
+        if token == ")":
+            depth -= 1
+        elif token == "(" or depth > 0:
+            depth += 1
+        else:
+            start = position = match.end()
+            depth = 1
+            while depth and position < len(masked):
+                if masked[position] == "(":
+                    depth += 1
+                elif masked[position] == ")":
+                    depth -= 1
+                position += 1
+            return scan_query(sql[start:position - 1])
+    return sql
+
+
+def span_seconds(sql):
+    # longest ago(...) window referenced by the query, None when there is none
+    spans = [int(amount) * SECONDS[unit.lower()] for amount, unit in AGO_PATTERN.findall(mask_strings(sql))]
+    return max(spans) if spans else None
+
+
+# estimate the scan cost class of a query from its time window and device filter
+def estimate_cost(sql):
+    scan = scan_query(sql)
+    where = clause_text(scan, find_clauses(scan), "where").lower()
+    if not where or ("$__timefilter" not in where and "time" not in where):
+        return "full-table"
+
+    if "$__timefilter" in where:
+        cost = COST_CLASSES.index("low")
+    else:
+        span = span_seconds(where) or 0
+        if span <= 3600:
+            cost = 0
+        elif span <= 86400:
+            cost = 1
+        elif span <= 7 * 86400:
+            cost = 2
+        else:
+            cost = 3
+
+    # a single device filter prunes most of the fleet's rows
+    if re.search(r"\bdeviceid\s*=", where):
+        cost = max(0, cost - 1)
+    return COST_CLASSES[cost]
+
+
+def finding(rule, severity, message, location, cost, fixable):
+    return {
+        "rule": rule,
+        "severity": severity,
+        "message": message,
+        "location": location,
+        "cost": cost,
+        "fixable": fixable,
+    }
+
+
+def has_tenant_filter(scan, tenant_variable):
+    where = clause_text(scan, find_clauses(scan), "where")
+    return bool(re.search(r"\b%s\s*=" % re.escape(tenant_variable), mask_strings(where), re.I))
+
+
+# lint one query, has_device_variable tells whether the dashboard defines $deviceid
+# tenant_variable is the tenant variable when the dashboard defines one
+def lint_query(sql, location, panel_type=None, has_device_variable=False, is_variable=False, tenant_variable=None):
+    findings = []
+    clauses = find_clauses(sql)
+    scan = scan_query(sql)
+    where = clause_text(scan, find_clauses(scan), "where").lower()
+    cost = estimate_cost(sql)
+    aggregated = bool(AGGREGATE_PATTERN.search(mask_literals(sql))) or clauses["group by"] is not None
+
+    star = SELECT_STAR_PATTERN.match(sql)
+    if star:
+        # only "SELECT *, ..." can be rewritten, a bare "SELECT *" needs its columns picked by hand
+        findings.append(finding("SELECT_STAR", "warning", "SELECT * reads every measure column",
+                                location, cost, star.group(1).strip().endswith(",")))
+
+    if cost == "full-table":
+        findings.append(finding("UNBOUNDED_SCAN", "error", "query has no time predicate and scans the whole table",
+                                location, cost, True))
+    elif not is_variable and "$__timefilter" not in where:
+        findings.append(finding("MISSING_TIME_FILTER", "warning",
+                                "query uses a fixed time range instead of $__timeFilter", location, cost, True))
+
+    # tenant dashboards must not read other customers' partitions
+    if tenant_variable and not has_tenant_filter(scan, tenant_variable):
+        findings.append(finding("MISSING_TENANT_FILTER", "error",
+                                "query reads every customer instead of $%s" % tenant_variable, location, cost, True))
+
+    if not is_variable and has_device_variable and panel_type in SINGLE_VALUE_PANELS \
+            and not re.search(r"\bdeviceid\b", mask_literals(sql), re.I):
+        findings.append(finding("MISSING_DEVICE_FILTER", "warning",
+                                "single value panel reads every device instead of $deviceid", location, cost, True))
+
+    if not is_variable and clauses["limit"] is None and not aggregated:
+        findings.append(finding("MISSING_LIMIT", "warning", "query has no LIMIT", location, cost, True))
+
+    return findings
+
+
+def add_where_condition(sql, condition):
+    clauses = find_clauses(sql)
+    if clauses["where"] is not None:
+        end = clauses["where"] + len(re.match(r"where\s+", sql[clauses["where"]:], re.I).group(0))
+        return sql[:end] + condition + " and " + sql[end:]
+    following = [clauses[k] for k in ("group by", "order by", "limit") if clauses[k] is not None]
+    position = min(following) if following else len(sql.rstrip())
+    return sql[:position].rstrip() + " \nWHERE " + condition + " \n" + sql[position:].lstrip()
+
+
+# rewrite a query into a bounded form, returns (sql, panel time override or None)
+def rewrite_query(sql, panel_type=None, has_device_variable=False, is_variable=False, limit=DEFAULT_LIMIT,
+                  star_columns="time, deviceid", tenant_variable=None):
+    time_from = None
+
+    # the tenant filter goes on the query that scans the table, so Timestream prunes to the tenant's partition
+    scan = scan_query(sql)
+    if tenant_variable and not has_tenant_filter(scan, tenant_variable):
+        sql = sql.replace(scan, add_where_condition(scan, "%s = '$%s'" % (tenant_variable, tenant_variable)), 1)
+
+    match = SELECT_STAR_PATTERN.match(sql)
+    if match and match.group(1).strip().endswith(","):
+        sql = sql[:match.start(1)] + star_columns + ", " + sql[match.end(1):]
+
+    if is_variable:
+        if estimate_cost(sql) == "full-table":
+            sql = add_where_condition(sql, "time > ago(1d)")
+        return sql, None
+
+    # a fixed ago() window becomes $__timeFilter with a matching panel relative time
+    range_match = TIME_RANGE_PATTERN.search(sql)
+    if range_match:
+        time_from = re.sub(r"\s+", "", range_match.group(1) or range_match.group(2))
+        sql = sql[:range_match.start()] + "$__timeFilter" + sql[range_match.end():]
+    else:
+        scan = scan_query(sql)
+        if "$__timefilter" not in clause_text(scan, find_clauses(scan), "where").lower():
+            sql = sql.replace(scan, add_where_condition(scan, "$__timeFilter"), 1)
+
+    if has_device_variable and panel_type in SINGLE_VALUE_PANELS \
+            and not re.search(r"\bdeviceid\b", mask_literals(sql), re.I):
+        sql = add_where_condition(sql, "deviceid = '$deviceid'")
+
+    clauses = find_clauses(sql)
+    aggregated = bool(AGGREGATE_PATTERN.search(mask_literals(sql))) or clauses["group by"] is not None
+    if clauses["limit"] is None and not aggregated:
+        if panel_type in SINGLE_VALUE_PANELS:
+            # single value panels show the latest row
+            if clauses["order by"] is None:
+                sql = sql.rstrip() + " \nORDER BY time DESC"
+            sql = sql.rstrip() + " \nLIMIT 1"
+        else:
+            sql = sql.rstrip() + " \nLIMIT %d" % limit
+
+    return sql, time_from
+
+
+def iter_queries(dashboard):
+    # yields (location, owner dict, key, panel type, is variable) for every Timestream query
+    for panel in dashboard.get("panels", []):
+        for target in panel.get("targets", []):
+            if target.get("rawQuery"):
+                yield "panel '%s' (%s)" % (panel.get("title"), target.get("refId")), panel, target, "rawQuery", False
+    for variable in dashboard.get("templating", {}).get("list", []):
+        if variable.get("type") == "query":
+            for key in ("query", "definition"):
+                if isinstance(variable.get(key), str) and variable[key]:
+                    yield "variable '%s' %s" % (variable.get("name"), key), None, variable, key, True
+
+
+def has_variable(dashboard, name):
+    return any(variable.get("name") == name for variable in dashboard.get("templating", {}).get("list", []))
+
+
+def tenant_variable_of(dashboard, tenant_variable=TENANT_VARIABLE):
+    return tenant_variable if has_variable(dashboard, tenant_variable) else None
+
+
+# lint a dashboard (the object under "dashboard" in grafana_dashboard.json)
+def lint_dashboard(dashboard, tenant_variable=TENANT_VARIABLE):
+    findings = []
+    device_variable = has_variable(dashboard, "deviceid")
+    tenant_variable = tenant_variable_of(dashboard, tenant_variable)
+    for location, panel, owner, key, is_variable in iter_queries(dashboard):
+        if is_variable and key == "definition":
+            continue
+        findings.extend(lint_query(owner[key], location, panel and panel.get("type"), device_variable, is_variable,
+                                   tenant_variable))
+    return findings
+
+
+# return a copy of the dashboard with every fixable finding rewritten
+def rewrite_dashboard(dashboard, limit=DEFAULT_LIMIT, tenant_variable=TENANT_VARIABLE):
+    dashboard = copy.deepcopy(dashboard)
+    device_variable = has_variable(dashboard, "deviceid")
+    tenant_variable = tenant_variable_of(dashboard, tenant_variable)
+    for location, panel, owner, key, is_variable in iter_queries(dashboard):
+        sql, time_from = rewrite_query(owner[key], panel and panel.get("type"), device_variable, is_variable, limit,
+                                       tenant_variable=tenant_variable)
+        owner[key] = sql
+        if time_from and panel is not None and not panel.get("timeFrom"):
+            panel["timeFrom"] = time_from
+    return dashboard
+
+
+def format_findings(findings):
+    return "\n".join(
+        "%-7s %-22s cost=%-10s %s: %s%s" % (
+            item["severity"], item["rule"], item["cost"], item["location"], item["message"],
+            "" if item["fixable"] else " (manual fix needed)")
+        for item in findings
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lint and rewrite Timestream queries in a Grafana dashboard")
+    parser.add_argument("dashboard", help="dashboard JSON, either the dashboard or a {\"dashboard\": ...} payload")
+    parser.add_argument("--rewrite", metavar="OUTPUT", help="write a rewritten dashboard to OUTPUT")
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT, help="LIMIT added to unbounded queries")
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    parser.add_argument("--strict", action="store_true", help="exit with status 1 when there are findings")
+    args = parser.parse_args()
+
+    with open(args.dashboard, encoding="utf-8") as f:
+        document = json.load(f)
+    dashboard = document.get("dashboard", document)
+
+    findings = lint_dashboard(dashboard)
+    if args.format == "json":
+        print(json.dumps(findings, indent=2))
+    elif findings:
+        print(format_findings(findings))
+
+    if args.rewrite:
+        rewritten = rewrite_dashboard(dashboard, args.limit)
+        if "dashboard" in document:
+            document = dict(document, dashboard=rewritten)
+        else:
+            document = rewritten
+        with open(args.rewrite, "w", encoding="utf-8") as f:
+            json.dump(document, f, indent=3)
+        remaining = lint_dashboard(rewritten)
+        print("%d findings, %d remaining after rewrite" % (len(findings), len(remaining)), file=sys.stderr)
+        findings = remaining
+
+    if args.strict and findings:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,56 +17,141 @@
 #################################################################################################
 
 import boto3
+import hashlib
 import json
 import os
+import re
 import urllib3
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from dashboard_lint import format_findings, lint_dashboard, rewrite_dashboard
+from tenant_dashboards import load_customers, scope_dashboard, tenant_dashboard
 
 # get runtime region
 runtime_region = os.environ['AWS_REGION']
 
+# dashboards provisioned into the workspace, each is linted and uploaded in parallel
+DASHBOARD_FILES = ['grafana_dashboard.json']
+
+# upper bound on concurrent grafana api calls
+MAX_PARALLEL_REQUESTS = 8
+
+# folder the per customer dashboards of the multi-tenant mode are created in
+TENANT_FOLDER_TITLE = 'Customer dashboards'
+
 # create grafana api key with boto
 # returns API key
-def create_grafana_api_key(workspace_id):
+def create_grafana_api_key(workspace_id, seconds_to_live=600):
     grafana = boto3.client('grafana')
 
     response = grafana.create_workspace_api_key(
         keyName='admin_key' + str(uuid.uuid4()),
         keyRole='ADMIN',
-        secondsToLive=600, # 10 minutes
+        secondsToLive=seconds_to_live, # 10 minutes unless provisioning runs longer
         workspaceId=workspace_id
     )
 
     return response['key']
 
 
-# create timestream data source in grafana
+# grafana api base url, GrafanaUrl overrides it e.g. to point at a local fake grafana server
+def grafana_url(workspace_id):
+    return os.environ.get('GrafanaUrl', f"https://{workspace_id}.grafana-workspace.{runtime_region}.amazonaws.com")
+
+
+# one connection pool shared by all requests, with timeouts and retries on throttling and server errors
+def create_http(api_key):
+    headers = {
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+        "Authorization": "Bearer " + api_key
+        }
+
+    retries = urllib3.Retry(
+        total=4,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False
+    )
+
+    return urllib3.PoolManager(
+        headers=headers,
+        retries=retries,
+        timeout=urllib3.Timeout(connect=3.0, read=10.0),
+        maxsize=MAX_PARALLEL_REQUESTS
+    )
+
+
+# send a request and decode the json response
+# returns (status, data)
+def request_json(http, method, url, payload=None):
+    body = json.dumps(payload) if payload is not None else None
+    result = http.request(method, url, body=body)
+    try:
+        data = json.loads(result.data.decode('utf-8'))
+    except ValueError:
+        data = None
+    return result.status, data
+
+
+# raise when grafana did not accept a create or update request
+def check_response(status, data, action):
+    if not 200 <= status < 300:
+        raise RuntimeError(f"{action} failed with status {status}: {data}")
+
+
+# stable hash of the content we provision, stored on the grafana object to detect changes
+def content_hash(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# uids derived from the content identity so objects can be fetched directly instead of listed
+def stable_uid(prefix, *parts):
+    return prefix + hashlib.sha1('/'.join(parts).encode('utf-8')).hexdigest()[:20]
+
+
+# header the query cache function reads its token from, see resources/lambda/query_cache
+QUERY_CACHE_TOKEN_HEADER = 'x-query-cache-token'
+
+# endpoint of the optional query cache function url and its token
+# returns (None, None) when the stack was deployed without the query cache
+def query_cache_endpoint():
+    endpoint = os.environ.get('QueryCacheEndpoint')
+    if not endpoint:
+        return None, None
+
+    secrets = boto3.client('secretsmanager')
+    token = secrets.get_secret_value(SecretId=os.environ['QueryCacheTokenSecret'])['SecretString']
+    return endpoint.rstrip('/'), token
+
+
+# install the timestream plugin unless it is already installed
+def ensure_timestream_plugin(base_url, http):
+    status, _ = request_json(http, 'GET', f"{base_url}/api/plugins/grafana-timestream-datasource/settings")
+    if status == 200:
+        return
+
+    status, data = request_json(http, 'POST', f"{base_url}/api/plugins/grafana-timestream-datasource/install", {})
+    print('plugin installed', status)
+    check_response(status, data, 'timestream plugin install')
+
+
+# create or update the timestream data source in grafana
+# raises when grafana rejects the create or update, dashboards would otherwise point at a stale data source
 # returns data souce uid
 def create_timestream_data_source(workspace_id, http):
 
     database_name = os.environ['TimestreamDatabase']
     table_name = os.environ['TimestreamTable']
-    
-    # check if data source already exists
-    api_url = f"https://{workspace_id}.grafana-workspace.{runtime_region}.amazonaws.com/api/datasources"
-    result = http.request('GET', api_url)
-    data = json.loads(result.data.decode('utf-8'))
-
-    # if data source already exists, return uid
-    for item in data:
-        if item['database'] == '"'+database_name+'"':
-            return item['uid']
-
-    # make sure to load the plugin
-    plugin_api_url = f"https://{workspace_id}.grafana-workspace.{runtime_region}.amazonaws.com/api/plugins/grafana-timestream-datasource/install"
-    install_result = http.request('POST', plugin_api_url, body={})
-    print(install_result.data.decode('utf-8'))
-
-    # otherwise, create data source
-    api_url = f"https://{workspace_id}.grafana-workspace.{runtime_region}.amazonaws.com/api/datasources"
+    base_url = grafana_url(workspace_id)
+
+    uid = stable_uid('timestream-', runtime_region, database_name)
     payload = {
+        "uid": uid,
         "orgId": 1,
-        "name": "Amazon Timestream "+runtime_region  + str(uuid.uuid4()),
+        "name": "Amazon Timestream " + runtime_region + " " + database_name,
         "type": "grafana-timestream-datasource",
         "typeName": "Amazon Timestream",
         "typeLogoUrl": "public/plugins/grafana-timestream-datasource/img/timestream.svg",
@@ -84,38 +169,305 @@ def create_timestream_data_source(workspace_id, http):
             "defaultTable": table_name
         },
         "readOnly": False
-    } 
+    }
 
-    result = http.request('POST', api_url, body=json.dumps(payload))
-    
-    return json.loads(result.data.decode('utf-8'))['datasource']['uid']
+    endpoint, token = query_cache_endpoint()
+    if not endpoint:
+        return apply_data_source(base_url, http, payload)
 
-# create timestream dashboard in grafana
-def create_timestream_dashboard(workspace_id, http, datasource_uid):
+    # dashboards query through the query cache when it is deployed, the token is sent as a custom header
+    # kept in secureJsonData, which grafana encrypts and never returns through its api
+    cached = json.loads(json.dumps(payload))
+    cached['jsonData']['endpoint'] = endpoint
+    cached['jsonData']['httpHeaderName1'] = QUERY_CACHE_TOKEN_HEADER
+    cached['secureJsonData'] = {'httpHeaderValue1': token}
+    uid = apply_data_source(base_url, http, cached)
 
-    # search for grafana dashboard matching name
-    api_url = f"https://{workspace_id}.grafana-workspace.{runtime_region}.amazonaws.com/api/search?tag={datasource_uid}"
-    result = http.request('GET', api_url)
-    data = json.loads(result.data.decode('utf-8'))
-    
-    # if dashboard already exists, return url
-    for item in data:
-        if item['title'] == "IoT Device Dashboard":
-            return item['url']
+    # the cache denies requests without the token, so a plugin version that does not send custom headers
+    # would fail every panel. Query through the data source once and query timestream directly otherwise
+    ok, detail = query_through_data_source(base_url, http, uid, database_name, table_name)
+    if ok:
+        return uid
+    print('Error: the query cache rejected a query through the data source, dashboards query timestream directly.'
+          ' The timestream plugin must send the data source custom http headers:', detail)
+    return apply_data_source(base_url, http, payload)
+
+
+# run one query through the data source plugin
+# returns (True, None) when it succeeded, (False, error) otherwise
+def query_through_data_source(base_url, http, uid, database_name, table_name):
+    query = {
+        "refId": "A",
+        "datasource": {"type": "grafana-timestream-datasource", "uid": uid},
+        "rawQuery": f'SELECT time FROM "{database_name}"."{table_name}" WHERE time > ago(1m) LIMIT 1',
+        "format": 0
+    }
+    status, data = request_json(http, 'POST', f"{base_url}/api/ds/query",
+                                {"queries": [query], "from": "now-1m", "to": "now"})
+    result = ((data or {}).get('results') or {}).get('A') or {}
+    if status != 200 or result.get('error'):
+        return False, result.get('error') or data
+    return True, None
+
+
+# create the data source or update it when the payload changed
+# returns data souce uid
+def apply_data_source(base_url, http, payload):
+    uid = payload['uid']
+    database_name = payload['database']
+    payload_hash = content_hash(payload)
+    payload['jsonData']['provisioningHash'] = payload_hash
+
+    # look the data source up by its uid
+    status, existing = request_json(http, 'GET', f"{base_url}/api/datasources/uid/{uid}")
+
+    if status == 404:
+        # data sources created by earlier versions have random uids, adopt a matching one once
+        _, data = request_json(http, 'GET', f"{base_url}/api/datasources")
+        for item in data or []:
+            if item.get('database') in (database_name, '"'+database_name+'"'):
+                existing = item
+                status = 200
+                break
+
+    if status == 200:
+        if existing.get('jsonData', {}).get('provisioningHash') == payload_hash:
+            print('data source unchanged', existing['uid'])
+            return existing['uid']
+
+        # update in place, keeping the uid and name grafana already knows
+        payload['uid'] = existing['uid']
+        payload['name'] = existing.get('name', payload['name'])
+        status, data = request_json(http, 'PUT', f"{base_url}/api/datasources/uid/{existing['uid']}", payload)
+        print('data source updated', status)
+        check_response(status, data, 'data source update')
+        return existing['uid']
 
-    api_url = f"https://{workspace_id}.grafana-workspace.{runtime_region}.amazonaws.com/api/dashboards/db"
+    # make sure the plugin is installed before creating the data source
+    ensure_timestream_plugin(base_url, http)
+    status, data = request_json(http, 'POST', f"{base_url}/api/datasources", payload)
+    print('data source created', status)
+    check_response(status, data, 'data source create')
+
+    return data['datasource']['uid']
+
+# lint dashboard queries before upload
+# DashboardLint selects the mode: "rewrite" (default) fixes unbounded queries, "report" only logs findings
+# and "strict" fails the deployment when findings remain after rewriting
+def lint_before_upload(dashboard):
+    mode = os.environ.get('DashboardLint', 'rewrite')
+
+    findings = lint_dashboard(dashboard)
+    if findings:
+        print(format_findings(findings))
+    if mode == 'report':
+        return dashboard
+
+    dashboard = rewrite_dashboard(dashboard)
+    remaining = lint_dashboard(dashboard)
+    if remaining and mode == 'strict':
+        raise ValueError('dashboard queries failed lint:\n' + format_findings(remaining))
+    return dashboard
+
+# timestream tables a query reads from the telemetry database
+def query_tables(query, database_name):
+    return re.findall(r'"%s"\s*\.\s*"([^"]+)"' % re.escape(database_name), query or '')
+
+# optional tables whose panels read the telemetry table when they are not deployed, device-state rows
+# carry the telemetry measures under the same names so only the cost of the queries changes
+TELEMETRY_FALLBACK_TABLES = ('device-state',)
+
+# point every query and target of the dashboard at the telemetry table instead of the given tables
+def read_telemetry_instead(value, database_name, tables, telemetry_table):
+    if isinstance(value, dict):
+        return {key: read_telemetry_instead(item, database_name, tables, telemetry_table) for key, item in value.items()}
+    if isinstance(value, list):
+        return [read_telemetry_instead(item, database_name, tables, telemetry_table) for item in value]
+    if not isinstance(value, str):
+        return value
+    for table in tables:
+        if value == '"%s"' % table:
+            return '"%s"' % telemetry_table
+        value = re.sub(r'"%s"\s*\.\s*"%s"' % (re.escape(database_name), re.escape(table)),
+                       '"%s"."%s"' % (database_name, telemetry_table), value)
+    return value
+
+# drop the panels that read timestream tables the stack did not deploy, e.g. the rollup table without
+# -c rollups=true. TimestreamTables lists the deployed tables as json, all panels are kept without it
+def select_deployed_panels(dashboard, database_name):
+    tables = os.environ.get('TimestreamTables')
+    if not tables:
+        return dashboard
+    deployed = set(json.loads(tables))
+
+    fallback = [table for table in TELEMETRY_FALLBACK_TABLES if table not in deployed]
+    if fallback:
+        print('queries read the telemetry table instead of:', ', '.join(fallback))
+        dashboard = read_telemetry_instead(dashboard, database_name, fallback, os.environ['TimestreamTable'])
+
+    def deployed_panel(panel):
+        return all(table in deployed
+                   for target in panel.get('targets', [])
+                   for table in query_tables(target.get('rawQuery'), database_name))
+
+    def select(panels):
+        kept = []
+        for panel in panels:
+            if not deployed_panel(panel):
+                print('panel dropped, its table is not deployed:', panel.get('title'))
+                continue
+            if 'panels' in panel:
+                panel['panels'] = select(panel['panels'])
+            kept.append(panel)
+        return kept
+
+    dashboard['panels'] = select(dashboard.get('panels', []))
+    return dashboard
+
+# build the dashboard payload from a dashboard file
+def load_dashboard(dashboard_file, datasource_uid):
 
     database_name = os.environ['TimestreamDatabase']
 
-    with open(f'grafana_dashboard.json', encoding='utf-8') as f:
+    with open(dashboard_file, encoding='utf-8') as f:
         data = f.read()
         data = data.replace('DATASOURCE_UID', datasource_uid)
         data = data.replace('IOT_TELEMETRY_DATABASE', database_name)
         payload = json.loads(data)
-    
-    result = http.request('POST', api_url, body=json.dumps(payload))
 
-    return json.loads(result.data.decode('utf-8'))['url']
+    payload['dashboard'] = select_deployed_panels(payload['dashboard'], database_name)
+    payload['dashboard'] = lint_before_upload(payload['dashboard'])
+    return payload
+
+# create or update a dashboard payload in grafana
+# unchanged dashboards are skipped, changed dashboards are updated in place
+# adopt_tag looks up a dashboard with the same title and tag when the uid is not found
+# returns dashboard url
+def upload_dashboard(base_url, http, payload, adopt_tag=None):
+
+    dashboard = payload['dashboard']
+    dashboard_hash = content_hash(dashboard)
+
+    status, existing = request_json(http, 'GET', f"{base_url}/api/dashboards/uid/{dashboard['uid']}")
+
+    if status == 404 and adopt_tag:
+        # dashboards created by earlier versions have random uids, adopt the one with the same title
+        _, data = request_json(http, 'GET', f"{base_url}/api/search?tag={adopt_tag}")
+        for item in data or []:
+            if item.get('title') == dashboard['title']:
+                dashboard['uid'] = item['uid']
+                break
+
+    elif status == 200 and existing['dashboard'].get('provisioningHash') == dashboard_hash:
+        print('dashboard unchanged', dashboard['title'])
+        return existing['meta']['url']
+
+    dashboard['provisioningHash'] = dashboard_hash
+    payload['overwrite'] = True
+    status, data = request_json(http, 'POST', f"{base_url}/api/dashboards/db", payload)
+    print('dashboard provisioned', dashboard['title'], status)
+    check_response(status, data, f"dashboard {dashboard['title']}")
+
+    return data['url']
+
+# create or update a timestream dashboard in grafana
+# returns dashboard url
+def create_timestream_dashboard(workspace_id, http, datasource_uid, dashboard_file='grafana_dashboard.json'):
+
+    payload = load_dashboard(dashboard_file, datasource_uid)
+    dashboard = payload['dashboard']
+    dashboard.pop('id', None)
+    dashboard['uid'] = dashboard.get('uid') or stable_uid('iot-', dashboard_file, datasource_uid)
+
+    return upload_dashboard(grafana_url(workspace_id), http, payload, adopt_tag=datasource_uid)
+
+# provision all dashboards in parallel
+# returns dashboard urls in the order of dashboard_files
+def provision_dashboards(workspace_id, http, datasource_uid, dashboard_files=DASHBOARD_FILES):
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+        futures = [
+            executor.submit(create_timestream_dashboard, workspace_id, http, datasource_uid, dashboard_file)
+            for dashboard_file in dashboard_files
+        ]
+        return [future.result() for future in futures]
+
+# customers to provision dashboards for, read from the device metadata table when the stack uses one
+# and otherwise from the device-meta.json packaged with this function
+def list_customers(dimension):
+    table_name = os.environ.get('DeviceMetadataTable')
+    if not table_name:
+        return load_customers(os.environ.get('DeviceMetadataFile', 'device-meta.json'), dimension)
+
+    customers = set()
+    paginator = boto3.client('dynamodb').get_paginator('scan')
+    pages = paginator.paginate(TableName=table_name, ProjectionExpression='#c',
+                               ExpressionAttributeNames={'#c': dimension})
+    for page in pages:
+        for item in page['Items']:
+            value = item.get(dimension, {})
+            value = value.get('S', value.get('N'))
+            if value not in (None, ''):
+                customers.add(value)
+    return sorted(customers)
+
+# create the folder of the customer dashboards unless it exists, and restrict it to admins. Grafana
+# gives every viewer and editor of the org access to a new folder, which would show each customer
+# the dashboards of all the others. Access to a customer's dashboard is granted per dashboard.
+# returns folder uid
+def ensure_tenant_folder(base_url, http, datasource_uid):
+    uid = stable_uid('tenants-', datasource_uid)
+    status, _ = request_json(http, 'GET', f"{base_url}/api/folders/{uid}")
+    if status != 200:
+        status, data = request_json(http, 'POST', f"{base_url}/api/folders", {"uid": uid, "title": TENANT_FOLDER_TITLE})
+        print('folder created', status)
+        check_response(status, data, 'tenant folder create')
+
+    status, data = request_json(http, 'GET', f"{base_url}/api/folders/{uid}/permissions")
+    check_response(status, data, 'tenant folder permissions read')
+    if any(item.get('role') != 'Admin' for item in data or []):
+        status, data = request_json(http, 'POST', f"{base_url}/api/folders/{uid}/permissions", {"items": []})
+        print('folder restricted to admins', status)
+        check_response(status, data, 'tenant folder permissions update')
+    return uid
+
+# provision one dashboard per customer in the multi-tenant mode
+# the template is linted and scoped to $<dimension> once, customer dashboards are built as they are uploaded,
+# so memory stays flat with thousands of customers and unchanged dashboards cost one GET
+# returns the number of customer dashboards
+def provision_tenant_dashboards(workspace_id, http, datasource_uid, dimension, dashboard_file='grafana_dashboard.json'):
+
+    base_url = grafana_url(workspace_id)
+    template = load_dashboard(dashboard_file, datasource_uid)
+    template['dashboard'].pop('id', None)
+    template['dashboard']['uid'] = template['dashboard'].get('uid') or stable_uid('iot-', dashboard_file, datasource_uid)
+    scoped = scope_dashboard(template['dashboard'], dimension)
+
+    # a customer dashboard reading other customers' data must never be uploaded
+    findings = [item for item in lint_dashboard(scoped, dimension) if item['severity'] == 'error']
+    if findings:
+        raise ValueError('customer dashboard queries failed lint:\n' + format_findings(findings))
+
+    folder_uid = ensure_tenant_folder(base_url, http, datasource_uid)
+    customers = list_customers(dimension)
+    print(len(customers), 'customers')
+
+    def provision(customer):
+        payload = dict(template, dashboard=tenant_dashboard(scoped, customer, dimension), folderUid=folder_uid)
+        return upload_dashboard(base_url, http, payload)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+        futures = {executor.submit(provision, customer): customer for customer in customers}
+        for future, customer in futures.items():
+            try:
+                future.result()
+            except Exception as err:
+                print('customer dashboard failed', customer, err)
+                failed.append(customer)
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(customers)} customer dashboards failed: {failed[:10]}")
+    return len(customers)
 
 # lambda handler
 def lambda_handler(event, context):
@@ -125,24 +477,21 @@ def lambda_handler(event, context):
     workspace_id = os.environ['grafana_workspace_id']
     print(workspace_id)
 
-    api_key = create_grafana_api_key(workspace_id)
-    print(api_key)
+    # the key has to outlive provisioning thousands of customer dashboards
+    api_key = create_grafana_api_key(workspace_id, max(600, context.get_remaining_time_in_millis() // 1000 + 60))
 
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": "Bearer " + api_key
-        }
-    
-    http = urllib3.PoolManager(headers=headers)
+    http = create_http(api_key)
     datasource_uid = create_timestream_data_source(workspace_id, http)
     print(datasource_uid)
 
-    url = create_timestream_dashboard(workspace_id, http, datasource_uid)
-    print(url)
-    
-    # return url to cloudformation
-    return url
+    urls = provision_dashboards(workspace_id, http, datasource_uid)
+    print(urls)
 
+    # multi-tenant mode, see tenant_dashboards.py
+    tenant_dimension = os.environ.get('TenantDimension')
+    if tenant_dimension:
+        print(provision_tenant_dashboards(workspace_id, http, datasource_uid, tenant_dimension), 'customer dashboards')
     
+    # return url to cloudformation
+    return urls[0]
 
@@ -0,0 +1,116 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+# Builds per customer dashboards for the multi-tenant mode, where the customer is a dimension and the
+# partition key of the Timestream tables (TenantDimension in the stack, customerid by default).
+# scope_dashboard() adds a $customerid variable and filters every query of a dashboard on it, so
+# Timestream prunes each query to one customer's partition. tenant_dashboard() pins a scoped
+# dashboard to one customer. Runs from dashboard_setup.py and standalone:
+#   python tenant_dashboards.py grafana_dashboard.json ../lambda/process_iot_telemetry/device-meta.json --uid <uid> --output tenants/
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+
+from dashboard_lint import TENANT_VARIABLE, rewrite_dashboard
+
+
+# unique customers of a device metadata file ({"device": {"customerid": ...}}), sorted
+def load_customers(path, dimension=TENANT_VARIABLE):
+    with open(path, encoding="utf-8") as f:
+        metadata = json.load(f)
+    return sorted({str(item[dimension]) for item in metadata.values() if item.get(dimension) not in (None, "")})
+
+
+# return a copy of the dashboard with a hidden $<dimension> variable and every query filtered on it
+def scope_dashboard(dashboard, dimension=TENANT_VARIABLE):
+    dashboard = copy.deepcopy(dashboard)
+    variables = dashboard.setdefault("templating", {}).setdefault("list", [])
+    variables[:] = [variable for variable in variables if variable.get("name") != dimension]
+    # constant variables are not read from the url, a viewer cannot switch the customer
+    variables.insert(0, {
+        "type": "constant",
+        "name": dimension,
+        "label": dimension,
+        "query": "",
+        "hide": 2,
+        "skipUrlSync": True,
+    })
+    return rewrite_dashboard(dashboard, tenant_variable=dimension)
+
+
+# queries quote the variable ('$customerid') and grafana interpolates constants as they are, so single
+# quotes are doubled and a customer id cannot end the string literal
+def sql_string(value):
+    return value.replace("'", "''")
+
+
+# the scoped dashboard pinned to one customer, with its own title, tags and uid
+def tenant_dashboard(scoped, customer, dimension=TENANT_VARIABLE):
+    dashboard = copy.deepcopy(scoped)
+    value = sql_string(customer)
+    for variable in dashboard["templating"]["list"]:
+        if variable.get("name") == dimension:
+            variable["query"] = value
+            variable["current"] = {"text": customer, "value": value}
+            variable["options"] = [{"selected": True, "text": customer, "value": value}]
+    dashboard["title"] = "%s (%s)" % (dashboard.get("title", "Dashboard"), customer)
+    dashboard["tags"] = list(dashboard.get("tags", [])) + ["tenant", "%s:%s" % (dimension, customer)]
+    if dashboard.get("uid"):
+        dashboard["uid"] = tenant_uid(dashboard["uid"], customer)
+    return dashboard
+
+
+# grafana uids are at most 40 characters, customer ids are hashed into a fixed length uid
+def tenant_uid(base, customer):
+    return "t-" + hashlib.sha1(("%s/%s" % (base, customer)).encode("utf-8")).hexdigest()[:24]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build per customer copies of a Grafana dashboard")
+    parser.add_argument("dashboard", help="dashboard JSON, either the dashboard or a {\"dashboard\": ...} payload")
+    parser.add_argument("device_metadata", help="device metadata JSON listing the customer of each device")
+    parser.add_argument("--dimension", default=TENANT_VARIABLE, help="customer dimension and variable name")
+    parser.add_argument("--uid", default=None,
+                        help="uid of the dashboard the copies are made from, defaults to the uid in the file. "
+                             "Pass the uid of the provisioned dashboard to get the uids dashboard_setup.py uploads")
+    parser.add_argument("--output", required=True, help="directory the customer dashboards are written to")
+    args = parser.parse_args()
+
+    with open(args.dashboard, encoding="utf-8") as f:
+        document = json.load(f)
+    template = dict(document.get("dashboard", document))
+    template["uid"] = args.uid or template.get("uid")
+    if not template["uid"]:
+        parser.error("the dashboard has no uid, pass --uid")
+    scoped = scope_dashboard(template, args.dimension)
+
+    os.makedirs(args.output, exist_ok=True)
+    customers = load_customers(args.device_metadata, args.dimension)
+    for customer in customers:
+        dashboard = tenant_dashboard(scoped, customer, args.dimension)
+        output = dict(document, dashboard=dashboard) if "dashboard" in document else dashboard
+        with open(os.path.join(args.output, "%s.json" % dashboard["uid"]), "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=3)
+    print("%d customer dashboards written to %s" % (len(customers), args.output))
+
+
+if __name__ == "__main__":
+    main()
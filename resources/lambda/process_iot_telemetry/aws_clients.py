@@ -0,0 +1,40 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import botocore.session
+from botocore.config import Config
+
+
+### Clients are created from a plain botocore session instead of boto3, which avoids importing
+### boto3 and s3transfer during the cold start. The telemetry function package vendors a pinned
+### botocore that only carries the models and endpoints of the services it uses (written at packaging
+### time, see cdkstack/telemetry_package.py). It is imported ahead of the runtime's botocore, so the
+### trimmed data is always read by the botocore version it was taken from.
+
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = botocore.session.get_session()
+    return _session
+
+
+def create_client(service_name, **config):
+    return get_session().create_client(service_name, config=Config(**config) if config else None)
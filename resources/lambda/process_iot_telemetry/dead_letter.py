@@ -0,0 +1,105 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import json
+import os
+import time
+
+
+### SQS SendMessageBatch accepts at most 10 messages per call
+MAX_MESSAGES_PER_SEND = 10
+
+
+def dead_letter_entry(record, code, message, database, table):
+    return {
+        "database": database,
+        "table": table,
+        "reasonCode": code,
+        "reason": message,
+        "failedAt": int(time.time() * 1000),
+        "record": record,
+    }
+
+
+class LogDeadLetterSink:
+    ### Writes one JSON line per dead-lettered record to the function log
+    ### Records can be recovered with a CloudWatch Logs Insights query on reasonCode
+
+    def __init__(self, prefix="DeadLetter: "):
+        self.prefix = prefix
+
+    def send(self, entries, database, table):
+        for record, code, message in entries:
+            print(self.prefix + json.dumps(dead_letter_entry(record, code, message, database, table)))
+
+
+class SqsDeadLetterSink:
+    ### Sends dead-lettered records to an SQS queue so they can be inspected and replayed
+    ### Falls back to the log sink for anything SQS does not accept
+    ### Without a client one is created on first use, keeping the SQS model out of the cold start
+
+    def __init__(self, queue_url, client=None, fallback=None):
+        self.queue_url = queue_url
+        self._client = client
+        self.fallback = fallback or LogDeadLetterSink()
+
+    @property
+    def client(self):
+        if self._client is None:
+            from aws_clients import create_client
+
+            self._client = create_client("sqs")
+        return self._client
+
+    def send(self, entries, database, table):
+        for offset in range(0, len(entries), MAX_MESSAGES_PER_SEND):
+            batch = entries[offset:offset + MAX_MESSAGES_PER_SEND]
+            messages = [
+                {
+                    "Id": str(index),
+                    "MessageBody": json.dumps(dead_letter_entry(record, code, message, database, table)),
+                    "MessageAttributes": {"reasonCode": {"DataType": "String", "StringValue": code}},
+                }
+                for index, (record, code, message) in enumerate(batch)
+            ]
+            try:
+                response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=messages)
+                unsent = [batch[int(failure["Id"])] for failure in response.get("Failed", [])]
+            except Exception as err:
+                print("Error: dead-letter queue unavailable:", err)
+                unsent = batch
+            if unsent:
+                self.fallback.send(unsent, database, table)
+
+
+def create_dead_letter_sink_from_environment():
+    ### DeadLetterQueueUrl selects the SQS sink, otherwise dead-lettered records are logged
+    queue_url = os.environ.get("DeadLetterQueueUrl")
+    if queue_url:
+        return SqsDeadLetterSink(queue_url)
+    return LogDeadLetterSink()
+
+
+def create_quarantine_sink_from_environment():
+    ### Payloads that fail validation are quarantined with the reasons instead of being written
+    ### QuarantineQueueUrl selects the SQS sink, otherwise they are logged with a "Quarantine: " prefix
+    fallback = LogDeadLetterSink("Quarantine: ")
+    queue_url = os.environ.get("QuarantineQueueUrl")
+    if queue_url:
+        return SqsDeadLetterSink(queue_url, fallback=fallback)
+    return fallback
@@ -0,0 +1,172 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import os
+import time
+
+from dynamodb_batch import batch_get_items, batch_write_items
+
+
+def message_key(telemetry):
+    ### identity of a message, matches record_key of the record it is encoded into
+    return (telemetry["deviceid"], str(telemetry["timestamp"]))
+
+
+def record_key(record):
+    return (record["Dimensions"][0]["Value"], record["Time"])
+
+
+class RotatingKeySet:
+    ### Remembers keys for at least window seconds in two generations. Lookups check both, new keys go
+    ### into the current one, and the previous generation is dropped when the current one is window
+    ### seconds old or holds max_keys / 2 keys, so memory stays bounded under any message rate.
+    ### Unlike a Bloom filter it has no false positives, which would silently drop telemetry.
+
+    def __init__(self, window=600, max_keys=200000, clock=time.monotonic):
+        self.window = window
+        self.generation_size = max(1, max_keys // 2)
+        self.clock = clock
+        self.current = set()
+        self.previous = set()
+        self.rotated = clock()
+        self.rotations = 0
+
+    def __contains__(self, key):
+        return key in self.current or key in self.previous
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def add(self, key):
+        if len(self.current) >= self.generation_size or self.clock() - self.rotated >= self.window:
+            self.previous = self.current
+            self.current = set()
+            self.rotated = self.clock()
+            self.rotations += 1
+        self.current.add(key)
+
+
+class DynamoDBDedupBackend:
+    ### Shares written message keys between Lambda instances through a table with a "key" partition key.
+    ### Items expire ttl seconds after they were written through the "expires" TTL attribute.
+    ### client is a boto3 DynamoDB client or any object with the same batch_get_item/batch_write_item methods
+
+    def __init__(self, client, table_name, ttl=3600, max_attempts=5):
+        self.client = client
+        self.table_name = table_name
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+    def seen_many(self, keys):
+        ### returns the subset of keys another invocation already wrote, raises UnprocessedItemsError
+        ### rather than reporting keys DynamoDB did not look up as new
+        by_id = {"%s#%s" % key: key for key in keys}
+        items = batch_get_items(
+            self.client, self.table_name, [{"key": {"S": key_id}} for key_id in by_id], self.max_attempts,
+            ProjectionExpression="#k", ExpressionAttributeNames={"#k": "key"},
+        )
+        return {by_id[item["key"]["S"]] for item in items}
+
+    def remember_many(self, keys):
+        expires = str(int(time.time()) + self.ttl)
+        items = [
+            {"PutRequest": {"Item": {"key": {"S": "%s#%s" % key}, "expires": {"N": expires}}}}
+            for key in keys
+        ]
+        batch_write_items(self.client, self.table_name, items, self.max_attempts)
+
+
+class Deduplicator:
+    ### Drops redelivered messages (IoT rule retries, QoS 1 redelivery, Lambda retries) before they are
+    ### enriched and encoded. A message is a duplicate when its (deviceid, timestamp) was already written
+    ### by this instance, appears earlier in the same batch, or was written by another instance according
+    ### to the optional shared backend. Keys are only remembered once their records were written, so
+    ### messages whose write failed are not dropped when they are retried.
+    ### Duplicates racing through concurrent invocations can both be written, which Timestream treats as
+    ### an idempotent upsert, the shared backend only narrows that window.
+
+    def __init__(self, keys=None, backend=None):
+        self.keys = keys if keys is not None else RotatingKeySet()
+        self.backend = backend
+        self.lookups = 0
+        self.duplicates = 0
+        self.shared_duplicates = 0
+
+    def filter(self, messages):
+        ### messages is a list of (item id, telemetry), returns the messages that are not duplicates
+        unique = []
+        batch = set()
+        keys = self.keys
+        for message in messages:
+            key = message_key(message[1])
+            if key in batch or key in keys:
+                continue
+            batch.add(key)
+            unique.append(message)
+
+        if self.backend is not None and unique:
+            try:
+                seen = self.backend.seen_many(batch)
+            except Exception as err:
+                ### the shared backend is an optimization, write the messages when it is unavailable
+                print("Error: dedup backend lookup failed:", err)
+                seen = ()
+            if seen:
+                unique = [message for message in unique if message_key(message[1]) not in seen]
+                self.shared_duplicates += len(seen)
+
+        self.lookups += len(messages)
+        self.duplicates += len(messages) - len(unique)
+        return unique
+
+    def remember(self, records):
+        ### remember the keys of records that were written
+        keys = [record_key(record) for record in records]
+        for key in keys:
+            self.keys.add(key)
+        if self.backend is not None and keys:
+            try:
+                self.backend.remember_many(keys)
+            except Exception as err:
+                print("Error: dedup backend update failed:", err)
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "duplicates": self.duplicates,
+            "sharedDuplicates": self.shared_duplicates,
+            "hitRate": round(self.duplicates / self.lookups, 4) if self.lookups else 0.0,
+            "keys": len(self.keys),
+        }
+
+
+def create_deduplicator_from_environment():
+    ### DedupWindowSeconds and DedupMaxKeys bound the in-process key set,
+    ### DedupTable selects the shared DynamoDB backend
+    backend = None
+    table_name = os.environ.get("DedupTable")
+    if table_name:
+        from aws_clients import create_client
+
+        backend = DynamoDBDedupBackend(create_client("dynamodb"), table_name,
+                                       ttl=int(os.environ.get("DedupTtlSeconds", "3600")))
+    keys = RotatingKeySet(
+        window=int(os.environ.get("DedupWindowSeconds", "600")),
+        max_keys=int(os.environ.get("DedupMaxKeys", "200000")),
+    )
+    return Deduplicator(keys, backend)
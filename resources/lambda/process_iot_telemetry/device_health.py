@@ -0,0 +1,345 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import bisect
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+from dynamodb_batch import batch_get_items, batch_write_items
+
+### levels that drain over time, a rise larger than the refill threshold is a recharge or refuel
+DRAIN_FIELDS = ("battery_level", "fuel_level")
+
+### fields checked for outliers against their own running mean and variance
+ANOMALY_FIELDS = ("temperature", "signal_strength")
+
+### signal strength buckets in dBm for the percentile sketch, values outside fall into the edge buckets
+SIGNAL_FIELD = "signal_strength"
+SIGNAL_BUCKET_EDGES = tuple(range(-120, -25, 5))
+
+
+def time_weight(elapsed_hours, time_constant_hours):
+    ### EWMA weight of a new sample for irregularly spaced samples, close samples move the average less
+    return 1.0 - math.exp(-elapsed_hours / time_constant_hours)
+
+
+def sketch_add(counts, value, decay, edges=SIGNAL_BUCKET_EDGES):
+    ### exponentially decayed histogram, older samples fade so percentiles follow recent behaviour
+    counts[:] = [count * decay for count in counts]
+    counts[bisect.bisect_right(edges, value)] += 1.0
+
+
+def sketch_percentile(counts, fraction, edges=SIGNAL_BUCKET_EDGES):
+    ### returns the value at fraction of the decayed histogram, interpolated inside the bucket
+    total = sum(counts)
+    if total <= 0:
+        return None
+    target = fraction * total
+    seen = 0.0
+    for bucket, count in enumerate(counts):
+        if count and seen + count >= target:
+            if bucket == 0:
+                return float(edges[0])
+            if bucket == len(edges):
+                return float(edges[-1])
+            low, high = edges[bucket - 1], edges[bucket]
+            return low + (high - low) * (target - seen) / count
+        seen += count
+    return float(edges[-1])
+
+
+class DeviceHealthScorer:
+    ### Keeps O(1) memory streaming estimators per device and turns them into health records:
+    ###   drain rate     - time weighted EWMA of how fast each DRAIN_FIELDS level falls, in units per hour
+    ###   time to empty  - current level divided by the drain rate, in hours, while the level is falling
+    ###   signal sketch  - decayed histogram of signal strength, its 10th and 50th percentile are written
+    ###   anomaly flags  - z-score of each ANOMALY_FIELDS value against its EWMA mean and variance,
+    ###                    bit i of anomaly_flags is set when field i exceeded z_threshold
+    ### health_score combines them: 100 is healthy, time to empty inside risk_horizon_hours, a weak
+    ### 10th percentile signal and anomalies each take points off.
+    ### A device's health record is produced every interval seconds of event time, or right away when an
+    ### anomaly was flagged. Device state is plain JSON data, snapshot() and restore() checkpoint it so
+    ### estimators survive cold starts (see DynamoDBCheckpointStore).
+    ### A device stays pending until commit() confirms its health record was written. The anomalies of a
+    ### record that failed to write are kept and reported again by the next flush.
+
+    def __init__(self, interval=300, drain_time_constant_hours=1.0, refill_threshold=5.0, z_alpha=0.02,
+                 z_threshold=4.0, z_warmup=30, sketch_decay=0.98, risk_horizon_hours=24.0, weak_signal=-85.0,
+                 lost_signal=-105.0, max_devices=200000, store=None):
+        self.interval_ms = interval * 1000
+        self.drain_time_constant_hours = drain_time_constant_hours
+        self.refill_threshold = refill_threshold
+        self.z_alpha = z_alpha
+        self.z_threshold = z_threshold
+        self.z_warmup = z_warmup
+        self.sketch_decay = sketch_decay
+        self.risk_horizon_hours = risk_horizon_hours
+        self.weak_signal = weak_signal
+        self.lost_signal = lost_signal
+        self.max_devices = max_devices
+        self.store = store
+        self.devices = OrderedDict()
+        self.pending = set()
+        self.flushed = {}
+        self.anomalies = 0
+
+    def new_state(self):
+        return {
+            "time": 0,
+            "levels": {},
+            "stats": {},
+            "sketch": [0.0] * (len(SIGNAL_BUCKET_EDGES) + 1),
+            "zscores": {},
+            "flags": 0,
+            "anomalies": 0,
+            "written_time": 0,
+        }
+
+    def restore_missing(self, device_ids):
+        ### loads checkpointed state for devices this instance has not seen yet, one store call per batch
+        if self.store is None:
+            return
+        missing = [device for device in set(device_ids) if device not in self.devices]
+        if not missing:
+            return
+        try:
+            self.restore(self.store.load(missing))
+        except Exception as err:
+            ### scoring is best effort, devices without a checkpoint start with fresh estimators
+            print("Error: health checkpoint load failed:", err)
+
+    def restore(self, states):
+        for device, state in states.items():
+            if device not in self.devices:
+                self.devices[device] = state
+        while len(self.devices) > self.max_devices:
+            evicted, _ = self.devices.popitem(last=False)
+            self.pending.discard(evicted)
+
+    def snapshot(self, device_ids=None):
+        ### returns {device id: state} for the given devices, or all devices
+        if device_ids is None:
+            device_ids = list(self.devices)
+        return {device: self.devices[device] for device in device_ids if device in self.devices}
+
+    def update(self, telemetry):
+        device = telemetry["deviceid"]
+        timestamp = int(telemetry["timestamp"])
+        state = self.devices.get(device)
+        if state is None:
+            state = self.devices[device] = self.new_state()
+            if len(self.devices) > self.max_devices:
+                evicted, _ = self.devices.popitem(last=False)
+                self.pending.discard(evicted)
+        else:
+            self.devices.move_to_end(device)
+
+        flags = self.update_stats(state, telemetry)
+        if flags:
+            state["flags"] |= flags
+            state["anomalies"] += 1
+            self.anomalies += 1
+            self.pending.add(device)
+
+        signal = telemetry.get(SIGNAL_FIELD)
+        if signal is not None:
+            sketch_add(state["sketch"], signal, self.sketch_decay)
+
+        ### drain rates need ordered samples, out of order messages only feed the order independent estimators
+        if timestamp <= state["time"]:
+            return
+        self.update_levels(state, telemetry, timestamp)
+        state["time"] = timestamp
+        if timestamp - state["written_time"] >= self.interval_ms:
+            self.pending.add(device)
+
+    def update_stats(self, state, telemetry):
+        ### returns the anomaly bits of this message, the z-score is taken before the sample joins the average
+        flags = 0
+        alpha = self.z_alpha
+        for bit, field in enumerate(ANOMALY_FIELDS):
+            value = telemetry.get(field)
+            if value is None:
+                continue
+            stats = state["stats"].get(field)
+            if stats is None:
+                state["stats"][field] = [float(value), 0.0, 1]
+                continue
+            mean, variance, count = stats
+            diff = value - mean
+            if count >= self.z_warmup and variance > 0:
+                zscore = diff / math.sqrt(variance)
+                state["zscores"][field] = zscore
+                if abs(zscore) > self.z_threshold:
+                    flags |= 1 << bit
+            increment = alpha * diff
+            stats[0] = mean + increment
+            stats[1] = (1 - alpha) * (variance + diff * increment)
+            stats[2] = count + 1
+        return flags
+
+    def update_levels(self, state, telemetry, timestamp):
+        for field in DRAIN_FIELDS:
+            value = telemetry.get(field)
+            if value is None:
+                continue
+            level = state["levels"].get(field)
+            if level is None:
+                state["levels"][field] = [value, timestamp, None]
+                continue
+            last_value, last_time, rate = level
+            elapsed_hours = (timestamp - last_time) / 3600000.0
+            drained = last_value - value
+            if drained >= -self.refill_threshold:
+                observed = drained / elapsed_hours
+                if rate is None:
+                    rate = observed
+                else:
+                    rate += time_weight(elapsed_hours, self.drain_time_constant_hours) * (observed - rate)
+            state["levels"][field] = [value, timestamp, rate]
+
+    def time_to_empty(self, level):
+        ### hours until the level reaches zero at the current drain rate, None while it is not falling
+        value, _, rate = level
+        if rate is None or rate <= 0:
+            return None
+        return max(0.0, value / rate)
+
+    def health_score(self, state):
+        score = 100.0
+        hours = [self.time_to_empty(level) for level in state["levels"].values()]
+        hours = [value for value in hours if value is not None]
+        if hours and min(hours) < self.risk_horizon_hours:
+            score -= 50.0 * (1.0 - min(hours) / self.risk_horizon_hours)
+        signal_p10 = sketch_percentile(state["sketch"], 0.1)
+        if signal_p10 is not None and signal_p10 < self.weak_signal:
+            score -= 30.0 * min(1.0, (self.weak_signal - signal_p10) / (self.weak_signal - self.lost_signal))
+        score -= min(20.0, 10.0 * bin(state["flags"]).count("1"))
+        return max(0.0, score)
+
+    def build_record(self, device, state, version):
+        values = [{"Name": "health_score", "Value": str(round(self.health_score(state), 2)), "Type": "DOUBLE"}]
+        for field, level in state["levels"].items():
+            if level[2] is not None:
+                values.append({"Name": field + "_drain_rate", "Value": str(level[2]), "Type": "DOUBLE"})
+            hours = self.time_to_empty(level)
+            if hours is not None:
+                values.append({"Name": field + "_time_to_empty", "Value": str(hours), "Type": "DOUBLE"})
+        for name, fraction in (("signal_strength_p10", 0.1), ("signal_strength_p50", 0.5)):
+            percentile = sketch_percentile(state["sketch"], fraction)
+            if percentile is not None:
+                values.append({"Name": name, "Value": str(round(percentile, 2)), "Type": "DOUBLE"})
+        for field, zscore in state["zscores"].items():
+            values.append({"Name": field + "_zscore", "Value": str(round(zscore, 3)), "Type": "DOUBLE"})
+        values.append({"Name": "anomaly_flags", "Value": str(state["flags"]), "Type": "BIGINT"})
+        values.append({"Name": "anomalies", "Value": str(state["anomalies"]), "Type": "BIGINT"})
+        return {
+            "Dimensions": [{"Name": "deviceid", "Value": device}],
+            "MeasureName": "health",
+            "MeasureValueType": "MULTI",
+            "MeasureValues": values,
+            "Time": str(state["time"]),
+            "Version": version,
+        }
+
+    def flush(self):
+        ### returns health records for devices that reached their interval or flagged an anomaly
+        version = int(time.time() * 1000)
+        records = []
+        self.flushed = {}
+        for device in list(self.pending):
+            state = self.devices[device]
+            if not state["time"]:
+                self.pending.discard(device)
+                continue
+            records.append(self.build_record(device, state, version))
+            self.flushed[device] = (state["time"], state["anomalies"])
+        return records
+
+    def commit(self, records, failed=()):
+        ### marks the health records of the last flush as written, except those at the failed indexes,
+        ### and checkpoints the state of every flushed device
+        for index, record in enumerate(records):
+            if index in failed:
+                continue
+            device = record["Dimensions"][0]["Value"]
+            state = self.devices.get(device)
+            flushed = self.flushed.get(device)
+            if state is None or flushed is None:
+                continue
+            state["written_time"], anomalies = flushed
+            state["anomalies"] -= anomalies
+            if not state["anomalies"]:
+                state["flags"] = 0
+            self.pending.discard(device)
+        if self.store is not None and self.flushed:
+            try:
+                self.store.save(self.snapshot(self.flushed))
+            except Exception as err:
+                print("Error: health checkpoint save failed:", err)
+        self.flushed = {}
+
+
+class DynamoDBCheckpointStore:
+    ### Keeps the health estimator state of each device as a JSON string in a table with a "deviceid"
+    ### partition key. Items expire ttl_days after the last checkpoint through the "expires" TTL attribute.
+    ### client is a boto3 DynamoDB client or any object with the same batch_get_item/batch_write_item methods
+
+    def __init__(self, client, table_name, key_name="deviceid", ttl_days=30, max_attempts=5):
+        self.client = client
+        self.table_name = table_name
+        self.key_name = key_name
+        self.ttl_seconds = ttl_days * 86400
+        self.max_attempts = max_attempts
+
+    def load(self, device_ids):
+        ### raises UnprocessedItemsError when DynamoDB keeps throttling, the scorer then starts those devices fresh
+        keys = [{self.key_name: {"S": device_id}} for device_id in device_ids]
+        items = batch_get_items(self.client, self.table_name, keys, self.max_attempts)
+        return {item[self.key_name]["S"]: json.loads(item["state"]["S"]) for item in items}
+
+    def save(self, states):
+        expires = str(int(time.time()) + self.ttl_seconds)
+        items = [
+            {"PutRequest": {"Item": {
+                self.key_name: {"S": device_id},
+                "state": {"S": json.dumps(state, separators=(",", ":"))},
+                "expires": {"N": expires},
+            }}}
+            for device_id, state in states.items()
+        ]
+        batch_write_items(self.client, self.table_name, items, self.max_attempts)
+
+
+def create_health_scorer_from_environment():
+    ### HealthIntervalSeconds sets how often a device's health record is written,
+    ### HealthCheckpointTable selects the DynamoDB table estimator state is checkpointed to
+    store = None
+    table_name = os.environ.get("HealthCheckpointTable")
+    if table_name:
+        from aws_clients import create_client
+
+        store = DynamoDBCheckpointStore(create_client("dynamodb"), table_name)
+    return DeviceHealthScorer(
+        interval=int(os.environ.get("HealthIntervalSeconds", "300")),
+        risk_horizon_hours=float(os.environ.get("HealthRiskHorizonHours", "24")),
+        store=store,
+    )
@@ -0,0 +1,219 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import json
+import marshal
+import os
+import time
+from collections import OrderedDict
+
+from dynamodb_batch import UnprocessedItemsError, batch_get_items
+
+### cache entries stored for devices the backend does not know about
+_UNKNOWN = object()
+
+
+class PartialLookupError(UnprocessedItemsError):
+    ### raised by a backend that could only read some devices, found holds the metadata of the devices
+    ### that were read and unresolved the ids of the devices that were not
+
+    def __init__(self, found, unresolved, unprocessed):
+        super().__init__("BatchGetItem", unprocessed)
+        self.found = found
+        self.unresolved = unresolved
+
+
+class MetadataCache:
+    ### Bounded LRU cache with a time to live per entry
+    ### Unknown devices are cached too (negative caching) with their own, usually shorter, TTL
+    ### so a misbehaving device does not cause a backend lookup for every message
+
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        ### returns the cached metadata, None for a cached unknown device, or _UNKNOWN on a miss
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < self.clock():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return _UNKNOWN
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self.entries[key] = (value, self.clock() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class JsonFileBackend:
+    ### Reads metadata from a JSON object keyed by device id, e.g. device-meta.json
+
+    def __init__(self, path="device-meta.json"):
+        with open(path, encoding="utf-8") as meta:
+            self.devices = json.load(meta)
+
+    def batch_get(self, device_ids):
+        return {device_id: self.devices[device_id] for device_id in device_ids if device_id in self.devices}
+
+
+class CompactFileBackend:
+    ### Reads metadata prebuilt at packaging time from device-meta.json (see cdkstack/lambda_packaging.py)
+    ### The file is a marshal dump of (field names, {device id: field values}) which loads much faster
+    ### than parsing JSON for large fleets. Metadata dicts are only built for devices that are looked up.
+
+    def __init__(self, path="device-meta.marshal"):
+        with open(path, "rb") as meta:
+            self.fields, self.devices = marshal.load(meta)
+
+    def batch_get(self, device_ids):
+        found = {}
+        for device_id in device_ids:
+            values = self.devices.get(device_id)
+            if values is not None:
+                found[device_id] = dict(zip(self.fields, values))
+        return found
+
+
+def build_compact_file(json_path, compact_path):
+    ### convert a device-meta.json style file into the CompactFileBackend format
+    with open(json_path, encoding="utf-8") as meta:
+        devices = json.load(meta)
+    fields = tuple(sorted({field for metadata in devices.values() for field in metadata}))
+    compact = (fields, {device_id: tuple(metadata.get(field) for field in fields) for device_id, metadata in devices.items()})
+    with open(compact_path, "wb") as output:
+        marshal.dump(compact, output)
+
+
+class DynamoDBBackend:
+    ### Reads metadata from a key/value table with a "deviceid" partition key
+    ### client is a boto3 DynamoDB client or any object with the same batch_get_item method,
+    ### such as a local stand-in used for testing
+
+    def __init__(self, client, table_name, key_name="deviceid", max_attempts=5):
+        self.client = client
+        self.table_name = table_name
+        self.key_name = key_name
+        self.max_attempts = max_attempts
+
+    def batch_get(self, device_ids):
+        keys = [{self.key_name: {"S": device_id}} for device_id in device_ids]
+        try:
+            items = batch_get_items(self.client, self.table_name, keys, self.max_attempts)
+        except UnprocessedItemsError as err:
+            raise PartialLookupError(self.metadata_of(err.items),
+                                     {key[self.key_name]["S"] for key in err.unprocessed}, err.unprocessed) from err
+        return self.metadata_of(items)
+
+    def metadata_of(self, items):
+        return {item[self.key_name]["S"]: from_dynamodb_item(item, self.key_name) for item in items}
+
+
+def from_dynamodb_item(item, key_name):
+    ### convert a low level DynamoDB item with string and number attributes into a plain dict
+    metadata = {}
+    for name, value in item.items():
+        if name == key_name:
+            continue
+        if "S" in value:
+            metadata[name] = value["S"]
+        elif "N" in value:
+            metadata[name] = value["N"]
+    return metadata
+
+
+class MetadataResolver:
+    ### Resolves device metadata through an in-process cache in front of a pluggable backend
+    ### All devices in a batch are looked up with a single backend call
+
+    def __init__(self, backend, cache=None):
+        self.backend = backend
+        self.cache = cache if cache is not None else MetadataCache()
+
+    def resolve_many(self, device_ids):
+        ### returns a dict of device id to metadata, None for devices the backend does not know
+        resolved = {}
+        missing = []
+        for device_id in set(device_ids):
+            value = self.cache.get(device_id)
+            if value is _UNKNOWN:
+                missing.append(device_id)
+            else:
+                resolved[device_id] = value
+
+        if missing:
+            unresolved = ()
+            try:
+                found = self.backend.batch_get(missing)
+            except PartialLookupError as err:
+                ### the devices that were read are used and cached, the others are treated like a failed lookup
+                print("Error: device metadata lookup left %d devices unresolved: %s" % (len(err.unresolved), err))
+                found = err.found
+                unresolved = err.unresolved
+            except Exception as err:
+                ### enrichment is best effort, write the telemetry without metadata and do not
+                ### cache the result so the devices are looked up again on the next message
+                print("Error: device metadata lookup failed:", err)
+                resolved.update((device_id, None) for device_id in missing)
+                return resolved
+            for device_id in missing:
+                if device_id in unresolved:
+                    resolved[device_id] = None
+                    continue
+                value = found.get(device_id)
+                self.cache.put(device_id, value)
+                resolved[device_id] = value
+
+        return resolved
+
+    def resolve(self, device_id):
+        return self.resolve_many([device_id])[device_id]
+
+
+def create_resolver_from_environment():
+    ### DeviceMetadataTable selects the DynamoDB backend, otherwise the bundled device metadata is used,
+    ### preferring the compact file built at packaging time over device-meta.json
+    table_name = os.environ.get("DeviceMetadataTable")
+    metadata_file = os.environ.get("DeviceMetadataFile", "device-meta.json")
+    compact_file = os.path.splitext(metadata_file)[0] + ".marshal"
+    if table_name:
+        from aws_clients import create_client
+
+        backend = DynamoDBBackend(create_client("dynamodb"), table_name)
+    elif os.path.exists(compact_file):
+        backend = CompactFileBackend(compact_file)
+    else:
+        backend = JsonFileBackend(metadata_file)
+
+    cache = MetadataCache(
+        max_size=int(os.environ.get("DeviceMetadataCacheSize", "10000")),
+        ttl=int(os.environ.get("DeviceMetadataTtlSeconds", "300")),
+        negative_ttl=int(os.environ.get("DeviceMetadataNegativeTtlSeconds", "60")),
+    )
+    return MetadataResolver(backend, cache)
@@ -0,0 +1,129 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import time
+from collections import OrderedDict
+
+
+### fields kept in the last known state, with the change that has to happen before a new state is written
+STATE_DEADBANDS = {
+    "battery_level": 1.0,
+    "fuel_level": 1.0,
+    "temperature": 5,
+    "signal_strength": 2.0,
+    "latitude": 0.001,
+    "longitude": 0.001,
+}
+
+### location fields are read from the nested location object of the payload
+NESTED_FIELDS = {"latitude": ("location", "latitude"), "longitude": ("location", "longitude")}
+
+
+def read_field(telemetry, field):
+    path = NESTED_FIELDS.get(field)
+    if path is None:
+        return telemetry.get(field)
+    value = telemetry.get(path[0])
+    return value.get(path[1]) if isinstance(value, dict) else None
+
+
+class DeviceStateTracker:
+    ### Maintains the last known state of each device: latest values, last seen time and the number of
+    ### messages received since the previous state record. A state record is only produced when a value
+    ### moved by more than its deadband or heartbeat seconds passed since the device's last state record,
+    ### so "fleet now" panels read a handful of rows per device instead of the raw history.
+    ### A device stays pending until commit() confirms its state record was written, so a failed write
+    ### is retried by the next flush and the message count covers every message since the last written row.
+
+    def __init__(self, deadbands=STATE_DEADBANDS, heartbeat=300, max_devices=200000):
+        self.deadbands = deadbands
+        self.heartbeat_ms = heartbeat * 1000
+        self.max_devices = max_devices
+        self.devices = OrderedDict()
+        self.pending = set()
+        self.flushed = {}
+
+    def update(self, telemetry):
+        device = telemetry["deviceid"]
+        timestamp = int(telemetry["timestamp"])
+        state = self.devices.get(device)
+        if state is None:
+            state = self.devices[device] = {"time": 0, "values": {}, "written": {}, "written_time": 0, "messages": 0}
+            if len(self.devices) > self.max_devices:
+                evicted, _ = self.devices.popitem(last=False)
+                self.pending.discard(evicted)
+        else:
+            self.devices.move_to_end(device)
+
+        state["messages"] += 1
+        ### out of order messages are counted but do not replace newer state
+        if timestamp < state["time"]:
+            return
+        state["time"] = timestamp
+        values = state["values"]
+        for field in self.deadbands:
+            value = read_field(telemetry, field)
+            if value is not None:
+                values[field] = value
+
+        if device in self.pending:
+            return
+        written = state["written"]
+        if timestamp - state["written_time"] >= self.heartbeat_ms or any(
+            field not in written or abs(value - written[field]) >= self.deadbands[field]
+            for field, value in values.items()
+        ):
+            self.pending.add(device)
+
+    def flush(self):
+        ### returns state records for devices that changed or reached their heartbeat
+        records = []
+        self.flushed = {}
+        for device in self.pending:
+            state = self.devices[device]
+            measure_values = [
+                {"Name": field, "Value": str(value), "Type": "DOUBLE"} for field, value in state["values"].items()
+            ]
+            measure_values.append({"Name": "last_seen", "Value": str(state["time"]), "Type": "BIGINT"})
+            measure_values.append({"Name": "messages", "Value": str(state["messages"]), "Type": "BIGINT"})
+            records.append({
+                "Dimensions": [{"Name": "deviceid", "Value": device}],
+                "MeasureName": "state",
+                "MeasureValueType": "MULTI",
+                "MeasureValues": measure_values,
+                "Time": str(state["time"]),
+                "Version": int(time.time() * 1000),
+            })
+            self.flushed[device] = (dict(state["values"]), state["time"], state["messages"])
+        return records
+
+    def commit(self, records, failed=()):
+        ### marks the state records of the last flush as written, except those at the failed indexes.
+        ### Their devices stay pending and keep counting messages until a later write succeeds.
+        for index, record in enumerate(records):
+            if index in failed:
+                continue
+            device = record["Dimensions"][0]["Value"]
+            state = self.devices.get(device)
+            flushed = self.flushed.get(device)
+            if state is None or flushed is None:
+                continue
+            state["written"], state["written_time"], messages = flushed
+            state["messages"] -= messages
+            self.pending.discard(device)
+        self.flushed = {}
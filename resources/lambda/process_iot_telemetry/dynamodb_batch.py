@@ -0,0 +1,76 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import time
+
+
+### DynamoDB BatchGetItem accepts at most 100 keys and BatchWriteItem at most 25 items per call
+MAX_KEYS_PER_BATCH_GET = 100
+MAX_ITEMS_PER_BATCH_WRITE = 25
+
+
+class UnprocessedItemsError(RuntimeError):
+    ### raised when DynamoDB still returns unprocessed keys or items after the last attempt,
+    ### unprocessed holds the keys or write requests that were left and, for BatchGetItem,
+    ### items the items that were read
+
+    def __init__(self, operation, unprocessed, items=None):
+        super().__init__("DynamoDB %s left %d items unprocessed" % (operation, len(unprocessed)))
+        self.unprocessed = unprocessed
+        self.items = items if items is not None else []
+
+
+def batch_get_items(client, table_name, keys, max_attempts=5, **options):
+    ### returns the items found for keys, options such as ProjectionExpression are sent with every request.
+    ### Keys DynamoDB could not process because of throughput limits are retried with exponential backoff.
+    ### When some are left after max_attempts the other chunks are still read, then UnprocessedItemsError
+    ### is raised with the items that were found
+    keys = list(keys)
+    items = []
+    unprocessed = []
+    for offset in range(0, len(keys), MAX_KEYS_PER_BATCH_GET):
+        request = {table_name: dict(options, Keys=keys[offset:offset + MAX_KEYS_PER_BATCH_GET])}
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(0.05 * 2 ** attempt)
+            response = client.batch_get_item(RequestItems=request)
+            items.extend(response.get("Responses", {}).get(table_name, []))
+            request = response.get("UnprocessedKeys")
+            if not request:
+                break
+        if request:
+            unprocessed.extend(request[table_name]["Keys"])
+    if unprocessed:
+        raise UnprocessedItemsError("BatchGetItem", unprocessed, items)
+    return items
+
+
+def batch_write_items(client, table_name, requests, max_attempts=5):
+    ### writes PutRequest/DeleteRequest entries 25 at a time, unprocessed items are retried like in batch_get_items
+    requests = list(requests)
+    for offset in range(0, len(requests), MAX_ITEMS_PER_BATCH_WRITE):
+        request = {table_name: requests[offset:offset + MAX_ITEMS_PER_BATCH_WRITE]}
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(0.05 * 2 ** attempt)
+            response = client.batch_write_item(RequestItems=request)
+            request = response.get("UnprocessedItems")
+            if not request:
+                break
+        if request:
+            raise UnprocessedItemsError("BatchWriteItem", request[table_name])
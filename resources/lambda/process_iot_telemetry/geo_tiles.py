@@ -0,0 +1,199 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import time
+import uuid
+from collections import OrderedDict
+
+
+### geohash precisions tiles are kept at, roughly 1250 km, 156 km and 39 km wide cells
+TILE_PRECISIONS = (2, 3, 4)
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(latitude, longitude, precision):
+    ### standard base32 geohash, longitude and latitude bits interleaved starting with longitude
+    bits = precision * 5
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    x = min(int((longitude + 180.0) / 360.0 * (1 << lon_bits)), (1 << lon_bits) - 1)
+    y = min(int((latitude + 90.0) / 180.0 * (1 << lat_bits)), (1 << lat_bits) - 1)
+    code = 0
+    for index in range(bits):
+        if index % 2 == 0:
+            bit = (x >> (lon_bits - 1 - index // 2)) & 1
+        else:
+            bit = (y >> (lat_bits - 1 - index // 2)) & 1
+        code = (code << 1) | bit
+    return "".join(GEOHASH_ALPHABET[(code >> shift) & 31] for shift in range(bits - 5, -1, -5))
+
+
+class TileAggregator:
+    ### Keeps per geohash tile device counts and positions at each of TILE_PRECISIONS, so a fleet map
+    ### reads one row per tile instead of raw positions. A device counts in the tiles of its latest
+    ### position until it has not reported for active_seconds of event time.
+    ###
+    ### Every tile record holds the number of devices, the centroid of their latest positions and the
+    ### latest position reported in the tile. Like the rollups, concurrent Lambda instances each write
+    ### their own partial (the "partial" dimension) and dashboards sum the partials. A device whose
+    ### messages reach several instances within active_seconds is counted by each of them, with the
+    ### kinesis ingestion mode a device's messages are processed by one instance and counts are exact.
+    ### Changed tiles are written at most every flush_interval seconds and every tile once per heartbeat
+    ### seconds, so partials of recycled instances drop out of a dashboard window a little longer than
+    ### the heartbeat.
+    ### With a tenant_dimension, tiles are kept per tenant passed to add(). Each tenant's tiles carry the
+    ### tenant dimension and are written as their own partial, so fleet wide panels still sum partials.
+
+    def __init__(self, precisions=TILE_PRECISIONS, active_seconds=3600, flush_interval=60, heartbeat=300,
+                 partial_id=None, tenant_dimension=None, clock=time.time):
+        self.precisions = precisions
+        self.max_precision = max(precisions)
+        self.active_ms = active_seconds * 1000
+        self.flush_interval = flush_interval
+        self.heartbeat = heartbeat
+        self.partial_id = partial_id or uuid.uuid4().hex[:12]
+        self.tenant_dimension = tenant_dimension
+        self.clock = clock
+        self.devices = OrderedDict()
+        self.tiles = {}
+        self.dirty = set()
+        self.watermark = 0
+        self.last_flush = self.last_heartbeat = clock()
+        self.version = 0
+
+    def add(self, telemetry, tenant=None):
+        location = telemetry.get("location")
+        if not isinstance(location, dict):
+            return
+        latitude = location.get("latitude")
+        longitude = location.get("longitude")
+        if latitude is None or longitude is None:
+            return
+        timestamp = int(telemetry["timestamp"])
+        if timestamp > self.watermark:
+            self.watermark = timestamp
+
+        ### devices with an empty tenant share the tiles of devices without one
+        tenant = tenant or None
+        device = telemetry["deviceid"]
+        previous = self.devices.get(device)
+        if previous is not None:
+            ### out of order messages do not move the device back
+            if timestamp < previous[0]:
+                return
+            self.devices.move_to_end(device)
+            if previous[1] == latitude and previous[2] == longitude and previous[4] == tenant:
+                previous[0] = timestamp
+                for precision in self.precisions:
+                    self.touch((precision, previous[3][:precision], tenant), latitude, longitude, timestamp)
+                return
+            self.remove(previous)
+        code = geohash(latitude, longitude, self.max_precision)
+        self.devices[device] = [timestamp, latitude, longitude, code, tenant]
+        for precision in self.precisions:
+            key = (precision, code[:precision], tenant)
+            tile = self.tiles.get(key)
+            if tile is None:
+                tile = self.tiles[key] = [0, 0.0, 0.0, latitude, longitude, timestamp]
+            tile[0] += 1
+            tile[1] += latitude
+            tile[2] += longitude
+            self.touch(key, latitude, longitude, timestamp)
+
+    def touch(self, key, latitude, longitude, timestamp):
+        tile = self.tiles[key]
+        if timestamp >= tile[5]:
+            tile[3], tile[4], tile[5] = latitude, longitude, timestamp
+        self.dirty.add(key)
+
+    def remove(self, device_state):
+        _, latitude, longitude, code, tenant = device_state
+        for precision in self.precisions:
+            key = (precision, code[:precision], tenant)
+            tile = self.tiles[key]
+            tile[0] -= 1
+            tile[1] -= latitude
+            tile[2] -= longitude
+            self.dirty.add(key)
+
+    def expire(self):
+        ### devices are kept in least recently updated order, stop at the first active one
+        cutoff = self.watermark - self.active_ms
+        while self.devices:
+            device, state = next(iter(self.devices.items()))
+            if state[0] >= cutoff:
+                break
+            del self.devices[device]
+            self.remove(state)
+
+    def next_version(self):
+        ### Timestream only replaces a record when the new Version is higher
+        self.version = max(self.version + 1, int(self.clock() * 1000))
+        return self.version
+
+    def build_record(self, key, tile, version):
+        precision, code, tenant = key
+        count = tile[0]
+        values = [{"Name": "devices", "Value": str(count), "Type": "BIGINT"}]
+        if count:
+            values += [
+                {"Name": "latitude", "Value": str(round(tile[1] / count, 6)), "Type": "DOUBLE"},
+                {"Name": "longitude", "Value": str(round(tile[2] / count, 6)), "Type": "DOUBLE"},
+                {"Name": "last_latitude", "Value": str(tile[3]), "Type": "DOUBLE"},
+                {"Name": "last_longitude", "Value": str(tile[4]), "Type": "DOUBLE"},
+            ]
+        values.append({"Name": "last_seen", "Value": str(tile[5]), "Type": "BIGINT"})
+        dimensions = [
+            {"Name": "tile", "Value": code},
+            {"Name": "tile_precision", "Value": str(precision)},
+            {"Name": "partial", "Value": self.partial_id},
+        ]
+        if tenant not in (None, "") and self.tenant_dimension:
+            dimensions[2] = {"Name": "partial", "Value": "%s-%s" % (self.partial_id, tenant)}
+            dimensions.append({"Name": self.tenant_dimension, "Value": tenant})
+        return {
+            "Dimensions": dimensions,
+            "MeasureName": "tile",
+            "MeasureValueType": "MULTI",
+            "MeasureValues": values,
+            "Time": str(int(self.clock() * 1000)),
+            "Version": version,
+        }
+
+    def flush(self, force=False):
+        ### returns tile records: changed tiles once the flush interval passed, every tile once per heartbeat.
+        ### Tiles left without devices are written once with a zero count and dropped.
+        now = self.clock()
+        heartbeat = force or now - self.last_heartbeat >= self.heartbeat
+        if not heartbeat and now - self.last_flush < self.flush_interval:
+            return []
+        self.last_flush = now
+        if heartbeat:
+            self.last_heartbeat = now
+
+        self.expire()
+        version = self.next_version()
+        keys = list(self.tiles) if heartbeat else self.dirty
+        records = [self.build_record(key, self.tiles[key], version) for key in keys if key in self.tiles]
+        for key in keys:
+            tile = self.tiles.get(key)
+            if tile is not None and tile[0] <= 0:
+                del self.tiles[key]
+        self.dirty = set()
+        return records
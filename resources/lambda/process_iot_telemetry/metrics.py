@@ -0,0 +1,147 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import time
+
+### metrics are extracted from the log line by CloudWatch, so emitting them costs one print per invocation
+STAGE_UNIT = "Milliseconds"
+COUNT_UNIT = "Count"
+
+### number of functions listed when a sampled invocation is profiled
+PROFILE_TOP_FUNCTIONS = 25
+
+
+class InvocationMetrics:
+    ### Collects per stage timings and counters for one invocation and emits them as a single
+    ### CloudWatch Embedded Metric Format (EMF) log line.
+    ###   checkpoint(stage) - time since the previous checkpoint is recorded as <stage>Time
+    ###   timing(name, ms)  - records a duration measured elsewhere as <name>Time
+    ###   count(name, n)    - adds to a counter metric
+    ###   set(name, value)  - adds a property that is logged but not turned into a metric
+    ### A profile_sample_rate fraction of invocations runs under cProfile and the profile is printed
+    ### when the invocation took longer than slow_ms, other invocations pay no profiling cost.
+
+    def __init__(self, namespace, dimensions=None, profile_sample_rate=0.0, slow_ms=1000.0,
+                 clock=time.perf_counter, emit=print):
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+        self.profile_sample_rate = profile_sample_rate
+        self.slow_ms = slow_ms
+        self.clock = clock
+        self.emit = emit
+        self.profiler = None
+        self.timings = {}
+        self.counters = {}
+        self.properties = {}
+        self.started = self._last = clock()
+        self._directive = None
+        self._directive_names = None
+
+    def begin(self):
+        ### start a new invocation, sampled invocations start profiling here
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.timings = {}
+        self.counters = {}
+        self.properties = {}
+        self.started = self._last = self.clock()
+        self.profiler = None
+        if self.profile_sample_rate and random.random() < self.profile_sample_rate:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def checkpoint(self, stage):
+        now = self.clock()
+        name = stage + "Time"
+        self.timings[name] = self.timings.get(name, 0.0) + (now - self._last) * 1000
+        self._last = now
+
+    def timing(self, name, milliseconds):
+        self.timings[name + "Time"] = milliseconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.properties[name] = value
+
+    def directive(self):
+        ### the CloudWatchMetrics directive only changes when the set of metric names changes,
+        ### so its JSON is cached and reused by later invocations
+        names = (tuple(self.timings), tuple(self.counters))
+        if names != self._directive_names:
+            metrics = [{"Name": name, "Unit": STAGE_UNIT} for name in self.timings]
+            metrics += [{"Name": name, "Unit": COUNT_UNIT} for name in self.counters]
+            self._directive = json.dumps([{
+                "Namespace": self.namespace,
+                "Dimensions": [list(self.dimensions)],
+                "Metrics": metrics,
+            }], separators=(",", ":"))
+            self._directive_names = names
+        return self._directive
+
+    def serialize(self):
+        ### EMF document: metric values are top level members named in the _aws metadata
+        values = dict(self.dimensions)
+        values.update(self.properties)
+        for name, value in self.timings.items():
+            values[name] = round(value, 3)
+        values.update(self.counters)
+        ### the members are spliced in after _aws without their braces, an empty document adds none
+        members = json.dumps(values, separators=(",", ":"))[1:-1]
+        return '{"_aws":{"Timestamp":%d,"CloudWatchMetrics":%s}%s}' % (
+            time.time() * 1000, self.directive(), "," + members if members else "")
+
+    def finish(self):
+        ### emit the metrics line and, for slow sampled invocations, the profile
+        ### returns the total invocation time in milliseconds
+        self._last = self.clock()
+        total = self.timings["TotalTime"] = (self._last - self.started) * 1000
+        self.emit(self.serialize())
+        if self.profiler is not None:
+            self.profiler.disable()
+            if total >= self.slow_ms:
+                self.emit("Profile: " + format_profile(self.profiler))
+            self.profiler = None
+        return total
+
+
+def format_profile(profiler, limit=PROFILE_TOP_FUNCTIONS):
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(limit)
+    return output.getvalue()
+
+
+def create_metrics_from_environment():
+    ### MetricsNamespace sets the CloudWatch namespace, ProfileSampleRate the fraction of invocations
+    ### to profile and ProfileSlowMs the duration above which a sampled profile is logged
+    dimensions = {}
+    if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+        dimensions["FunctionName"] = os.environ["AWS_LAMBDA_FUNCTION_NAME"]
+    return InvocationMetrics(
+        os.environ.get("MetricsNamespace", "IoTTelemetry"),
+        dimensions,
+        profile_sample_rate=float(os.environ.get("ProfileSampleRate", "0")),
+        slow_ms=float(os.environ.get("ProfileSlowMs", "1000")),
+    )
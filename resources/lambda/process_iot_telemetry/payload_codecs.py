@@ -0,0 +1,132 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import base64
+import json
+import struct
+
+### Devices on metered links can publish a compact packed struct instead of JSON. The encoding is taken
+### from the MQTT content type when the device sets one, otherwise from the first byte of the payload:
+###   0x01                     packed struct, version 1 (see PACKED_V1)
+###   anything else            JSON
+### The packed struct is decoded with a single unpack_from on a memoryview of the payload, only the
+### deviceid and the decoded values are allocated.
+
+CONTENT_TYPES = {
+    "application/json": "json",
+    "application/vnd.iot-telemetry.packed": "packed",
+}
+
+### Packed struct version 1, little endian, for the fields of the sample device:
+###   version B, timestamp Q (epoch ms), temperature h, signal_strength h (x100),
+###   latitude i (x1e7), longitude i (x1e7), fuel_level H (x100), battery_level H (x100),
+###   deviceid length B followed by the UTF-8 deviceid
+PACKED_VERSION = 1
+PACKED_V1 = struct.Struct("<BQhhiiHHB")
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def _need(buf, end):
+    if end > len(buf):
+        raise PayloadError("truncated payload")
+
+
+### Packed struct
+
+def decode_packed(data):
+    buf = memoryview(data)
+    _need(buf, PACKED_V1.size)
+    (version, timestamp, temperature, signal_strength, latitude, longitude,
+     fuel_level, battery_level, deviceid_length) = PACKED_V1.unpack_from(buf)
+    if version != PACKED_VERSION:
+        raise PayloadError("unsupported packed payload version %d" % version)
+    end = PACKED_V1.size + deviceid_length
+    if end != len(buf):
+        raise PayloadError("packed payload length does not match its deviceid length")
+    return {
+        "deviceid": str(buf[PACKED_V1.size:end], "utf-8"),
+        "timestamp": timestamp,
+        "temperature": temperature,
+        "signal_strength": signal_strength / 100,
+        "location": {"latitude": latitude / 10000000, "longitude": longitude / 10000000},
+        "fuel_level": fuel_level / 100,
+        "battery_level": battery_level / 100,
+    }
+
+
+def encode_packed(payload):
+    deviceid = payload["deviceid"].encode("utf-8")
+    try:
+        return PACKED_V1.pack(
+            PACKED_VERSION,
+            payload["timestamp"],
+            payload["temperature"],
+            round(payload["signal_strength"] * 100),
+            round(payload["location"]["latitude"] * 10000000),
+            round(payload["location"]["longitude"] * 10000000),
+            round(payload["fuel_level"] * 100),
+            round(payload["battery_level"] * 100),
+            len(deviceid),
+        ) + deviceid
+    except struct.error as err:
+        raise PayloadError("payload does not fit the packed layout: %s" % err)
+
+
+def decode_json(data):
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+def encode_json(payload):
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+DECODERS = {
+    "json": decode_json,
+    "packed": decode_packed,
+}
+
+ENCODERS = {
+    "json": encode_json,
+    "packed": encode_packed,
+}
+
+
+def detect_encoding(data):
+    if not data:
+        raise PayloadError("empty payload")
+    if data[0] == PACKED_VERSION:
+        return "packed"
+    return "json"
+
+
+def decode_payload(data, content_type=None):
+    ### decode a raw payload, content_type wins over the first byte when it names a known encoding
+    encoding = CONTENT_TYPES.get(content_type.split(";")[0].strip().lower()) if content_type else None
+    return DECODERS[encoding or detect_encoding(data)](data)
+
+
+def decode_envelope(envelope):
+    ### the binary IoT rule forwards {"payload": <base64>, "contentType": <MQTT 5 content type or null>}
+    return decode_payload(base64.b64decode(envelope["payload"]), envelope.get("contentType"))
+
+
+def encode_payload(payload, encoding):
+    return ENCODERS[encoding](payload)
@@ -16,99 +16,349 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
 #################################################################################################
 
+import time
+
+### init phase timings in milliseconds, logged once per container so cold start changes can be verified
+init_timings = {}
+_init_clock = time.perf_counter()
+
+
+def init_checkpoint(stage):
+    global _init_clock
+    now = time.perf_counter()
+    init_timings[stage] = round((now - _init_clock) * 1000, 3)
+    _init_clock = now
+
+
+import base64
 import json
-import boto3
 import os
-from botocore.config import Config
 
+from aws_clients import create_client
+from dead_letter import create_dead_letter_sink_from_environment, create_quarantine_sink_from_environment
+from dedup import create_deduplicator_from_environment
+from device_health import create_health_scorer_from_environment
+from device_metadata import create_resolver_from_environment
+from device_state import DeviceStateTracker
+from geo_tiles import TileAggregator
+from metrics import create_metrics_from_environment
+from payload_codecs import decode_envelope, decode_payload
+from rollups import WindowAggregator
+from telemetry_schema import PayloadValidator, RecordEncoder, load_schema
+from timestream_writer import TimestreamWriter, deadline_from_context
+
+init_checkpoint("imports")
 
 ### Often IoT devices do not include important metadata about the device in the telemetry payload.
 ### This could include the customer or location where the device is deployed or the id of the equipment being monitored
 ### This metadata is often stored in an applicatoin database such as DynamoDB or Aurora SQL
-### For simplicity here it is loaded from a local JSON file and added to the telemetry record in timestream
-with open(f"device-meta.json", encoding="utf-8") as meta:
-    deviceMeta = json.load(meta)
+### By default it is loaded from the local device-meta.json file, set DeviceMetadataTable to read it from DynamoDB.
+### Lookups go through an LRU/TTL cache that is reused across warm invocations
+metadata_resolver = create_resolver_from_environment()
+init_checkpoint("metadata")
+
+### devices without metadata are still written, just without the metadata measures
+NO_METADATA = {}
+
+### In multi-tenant mode TenantDimension names the metadata field (customerid) that is written as a dimension,
+### the partition key of the tables, instead of a measure. Derived records carry it as well, so per tenant
+### dashboards only read their own partition
+tenant_dimension = os.environ.get("TenantDimension")
+
+### The record layout is described in telemetry-schema.json and compiled once per container
+### Adding a sensor field only requires a schema change
+schema = load_schema()
+encoder = RecordEncoder(schema, dimension_metadata=(tenant_dimension,) if tenant_dimension else ())
+
+### Payloads are validated against the same schema before any network call. Timestamps must fall inside
+### the memory store window of the telemetry table (MemoryStoreRetentionHours, the Timestream default is 6)
+### Invalid payloads are quarantined with the reasons so one bad device cannot fail or poison a batch
+validator = PayloadValidator(schema, float(os.environ.get("MemoryStoreRetentionHours", "6")))
+quarantine_sink = create_quarantine_sink_from_environment()
+
+### Redelivered messages (IoT rule retries, QoS 1 redelivery, Lambda retries) are dropped before enrichment.
+### Keys of written messages are kept for DedupWindowSeconds, DedupTable shares them between instances
+deduplicator = create_deduplicator_from_environment()
+init_checkpoint("schema")
 
 ### Setup database connection outside handler for optimal reuse
 database = os.environ["TimestreamDatabase"]
 table = os.environ["TimestreamTable"]
 
-session = boto3.Session()
-write_client = session.client(
+### botocore only retries once on its own, TimestreamWriter retries within the invocation time budget
+write_client = create_client(
     "timestream-write",
-    config=Config(
-        read_timeout=20, max_pool_connections=5000, retries={"max_attempts": 10}
-    ),
+    read_timeout=20, max_pool_connections=5000, retries={"max_attempts": 2, "mode": "standard"},
+)
+init_checkpoint("client")
+
+### Permanently rejected records are sent to the dead-letter sink with a reason code
+### Large batches are written by up to WriteConcurrency threads sharing the client connection pool
+dead_letter_sink = create_dead_letter_sink_from_environment()
+writer = TimestreamWriter(
+    write_client, database, table, dead_letter_sink,
+    max_concurrency=int(os.environ.get("WriteConcurrency", "8")),
 )
 
+### Per device 1 minute and 1 hour aggregates are kept in memory and flushed to the rollup table,
+### so long range dashboard panels do not have to scan raw telemetry
+rollup_table = os.environ.get("RollupTable")
+rollup_aggregator = None
+rollup_writer = None
+if rollup_table:
+    rollup_aggregator = WindowAggregator(flush_interval=int(os.environ.get("RollupFlushSeconds", "60")))
+    rollup_writer = TimestreamWriter(write_client, database, rollup_table, dead_letter_sink)
+
+### The last known state of every device is written to the state table when it changed
+### or every StateHeartbeatSeconds, "fleet now" panels read it instead of raw history
+state_table = os.environ.get("StateTable")
+state_tracker = None
+state_writer = None
+if state_table:
+    state_tracker = DeviceStateTracker(heartbeat=int(os.environ.get("StateHeartbeatSeconds", "300")))
+    state_writer = TimestreamWriter(write_client, database, state_table, dead_letter_sink)
+
+### Streaming health estimators per device (drain rate, time to empty, signal percentiles, anomaly flags)
+### are written to the health table, "devices at risk" panels read them instead of scanning raw history.
+### Estimator state is checkpointed to HealthCheckpointTable so it survives cold starts
+health_table = os.environ.get("HealthTable")
+health_scorer = None
+health_writer = None
+if health_table:
+    health_scorer = create_health_scorer_from_environment()
+    health_writer = TimestreamWriter(write_client, database, health_table, dead_letter_sink)
+
+### Device counts and positions per geohash tile at a few zoom levels are written to the tile table,
+### so the fleet map reads one row per tile instead of raw positions
+tile_table = os.environ.get("GeoTileTable")
+tile_aggregator = None
+tile_writer = None
+if tile_table:
+    tile_aggregator = TileAggregator(
+        active_seconds=int(os.environ.get("GeoTileActiveSeconds", "3600")),
+        flush_interval=int(os.environ.get("GeoTileFlushSeconds", "60")),
+        tenant_dimension=tenant_dimension,
+    )
+    tile_writer = TimestreamWriter(write_client, database, tile_table, dead_letter_sink)
+init_checkpoint("writer")
+
+### Stage timings and counters are emitted as one Embedded Metric Format log line per invocation
+metrics = create_metrics_from_environment()
+cold_start = True
+
+init_timings["total"] = round(sum(init_timings.values()), 3)
+print("Init Timings: " + json.dumps(init_timings))
+
+
+def iter_messages(event):
+    ### yields (item identifier, message) for every telemetry message in the event
+    ### the IoT Rule sends a single payload per invocation, while SQS and Kinesis event sources
+    ### deliver a "Records" envelope and direct invocations may send a list of payloads
+    if isinstance(event, list):
+        for index, message in enumerate(event):
+            yield str(index), message
+    elif "Records" in event:
+        for index, record in enumerate(event["Records"]):
+            if "body" in record:
+                yield record["messageId"], record["body"]
+            elif "kinesis" in record:
+                yield record["kinesis"]["sequenceNumber"], base64.b64decode(record["kinesis"]["data"])
+            else:
+                yield str(index), record
+    else:
+        yield "0", event
+
+
+def parse_message(message):
+    ### JSON payloads arrive parsed from the IoT Rule, SQS and Kinesis records carry the rule output
+    ### as text or bytes, and the binary rule output wraps the base64 payload with its content type
+    if isinstance(message, bytes):
+        message = decode_payload(message)
+    elif not isinstance(message, dict):
+        message = json.loads(message)
+    if isinstance(message, dict) and "payload" in message and "deviceid" not in message:
+        return decode_envelope(message)
+    return message
+
+
+def raw_payload(message):
+    ### quarantined messages that could not be parsed are kept as text
+    if isinstance(message, bytes):
+        return message.decode("utf-8", "replace")
+    return message
+
+
+def build_record(telemetry, metadata):
+    return encoder.encode(telemetry, metadata or NO_METADATA)
+
+
+def add_tenant_dimension(records):
+    ### derived records are keyed by the deviceid dimension, the tenant is looked up through the metadata cache
+    if not tenant_dimension or not records:
+        return records
+    metadata = metadata_resolver.resolve_many({record["Dimensions"][0]["Value"] for record in records})
+    for record in records:
+        tenant = (metadata.get(record["Dimensions"][0]["Value"]) or NO_METADATA).get(tenant_dimension)
+        if tenant not in (None, ""):
+            record["Dimensions"].append({"Name": tenant_dimension, "Value": str(tenant)})
+    return records
+
+
+def write_order_key(record):
+    ### records of one tenant and then one device are written next to each other,
+    ### so the chunks can share those dimensions in CommonAttributes
+    device = record["Dimensions"][0]["Value"]
+    if tenant_dimension:
+        for dimension in record["Dimensions"]:
+            if dimension["Name"] == tenant_dimension:
+                return dimension["Value"], device
+    return "", device
+
+
+def count_reasons(entries):
+    reasons = {}
+    for _, code, _ in entries:
+        reasons[code] = reasons.get(code, 0) + 1
+    return reasons
+
 
 def lambda_handler(event, context):
-    ### lambda recieves IoT telemetry payload from IoT Rule. the Rule sends one payload even per invocation ###
-    telemetry = event
-
-    dimensions = [{"Name": "deviceid", "Value": telemetry["deviceid"]}]
-
-    equipmentid = deviceMeta[telemetry["deviceid"]]["equipmentid"]
-    customerid = deviceMeta[telemetry["deviceid"]]["customerid"]
-
-    ### Setup telemetry values record
-    values = {
-        "Dimensions": dimensions,
-        "MeasureName": "telemetry",
-        "MeasureValues": [
-            {
-                "Name": "temperature",
-                "Value": str(telemetry["temperature"]),
-                "Type": "BIGINT",
-            },
-            {
-                "Name": "signal_strength",
-                "Value": str(telemetry["signal_strength"]),
-                "Type": "DOUBLE",
-            },
-            {
-                "Name": "latitude",
-                "Value": str(telemetry["location"]["latitude"]),
-                "Type": "DOUBLE",
-            },
-            {
-                "Name": "longitude",
-                "Value": str(telemetry["location"]["longitude"]),
-                "Type": "DOUBLE",
-            },
-            {
-                "Name": "fuel_level",
-                "Value": str(telemetry["fuel_level"]),
-                "Type": "DOUBLE",
-            },
-            {
-                "Name": "battery_level",
-                "Value": str(telemetry["battery_level"]),
-                "Type": "DOUBLE",
-            },
-            {"Name": "equipmentid", "Value": equipmentid, "Type": "VARCHAR"},
-            {"Name": "customerid", "Value": customerid, "Type": "VARCHAR"},
-        ],
-        "MeasureValueType": "MULTI",
-        "Time": str(telemetry["timestamp"]),
-    }
-
-    records = [values]
-
-
-    ### Send telemetry to timestream as a single record
-    try:
-        result = write_client.write_records(
-            DatabaseName=database, TableName=table, Records=records, CommonAttributes={}
-        )
-        print(
-            "WriteRecords Status: [%s]" % result["ResponseMetadata"]["HTTPStatusCode"]
+    ### lambda recieves one IoT telemetry payload from the IoT Rule, or a batch of payloads ###
+    global cold_start
+    metrics.begin()
+    metrics.count("ColdStart", int(cold_start))
+    if cold_start:
+        metrics.timing("Init", init_timings["total"])
+        cold_start = False
+    if hasattr(context, "aws_request_id"):
+        metrics.set("RequestId", context.aws_request_id)
+    cache_hits, cache_misses = metadata_resolver.cache.hits, metadata_resolver.cache.misses
+
+    messages = []
+    records = []
+    record_items = []
+    record_messages = []
+    failures = []
+    quarantined = []
+
+    ### malformed and invalid payloads are quarantined, retrying them would not help
+    window = validator.window()
+    for item_id, message in iter_messages(event):
+        try:
+            telemetry = parse_message(message)
+        except Exception as err:
+            quarantined.append((raw_payload(message), "INVALID_PAYLOAD", "payload: " + str(err)))
+            continue
+        reasons = validator.validate(telemetry, window)
+        if reasons:
+            quarantined.append((telemetry, "INVALID_PAYLOAD", "; ".join(reasons)))
+            continue
+        messages.append((item_id, telemetry))
+
+    if quarantined:
+        quarantine_sink.send(quarantined, database, table)
+    metrics.count("Messages", len(messages) + len(quarantined))
+    metrics.count("Quarantined", len(quarantined))
+
+    ### duplicates of written messages are acknowledged without being written again
+    unique = deduplicator.filter(messages)
+    metrics.count("Duplicates", len(messages) - len(unique))
+    messages = unique
+    metrics.checkpoint("Parse")
+
+    ### look up metadata for every device in the batch at once
+    device_metadata = metadata_resolver.resolve_many(telemetry["deviceid"] for _, telemetry in messages)
+    metrics.count("MetadataCacheHits", metadata_resolver.cache.hits - cache_hits)
+    metrics.count("MetadataCacheMisses", metadata_resolver.cache.misses - cache_misses)
+    if health_scorer is not None:
+        health_scorer.restore_missing(telemetry["deviceid"] for _, telemetry in messages)
+        anomalies = health_scorer.anomalies
+    metrics.checkpoint("Enrich")
+
+    for item_id, telemetry in messages:
+        metadata = device_metadata.get(telemetry["deviceid"])
+        try:
+            records.append(build_record(telemetry, metadata))
+            record_items.append(item_id)
+            record_messages.append((telemetry, metadata))
+        except Exception as err:
+            print("Error:", item_id, err)
+            failures.append(item_id)
+
+    order = sorted(range(len(records)), key=lambda i: write_order_key(records[i]))
+    records = [records[i] for i in order]
+    record_items = [record_items[i] for i in order]
+    record_messages = [record_messages[i] for i in order]
+    metrics.count("EncodeErrors", len(failures))
+    metrics.checkpoint("Encode")
+
+    ### Send telemetry to timestream in chunks of up to 100 records, retrying throttled writes
+    result = writer.write(records, deadline_from_context(context))
+    failures.extend(record_items[index] for index, _, _ in result.failed)
+
+    ### records that ran out of retries stay unknown to the deduplicator so their redelivery is written
+    if result.failed:
+        failed_indexes = {index for index, _, _ in result.failed}
+        deduplicator.remember([record for index, record in enumerate(records) if index not in failed_indexes])
+    else:
+        deduplicator.remember(records)
+
+    ### the IoT Rule does not retry based on the response, so records that ran out of retries
+    ### are dead-lettered instead of being lost. Batching event sources retry the reported items.
+    if result.failed and not (isinstance(event, dict) and "Records" in event):
+        dead_letter_sink.send(
+            [(records[index], code, message) for index, code, message in result.failed], database, table
         )
-    except write_client.exceptions.RejectedRecordsException as err:
-        print("RejectedRecords: ", err)
-        for rr in err.response["RejectedRecords"]:
-            print("Rejected Index " + str(rr["RecordIndex"]) + ": " + rr["Reason"])
-        print("Other records were written successfully. ")
-    except Exception as err:
-        print("Error:", err)
-        pass
+    metrics.count("RecordsWritten", result.written)
+    metrics.count("RecordsRejected", len(result.dead_lettered))
+    metrics.count("RecordsFailed", len(result.failed))
+    metrics.count("Retries", result.retries)
+    metrics.count("WriteCalls", result.calls)
+    if result.failed or result.dead_lettered:
+        metrics.set("RejectionReasons", count_reasons(result.failed + result.dead_lettered))
+    metrics.checkpoint("Write")
+
+    ### derived data only sees written records. Failed items are redelivered and would be counted twice,
+    ### permanently rejected records are not in the raw table either
+    unwritten = {index for index, _, _ in result.failed + result.dead_lettered}
+    for index, (telemetry, metadata) in enumerate(record_messages):
+        if index in unwritten:
+            continue
+        if rollup_aggregator is not None:
+            rollup_aggregator.add(telemetry)
+        if state_tracker is not None:
+            state_tracker.update(telemetry)
+        if health_scorer is not None:
+            health_scorer.update(telemetry)
+        if tile_aggregator is not None:
+            tile_aggregator.add(telemetry, (metadata or NO_METADATA).get(tenant_dimension) if tenant_dimension else None)
+
+    ### rollups, device state, health and tiles are derived data, failures are dead-lettered but do not fail the telemetry items
+    if rollup_aggregator is not None:
+        rollup_records = add_tenant_dimension(rollup_aggregator.flush())
+        if rollup_records:
+            derived = rollup_writer.write(rollup_records, deadline_from_context(context))
+            metrics.count("RollupRecordsWritten", derived.written)
+    if state_tracker is not None:
+        state_records = add_tenant_dimension(state_tracker.flush())
+        if state_records:
+            derived = state_writer.write(state_records, deadline_from_context(context))
+            state_tracker.commit(state_records, {index for index, _, _ in derived.failed})
+            metrics.count("StateRecordsWritten", derived.written)
+    if health_scorer is not None:
+        metrics.count("HealthAnomalies", health_scorer.anomalies - anomalies)
+        health_records = add_tenant_dimension(health_scorer.flush())
+        if health_records:
+            derived = health_writer.write(health_records, deadline_from_context(context))
+            health_scorer.commit(health_records, {index for index, _, _ in derived.failed})
+            metrics.count("HealthRecordsWritten", derived.written)
+    if tile_aggregator is not None:
+        tile_records = tile_aggregator.flush()
+        if tile_records:
+            derived = tile_writer.write(tile_records, deadline_from_context(context))
+            metrics.count("TileRecordsWritten", derived.written)
+    metrics.checkpoint("Derived")
+    metrics.finish()
+
+    ### report failed items back so batching event sources only retry those messages
+    return {"batchItemFailures": [{"itemIdentifier": item_id} for item_id in dict.fromkeys(failures)]}
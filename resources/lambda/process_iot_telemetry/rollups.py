@@ -0,0 +1,145 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import time
+import uuid
+
+
+### tumbling window sizes in seconds keyed by the granularity dimension written to the rollup table
+ROLLUP_WINDOWS = {"1m": 60, "1h": 3600}
+
+### telemetry fields aggregated per window
+ROLLUP_FIELDS = ("battery_level", "fuel_level", "temperature", "signal_strength")
+
+### index of each statistic in a field's state list
+MIN, MAX, SUM, COUNT, LAST, LAST_TIME = range(6)
+
+
+class WindowAggregator:
+    ### Keeps per device tumbling window aggregates (min/max/sum/count/last) of telemetry fields
+    ###
+    ### Concurrent Lambda instances each see part of a device's messages, so every instance writes its
+    ### own partial aggregate, identified by the "partial" dimension. Dashboards combine partials with
+    ### min(min), max(max), sum(sum)/sum(count) and max_by(last, last_time).
+    ### Open windows are rewritten with a higher Version at most every flush_interval seconds, closed
+    ### windows are written a final time and evicted. A window closes once the newest event time seen is
+    ### past its end by allowed_lateness seconds; later messages are left out of the rollups (they are
+    ### still written to the raw table).
+
+    def __init__(self, fields=ROLLUP_FIELDS, windows=ROLLUP_WINDOWS, allowed_lateness=300, flush_interval=60,
+                 partial_id=None, clock=time.time):
+        self.fields = fields
+        self.windows = [(granularity, seconds * 1000) for granularity, seconds in windows.items()]
+        self.window_sizes = dict(self.windows)
+        self.allowed_lateness_ms = allowed_lateness * 1000
+        self.flush_interval = flush_interval
+        self.partial_id = partial_id or uuid.uuid4().hex[:12]
+        self.clock = clock
+        self.state = {}
+        self.dirty = set()
+        self.watermark = 0
+        self.last_flush = clock()
+        self.version = 0
+        self.late_messages = 0
+
+    def add(self, telemetry):
+        timestamp = int(telemetry["timestamp"])
+        if timestamp > self.watermark:
+            self.watermark = timestamp
+
+        device = telemetry["deviceid"]
+        for granularity, size in self.windows:
+            start = timestamp - timestamp % size
+            if start + size + self.allowed_lateness_ms <= self.watermark:
+                self.late_messages += 1
+                continue
+
+            key = (device, granularity, start)
+            window = self.state.get(key)
+            if window is None:
+                window = self.state[key] = {}
+            self.dirty.add(key)
+
+            for field in self.fields:
+                value = telemetry.get(field)
+                if value is None:
+                    continue
+                stats = window.get(field)
+                if stats is None:
+                    window[field] = [value, value, value, 1, value, timestamp]
+                    continue
+                if value < stats[MIN]:
+                    stats[MIN] = value
+                if value > stats[MAX]:
+                    stats[MAX] = value
+                stats[SUM] += value
+                stats[COUNT] += 1
+                if timestamp >= stats[LAST_TIME]:
+                    stats[LAST] = value
+                    stats[LAST_TIME] = timestamp
+
+    def next_version(self):
+        ### Timestream only replaces a record when the new Version is higher
+        self.version = max(self.version + 1, int(self.clock() * 1000))
+        return self.version
+
+    def build_record(self, key, window, version):
+        device, granularity, start = key
+        values = []
+        last_time = 0
+        for field, stats in window.items():
+            values.append({"Name": field + "_min", "Value": str(stats[MIN]), "Type": "DOUBLE"})
+            values.append({"Name": field + "_max", "Value": str(stats[MAX]), "Type": "DOUBLE"})
+            values.append({"Name": field + "_sum", "Value": str(stats[SUM]), "Type": "DOUBLE"})
+            values.append({"Name": field + "_count", "Value": str(stats[COUNT]), "Type": "BIGINT"})
+            values.append({"Name": field + "_last", "Value": str(stats[LAST]), "Type": "DOUBLE"})
+            last_time = max(last_time, stats[LAST_TIME])
+        values.append({"Name": "last_event_time", "Value": str(last_time), "Type": "BIGINT"})
+        return {
+            "Dimensions": [
+                {"Name": "deviceid", "Value": device},
+                {"Name": "granularity", "Value": granularity},
+                {"Name": "partial", "Value": self.partial_id},
+            ],
+            "MeasureName": "rollup",
+            "MeasureValueType": "MULTI",
+            "MeasureValues": values,
+            "Time": str(start),
+            "Version": version,
+        }
+
+    def flush(self, force=False):
+        ### returns rollup records to write: closed windows always, open windows once the flush interval passed
+        now = self.clock()
+        flush_open = force or now - self.last_flush >= self.flush_interval
+        if flush_open:
+            self.last_flush = now
+
+        version = self.next_version()
+        records = []
+        for key in list(self.state):
+            _, granularity, start = key
+            closed = start + self.window_sizes[granularity] + self.allowed_lateness_ms <= self.watermark
+            if key in self.dirty and (closed or flush_open):
+                if self.state[key]:
+                    records.append(self.build_record(key, self.state[key], version))
+                self.dirty.discard(key)
+            if closed:
+                del self.state[key]
+                self.dirty.discard(key)
+        return records
@@ -0,0 +1,246 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import json
+import math
+import time
+from operator import itemgetter
+
+
+### Formatters turn a payload value into the string representation Timestream expects for each type
+### str() matches what Timestream accepts for numbers and strings, only booleans need converting
+def _format_boolean(value):
+    return "true" if value else "false"
+
+
+FORMATTERS = {
+    "BIGINT": str,
+    "DOUBLE": str,
+    "BOOLEAN": _format_boolean,
+    "VARCHAR": str,
+    "TIMESTAMP": str,
+}
+
+### payload value types accepted for each Timestream type, bool is excluded from the numeric types on purpose
+VALUE_TYPES = {
+    "BIGINT": (int,),
+    "DOUBLE": (int, float),
+    "BOOLEAN": (bool,),
+    "VARCHAR": (str,),
+    "TIMESTAMP": (int,),
+}
+
+### Timestream accepts records up to 15 minutes in the future
+MAX_FUTURE_MS = 15 * 60 * 1000
+
+### static per device parts (dimensions and metadata measures) are cached up to this many devices
+STATIC_CACHE_SIZE = 100000
+
+
+def load_schema(path="telemetry-schema.json"):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def source_expression(source):
+    ### "location.latitude" -> t['location']['latitude']
+    return "t" + "".join("[%r]" % key for key in source.split("."))
+
+
+def compile_getter(source):
+    ### compile a dotted source path into a callable, used outside the generated encoder
+    getters = [itemgetter(key) for key in source.split(".")]
+    if len(getters) == 1:
+        return getters[0]
+
+    def getter(telemetry):
+        value = telemetry
+        for get in getters:
+            value = get(value)
+        return value
+
+    return getter
+
+
+def compile_encoder(schema):
+    ### Generate a function equivalent to a hand written record literal for this schema,
+    ### the same way collections.namedtuple builds its classes. Per message work is then
+    ### limited to reading and formatting the values that change.
+    namespace = {}
+    required = []
+    optional = []
+    for index, measure in enumerate(schema["measures"]):
+        formatter = "_format%d" % index
+        namespace[formatter] = FORMATTERS[measure["type"]]
+        value = "{'Name': %r, 'Value': %s(%s), 'Type': %r}" % (
+            measure["name"], formatter, source_expression(measure["source"]), measure["type"]
+        )
+        if measure.get("required", True):
+            required.append(value)
+        else:
+            optional.append((source_expression(measure["source"]), value))
+
+    lines = [
+        "def encode(t, static):",
+        "    dimensions, metadata_values = static",
+        "    values = [%s]" % ", ".join(required),
+    ]
+    for expression, value in optional:
+        lines += [
+            "    try:",
+            "        if %s is not None:" % expression,
+            "            values.append(%s)" % value,
+            "    except (KeyError, TypeError):",
+            "        pass",
+        ]
+    lines += [
+        "    values.extend(metadata_values)",
+        "    return {'Dimensions': dimensions, 'MeasureName': %r, 'MeasureValues': values,"
+        " 'MeasureValueType': 'MULTI', 'Time': str(%s)}"
+        % (schema["measure_name"], source_expression(schema["time"]["source"])),
+    ]
+    exec(compile("\n".join(lines), "<telemetry-schema>", "exec"), namespace)
+    return namespace["encode"]
+
+
+class RecordEncoder:
+    ### Encodes telemetry payloads into Timestream multi-measure records
+    ### The schema is compiled once per container, see compile_encoder
+    ### Metadata fields named in dimension_metadata (the tenant dimension in multi-tenant mode) are
+    ### written as dimensions after the schema dimensions instead of as measures
+
+    def __init__(self, schema, dimension_metadata=()):
+        self.schema = schema
+        self.key_getter = compile_getter(schema["dimensions"][0]["source"])
+        self.dimensions = [
+            (dimension["name"], compile_getter(dimension["source"]))
+            for dimension in schema["dimensions"]
+        ]
+        self.dimension_metadata = [name for name in dimension_metadata if name]
+        self.metadata = [
+            (field["name"], field["type"]) for field in schema.get("metadata", [])
+            if field["name"] not in self.dimension_metadata
+        ]
+        self.encode_values = compile_encoder(schema)
+        self.static_parts = {}
+
+    def static_part(self, telemetry, metadata):
+        ### dimensions and metadata measures are identical for every message from a device
+        ### so they are built once and shared between records. Metadata lookups return the
+        ### same object while it is unchanged, so an identity check is enough to reuse the part.
+        device = self.key_getter(telemetry)
+        cached = self.static_parts.get(device)
+        if cached is not None and cached[0] is metadata:
+            return cached[1]
+
+        if len(self.static_parts) >= STATIC_CACHE_SIZE:
+            self.static_parts.clear()
+        dimensions = [{"Name": name, "Value": str(get(telemetry))} for name, get in self.dimensions]
+        dimensions += [
+            {"Name": name, "Value": str(metadata[name])}
+            for name in self.dimension_metadata
+            if metadata.get(name) not in (None, "")
+        ]
+        metadata_values = [
+            {"Name": name, "Value": str(metadata[name]), "Type": measure_type}
+            for name, measure_type in self.metadata
+            if metadata.get(name) is not None
+        ]
+        part = (dimensions, metadata_values)
+        self.static_parts[device] = (metadata, part)
+        return part
+
+    def encode(self, telemetry, metadata):
+        return self.encode_values(telemetry, self.static_part(telemetry, metadata))
+
+
+def compile_validator(schema):
+    ### Generate a validation function for this schema, like compile_encoder. It returns the
+    ### list of reasons a payload would fail to encode or be rejected by Timestream, empty when valid.
+    namespace = {"_isfinite": math.isfinite}
+    lines = [
+        "def validate(t, earliest, latest):",
+        "    if t.__class__ is not dict:",
+        "        return ['payload: expected a JSON object']",
+        "    errors = []",
+    ]
+
+    def check(name, source, types, required, checks):
+        namespace["_types_" + name] = frozenset(types)
+        lines.extend([
+            "    try:",
+            "        v = %s" % source_expression(source),
+            "    except (KeyError, TypeError):",
+            "        %s" % ("errors.append(%r)" % (name + ": missing") if required else "pass"),
+            "    else:",
+        ])
+        if not required:
+            lines.append("        if v is None: pass")
+        lines.append("        %sif v.__class__ not in _types_%s:" % ("el" if not required else "", name))
+        lines.append("            errors.append(%r %% v.__class__.__name__)" % (
+            "%s: expected %s, got %%s" % (name, "/".join(t.__name__ for t in types))))
+        for condition, reason in checks:
+            lines.append("        elif %s:" % condition)
+            lines.append("            errors.append(%s)" % reason)
+
+    for dimension in schema["dimensions"]:
+        name = dimension["name"]
+        check(name, dimension["source"], (str,), True, [("not v", repr(name + ": empty"))])
+
+    time_source = schema["time"]["source"]
+    time_name = time_source.replace(".", "_")
+    check(time_name, time_source, (int,), True, [
+        ("v < earliest", "%r %% v" % (time_source + ": %d is older than the memory store window")),
+        ("v > latest", "%r %% v" % (time_source + ": %d is too far in the future")),
+    ])
+
+    for measure in schema["measures"]:
+        name = measure["name"]
+        checks = []
+        if measure["type"] == "DOUBLE":
+            checks.append(("not _isfinite(v)", repr(name + ": not a finite number")))
+        if measure.get("min") is not None:
+            checks.append(("v < %r" % measure["min"], "%r %% v" % ("%s: %%r is below %r" % (name, measure["min"]))))
+        if measure.get("max") is not None:
+            checks.append(("v > %r" % measure["max"], "%r %% v" % ("%s: %%r is above %r" % (name, measure["max"]))))
+        check(name, measure["source"], VALUE_TYPES[measure["type"]], measure.get("required", True), checks)
+
+    lines.append("    return errors")
+    exec(compile("\n".join(lines), "<telemetry-validator>", "exec"), namespace)
+    return namespace["validate"]
+
+
+class PayloadValidator:
+    ### Checks payloads against the schema before any network call: types, value ranges and
+    ### a timestamp inside the window Timestream accepts. memory_store_hours is the memory
+    ### store retention of the target table, older records would be rejected.
+
+    def __init__(self, schema, memory_store_hours, clock=time.time):
+        self.validate_values = compile_validator(schema)
+        self.max_past_ms = int(memory_store_hours * 3600 * 1000)
+        self.max_future_ms = schema["time"].get("max_future_ms", MAX_FUTURE_MS)
+        self.clock = clock
+
+    def window(self):
+        ### accepted (earliest, latest) timestamps, taken once per invocation
+        now = int(self.clock() * 1000)
+        return now - self.max_past_ms, now + self.max_future_ms
+
+    def validate(self, telemetry, window=None):
+        earliest, latest = window or self.window()
+        return self.validate_values(telemetry, earliest, latest)
@@ -0,0 +1,215 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+### Timestream accepts at most 100 records per WriteRecords call
+MAX_RECORDS_PER_WRITE = 100
+
+
+def chunk_records(records, size=MAX_RECORDS_PER_WRITE):
+    ### yield (offset, chunk) pairs so rejected indexes can be mapped back to the input list
+    for offset in range(0, len(records), size):
+        yield offset, records[offset:offset + size]
+
+
+def build_common_attributes(records):
+    ### hoist attributes shared by every record in the chunk into CommonAttributes
+    ### this shrinks the request body and the per-record parsing done by Timestream
+    common = {}
+    shared_keys = ("MeasureName", "MeasureValueType", "TimeUnit")
+
+    first = records[0]
+    for key in shared_keys:
+        if key in first and all(record.get(key) == first[key] for record in records):
+            common[key] = first[key]
+
+    ### dimensions are hoisted one at a time, so a chunk spanning several devices still shares
+    ### the ones they have in common, such as the customer in the multi-tenant mode
+    dimensions = [
+        dimension for dimension in first.get("Dimensions", ())
+        if all(dimension in record.get("Dimensions", ()) for record in records)
+    ]
+    if dimensions:
+        common["Dimensions"] = dimensions
+
+    if not common:
+        return common, records
+
+    stripped = []
+    for record in records:
+        item = {key: value for key, value in record.items() if key not in common}
+        if dimensions:
+            remaining = [dimension for dimension in record["Dimensions"] if dimension not in dimensions]
+            if remaining:
+                item["Dimensions"] = remaining
+        stripped.append(item)
+    return common, stripped
+
+
+### Timestream error codes worth retrying, everything else is treated as permanent
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "InternalServerException",
+    "ServiceUnavailableException",
+    "RequestTimeout",
+    "RequestTimeoutException",
+}
+
+### botocore raises these for network level failures, they are retryable as well
+RETRYABLE_EXCEPTION_NAMES = {
+    "ReadTimeoutError",
+    "ConnectTimeoutError",
+    "EndpointConnectionError",
+    "ConnectionClosedError",
+}
+
+WriteResult = namedtuple("WriteResult", ["written", "failed", "dead_lettered", "retries", "calls"])
+
+
+def rejection_reason_code(rejected_record):
+    ### map a RejectedRecords entry to a short reason code for the dead-letter sink
+    reason = rejected_record.get("Reason", "").lower()
+    if "ExistingVersion" in rejected_record or "version" in reason:
+        return "VERSION_CONFLICT"
+    if "retention" in reason or "memory store" in reason or "time range" in reason:
+        return "OUT_OF_RETENTION"
+    return "INVALID_RECORD"
+
+
+def classify_exception(err):
+    ### returns (reason code, retryable) for an exception raised by write_records
+    code = getattr(err, "response", {}).get("Error", {}).get("Code")
+    if code:
+        return code, code in RETRYABLE_ERROR_CODES
+    name = type(err).__name__
+    return name, name in RETRYABLE_EXCEPTION_NAMES
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    ### exponential backoff with full jitter
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class TimestreamWriter:
+    ### Writes records to a Timestream table in 100 record chunks
+    ### Retryable failures (throttling, transient errors) are resubmitted with jittered exponential backoff
+    ### until max_attempts or the deadline is reached. Permanently rejected records go to the dead-letter sink.
+    ### Chunks are written in parallel by up to max_concurrency threads sharing the pooled client.
+
+    def __init__(self, write_client, database, table, dead_letter_sink=None,
+                 max_attempts=6, base_delay=0.05, max_delay=2.0, max_concurrency=8):
+        self.write_client = write_client
+        self.database = database
+        self.table = table
+        self.dead_letter_sink = dead_letter_sink
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.executor = None
+
+    def write_chunks(self, records, chunks):
+        ### write the chunks of record indexes concurrently, returns one failure list per chunk in order
+        if len(chunks) == 1 or self.max_concurrency <= 1:
+            return [self.write_chunk([records[i] for i in chunk]) for chunk in chunks]
+
+        ### the executor is created once and reused across warm invocations
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        futures = [self.executor.submit(self.write_chunk, [records[i] for i in chunk]) for chunk in chunks]
+        return [future.result() for future in futures]
+
+    def write_chunk(self, records):
+        ### write up to 100 records, returns a list of (index, reason code, message, retryable)
+        ### for records that were not written. Successful writes are reported by the invocation metrics.
+        common, stripped = build_common_attributes(records)
+        try:
+            self.write_client.write_records(
+                DatabaseName=self.database, TableName=self.table, Records=stripped, CommonAttributes=common
+            )
+            return []
+        except self.write_client.exceptions.RejectedRecordsException as err:
+            print("RejectedRecords: ", err)
+            failures = []
+            for rr in err.response["RejectedRecords"]:
+                print("Rejected Index " + str(rr["RecordIndex"]) + ": " + rr["Reason"])
+                failures.append((rr["RecordIndex"], rejection_reason_code(rr), rr["Reason"], False))
+            print("Other records were written successfully. ")
+            return failures
+        except Exception as err:
+            code, retryable = classify_exception(err)
+            print("Error:", code, err)
+            return [(index, code, str(err), retryable) for index in range(len(records))]
+
+    def write(self, records, deadline=None):
+        ### write any number of records, deadline is a time.monotonic() value after which no retry is started
+        ### returns a WriteResult where failed and dead_lettered hold (index, reason code, message)
+        ### entries indexing the input records list
+        failed = []
+        dead_lettered = []
+        retries = 0
+        calls = 0
+        pending = list(range(len(records)))
+        attempt = 0
+
+        while pending:
+            retry = []
+            chunks = [chunk for _, chunk in chunk_records(pending)]
+            calls += len(chunks)
+            for chunk, chunk_failures in zip(chunks, self.write_chunks(records, chunks)):
+                for index, code, message, retryable in chunk_failures:
+                    entry = (chunk[index], code, message)
+                    if retryable:
+                        retry.append(entry)
+                    else:
+                        dead_lettered.append(entry)
+
+            if not retry:
+                break
+
+            attempt += 1
+            delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+            if attempt >= self.max_attempts or (deadline is not None and time.monotonic() + delay >= deadline):
+                failed.extend(retry)
+                break
+
+            retries += len(retry)
+            time.sleep(delay)
+            pending = [index for index, _, _ in retry]
+
+        if dead_lettered and self.dead_letter_sink is not None:
+            self.dead_letter_sink.send(
+                [(records[index], code, message) for index, code, message in dead_lettered],
+                self.database,
+                self.table,
+            )
+
+        written = len(records) - len(failed) - len(dead_lettered)
+        return WriteResult(written, failed, dead_lettered, retries, calls)
+
+
+def deadline_from_context(context, safety_margin_ms=1000):
+    ### stop starting retries once less than the safety margin of the invocation time is left
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return time.monotonic() + (context.get_remaining_time_in_millis() - safety_margin_ms) / 1000.0
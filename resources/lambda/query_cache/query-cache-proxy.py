@@ -0,0 +1,107 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import base64
+import hmac
+import json
+import os
+
+from query_cache import create_query_cache_from_environment
+
+### Lambda function URL that speaks the Timestream Query JSON protocol, registered as the custom endpoint
+### of the Grafana Timestream data source. Query requests are served by the coalescing cache in
+### query_cache.py. Every request must carry the token stored in QueryCacheTokenSecret in the
+### x-query-cache-token header, which the data source sends as a custom HTTP header. Without a
+### configured token every request is denied. The function role only allows timestream:Select on
+### the telemetry database.
+
+JSON_CONTENT_TYPE = "application/x-amz-json-1.0"
+TOKEN_HEADER = "x-query-cache-token"
+
+query_cache = create_query_cache_from_environment()
+
+
+def load_token():
+    ### QueryCacheToken is used as is, e.g. for local runs, QueryCacheTokenSecret is read from Secrets Manager
+    if os.environ.get("QueryCacheToken"):
+        return os.environ["QueryCacheToken"]
+    secret_id = os.environ.get("QueryCacheTokenSecret")
+    if not secret_id:
+        return ""
+    from aws_clients import create_client
+
+    return create_client("secretsmanager").get_secret_value(SecretId=secret_id)["SecretString"]
+
+
+token = load_token()
+
+
+def respond(status, body):
+    return {
+        "statusCode": status,
+        "headers": {"Content-Type": JSON_CONTENT_TYPE},
+        "body": json.dumps(body, separators=(",", ":")),
+    }
+
+
+def error(status, code, message):
+    return respond(status, {"__type": code, "message": message})
+
+
+def handle(operation, request, host):
+    if operation == "Query":
+        return respond(200, query_cache.query(request["QueryString"], NextToken=request.get("NextToken"),
+                                              MaxRows=request.get("MaxRows")))
+    if operation == "DescribeEndpoints":
+        ### SDKs that use endpoint discovery are pointed back at this function
+        return respond(200, {"Endpoints": [{"Address": host, "CachePeriodInMinutes": 1440}]})
+    if operation == "CancelQuery":
+        ### queries run to completion so their result can be cached for other viewers
+        return respond(200, {"CancellationMessage": "Query results are cached, the query was not cancelled"})
+    return error(400, "ValidationException", "Operation %s is not supported by the query cache" % operation)
+
+
+def authorized(headers):
+    ### fail closed, a function deployed without a token would otherwise serve anyone who finds its url
+    return bool(token) and hmac.compare_digest(headers.get(TOKEN_HEADER, "").encode("utf-8"), token.encode("utf-8"))
+
+
+# lambda handler
+def lambda_handler(event, context):
+    headers = {name.lower(): value for name, value in (event.get("headers") or {}).items()}
+    if not authorized(headers):
+        return error(403, "AccessDeniedException", "Invalid query cache token")
+
+    operation = headers.get("x-amz-target", "").rpartition(".")[2]
+    body = event.get("body") or "{}"
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body).decode("utf-8")
+
+    try:
+        return handle(operation, json.loads(body), headers.get("host", ""))
+    except ValueError as err:
+        return error(400, "ValidationException", str(err))
+    except KeyError as err:
+        return error(400, "ValidationException", "Missing parameter %s" % err)
+    except Exception as err:
+        ### pass Timestream errors such as throttling through so the client retries them
+        response = getattr(err, "response", None)
+        if response is None:
+            raise
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode", 400)
+        return error(status, response["Error"]["Code"], response["Error"].get("Message", ""))
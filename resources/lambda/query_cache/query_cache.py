@@ -0,0 +1,620 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+import base64
+import calendar
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+NS_PER_SECOND = 10 ** 9
+
+### responses are split into pages of at most this many bytes of rows, far below the 6MB response
+### limit of Lambda function URLs, like Timestream the pages are continued with NextToken
+PAGE_BYTES = 1000000
+DURATION_UNITS = {"ns": 1, "us": 10 ** 3, "ms": 10 ** 6, "s": NS_PER_SECOND, "m": 60 * NS_PER_SECOND,
+                  "h": 3600 * NS_PER_SECOND, "d": 86400 * NS_PER_SECOND}
+DATE_TRUNC_UNITS = {"second": NS_PER_SECOND, "minute": 60 * NS_PER_SECOND, "hour": 3600 * NS_PER_SECOND,
+                    "day": 86400 * NS_PER_SECOND}
+
+### string literals and quoted identifiers are kept as they are, comments and whitespace runs are collapsed
+QUERY_TOKENS = re.compile(r"('(?:[^']|'')*')|(\"(?:[^\"]|\"\")*\")|((?:\s|--[^\n]*|/\*.*?\*/)+)", re.S)
+
+DURATION = r"\d+(?:\.\d+)?(?:ns|us|ms|s|m|h|d)"
+TIME_EXPRESSION = (r"(?:ago\(\s*" + DURATION + r"\s*\)|now\(\s*\)|from_iso8601_timestamp\(\s*'[^']*'\s*\)"
+                   r"|from_milliseconds\(\s*\d+\s*\))")
+TIME_PREDICATE = re.compile(
+    r"\btime\s+between\s+(?P<start>" + TIME_EXPRESSION + r")\s+and\s+(?P<end>" + TIME_EXPRESSION + r")"
+    r"|\btime\s*>=?\s*(?P<lower>" + TIME_EXPRESSION + r")(?!\s*[-+])", re.I)
+TIME_COLUMN = re.compile(
+    r"(?P<expression>time|bin\(\s*time\s*,\s*(?P<bin>" + DURATION + r")\s*\)"
+    r"|date_trunc\(\s*'(?P<unit>\w+)'\s*,\s*time\s*\))(?:\s+as\s+(?P<alias>\"[^\"]+\"|\w+))?", re.I)
+AGGREGATE = re.compile(r"\b(avg|sum|min|max|count|count_if|max_by|min_by|approx_percentile|approx_distinct|"
+                       r"arbitrary|stddev|variance|array_agg|bool_and|bool_or|geometric_mean)\s*\(", re.I)
+VOLATILE = re.compile(r"\b(ago|now|current_timestamp|current_date)\b", re.I)
+CLAUSES = re.compile(r"\b(select|from|where|group by|having|order by|limit)\b")
+TABLE = re.compile(r'\bfrom\s+"[^"]+"\s*\.\s*"(?P<table>[^"]+)"', re.I)
+
+
+def normalize_query(sql):
+    ### identical queries from different dashboards and viewers normalize to the same text
+    def replace(match):
+        if match.group(3):
+            return " "
+        return match.group(0)
+
+    return QUERY_TOKENS.sub(replace, sql).strip().rstrip(";").strip()
+
+
+def parse_duration(text):
+    match = re.match(r"(\d+(?:\.\d+)?)(ns|us|ms|s|m|h|d)$", text)
+    return int(float(match.group(1)) * DURATION_UNITS[match.group(2)])
+
+
+def parse_iso8601(text):
+    ### from_iso8601_timestamp() literals as written by the Grafana $__timeFilter macro, UTC only
+    match = re.match(r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?(?:Z|\+00:?00)?$", text)
+    if not match:
+        raise ValueError("unsupported timestamp %r" % text)
+    seconds = calendar.timegm(tuple(int(part) for part in match.groups()[:6]))
+    return seconds * NS_PER_SECOND + int((match.group(7) or "0").ljust(9, "0"))
+
+
+def evaluate_time(expression, now_ns):
+    name, _, argument = expression.partition("(")
+    argument = argument.rstrip(")").strip()
+    name = name.strip().lower()
+    if name == "ago":
+        return now_ns - parse_duration(argument)
+    if name == "now":
+        return now_ns
+    if name == "from_milliseconds":
+        return int(argument) * 10 ** 6
+    return parse_iso8601(argument.strip("'"))
+
+
+def iso8601(ns):
+    seconds, fraction = divmod(ns, NS_PER_SECOND)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + ".%03dZ" % (fraction // 10 ** 6)
+
+
+def timestream_time(ns):
+    ### timestamps in query results look like "2024-01-01 00:00:00.000000000" and sort as text
+    seconds, fraction = divmod(ns, NS_PER_SECOND)
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds)) + ".%09d" % fraction
+
+
+def range_predicate(start_ns, end_ns):
+    return "time BETWEEN from_iso8601_timestamp('%s') AND from_iso8601_timestamp('%s')" % (
+        iso8601(start_ns), iso8601(end_ns))
+
+
+def top_level(sql):
+    ### lower cased copy of sql with literals and everything inside parentheses masked out
+    masked = []
+    depth = 0
+    quote = None
+    for char in sql.lower():
+        if quote:
+            masked.append("_")
+            if char == quote:
+                quote = None
+            continue
+        if char in "'\"":
+            quote = char
+            masked.append("_")
+        elif char == "(":
+            depth += 1
+            masked.append("_")
+        elif char == ")":
+            depth -= 1
+            masked.append("_")
+        else:
+            masked.append(char if depth == 0 else "_")
+    return "".join(masked)
+
+
+def split_top_level(text):
+    masked = top_level(text)
+    parts = []
+    start = 0
+    for index, char in enumerate(masked):
+        if char == ",":
+            parts.append(text[start:index].strip())
+            start = index + 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+def parse_clauses(sql):
+    ### {"select": ..., "from": ..., "where": ...} of the outermost query, None for nested or compound queries
+    masked = top_level(sql)
+    found = [(match.group(1), match.start(), match.end()) for match in CLAUSES.finditer(masked)]
+    names = [name for name, _, _ in found]
+    if not names or names[0] != "select" or len(names) != len(set(names)):
+        return None
+    clauses = {}
+    for index, (name, _, end) in enumerate(found):
+        stop = found[index + 1][1] if index + 1 < len(found) else len(sql)
+        clauses[name] = sql[end:stop].strip()
+    return clauses
+
+
+class TimePartition:
+    ### Describes a query whose result rows each belong to one time bucket: the time column (time,
+    ### bin(time, ...) or date_trunc(..., time)) is selected, and grouped by when the query aggregates.
+    ### Such results can be updated for a sliding window by re-querying only the newest buckets.
+
+    def __init__(self, index, bucket_ns, descending, limit):
+        self.index = index
+        self.bucket_ns = bucket_ns
+        self.descending = descending
+        self.limit = limit
+
+    def row_time(self, row):
+        return row["Data"][self.index].get("ScalarValue") or ""
+
+
+def find_time_partition(sql, predicate):
+    lowered = sql.lower()
+    if lowered.count("select") != 1 or re.search(r"\b(join|union|intersect|except|over)\b", lowered):
+        return None
+    clauses = parse_clauses(sql)
+    if clauses is None or "where" not in clauses or predicate.group(0) not in clauses["where"]:
+        return None
+
+    items = split_top_level(clauses["select"])
+    if any(item == "*" or item.endswith(".*") for item in items):
+        return None
+    for index, item in enumerate(items):
+        column = TIME_COLUMN.fullmatch(item)
+        if column:
+            break
+    else:
+        return None
+    names = {re.sub(r"\s", "", column.group("expression").lower()), str(index + 1)}
+    if column.group("alias"):
+        names.add(column.group("alias").lower())
+    if column.group("bin"):
+        bucket_ns = parse_duration(column.group("bin").lower())
+    elif column.group("unit"):
+        bucket_ns = DATE_TRUNC_UNITS.get(column.group("unit").lower())
+        if bucket_ns is None:
+            return None
+    else:
+        bucket_ns = 0
+
+    if "group by" in clauses:
+        if not any(re.sub(r"\s", "", key.lower()) in names for key in split_top_level(clauses["group by"])):
+            return None
+    elif AGGREGATE.search(clauses["select"]) or "having" in clauses:
+        return None
+
+    descending = False
+    if "order by" in clauses:
+        keys = split_top_level(clauses["order by"])
+        order = re.fullmatch(r"(.+?)(?:\s+(asc|desc))?", keys[0], re.I)
+        if len(keys) != 1 or re.sub(r"\s", "", order.group(1).lower()) not in names:
+            return None
+        descending = (order.group(2) or "").lower() == "desc"
+
+    limit = None
+    if "limit" in clauses:
+        if not clauses["limit"].isdigit():
+            return None
+        limit = int(clauses["limit"])
+    return TimePartition(index, bucket_ns, descending, limit)
+
+
+class QueryPlan:
+    ### How a query is cached: its key, the aligned time range and, for sliding windows, how to reuse results
+
+    def __init__(self, sql, key, expires, late_ns, template_key=None, start_ns=None, end_ns=None, template=None,
+                 partition=None):
+        self.sql = sql
+        self.key = key
+        self.expires = expires
+        self.late_ns = late_ns
+        self.template_key = template_key
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.template = template
+        self.partition = partition
+
+    def range_sql(self, start_ns, end_ns):
+        return self.template.replace("{range}", range_predicate(start_ns, end_ns))
+
+
+def digest(*parts):
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def plan_query(sql, now_ns, align_ns, late_ns, settled_ttl_ns, table_late_ns=None):
+    ### The time range of the query is resolved against now and widened to align_ns boundaries: the start
+    ### is moved down (to a bucket boundary when the query bins by time) and the end up to the next
+    ### boundary. Viewers refreshing within the same align_ns interval then send the same query, and its
+    ### result stays fresh until the aligned end has passed. Rows of a table can still change late_ns
+    ### after their timestamp (table_late_ns overrides it per table name), so ranges that ended earlier
+    ### than that no longer change and are kept for settled_ttl_ns.
+    normalized = normalize_query(sql)
+    bucket = now_ns - now_ns % align_ns
+    table = TABLE.search(normalized)
+    if table and table_late_ns:
+        late_ns = table_late_ns.get(table.group("table"), late_ns)
+    predicates = list(TIME_PREDICATE.finditer(normalized))
+    if len(predicates) != 1:
+        ### no single time range, cache the query for the current interval
+        return QueryPlan(normalized, digest(normalized, bucket), bucket + align_ns, late_ns)
+
+    predicate = predicates[0]
+    template = normalized[:predicate.start()] + "{range}" + normalized[predicate.end():]
+    partition = find_time_partition(normalized, predicate)
+    if predicate.group("lower"):
+        start_ns, end_ns = evaluate_time(predicate.group("lower"), now_ns), now_ns
+    else:
+        start_ns, end_ns = evaluate_time(predicate.group("start"), now_ns), evaluate_time(predicate.group("end"), now_ns)
+
+    step = max(align_ns, partition.bucket_ns) if partition else align_ns
+    start_ns -= start_ns % step
+    end_ns = end_ns - end_ns % align_ns + align_ns
+    if end_ns + late_ns < now_ns:
+        expires = now_ns + settled_ttl_ns
+    else:
+        expires = end_ns
+
+    rewritten = template.replace("{range}", range_predicate(start_ns, end_ns))
+    key = digest(rewritten, bucket if VOLATILE.search(template) else "")
+    if VOLATILE.search(template):
+        ### ago() or now() outside the time range, the result is only valid for the current interval
+        expires = min(expires, bucket + align_ns)
+        partition = None
+    return QueryPlan(rewritten, key, expires, late_ns, digest(template), start_ns, end_ns, template, partition)
+
+
+class MemoryCacheStore:
+    ### LRU of cache entries in this process
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DynamoDBCacheStore:
+    ### Shares cache entries and query leases between Lambda instances through a table with a "key"
+    ### partition key. Entries are stored zlib compressed and skipped when they exceed max_item_bytes.
+    ### Items expire through the "expires" TTL attribute, readers check freshness themselves.
+    ### client is a boto3 DynamoDB client or any object with the same get_item/put_item/update_item/delete_item methods
+
+    def __init__(self, client, table_name, max_item_bytes=350000, ttl=3600):
+        self.client = client
+        self.table_name = table_name
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+
+    def get(self, key):
+        response = self.client.get_item(TableName=self.table_name, Key={"key": {"S": key}}, ConsistentRead=True)
+        item = response.get("Item")
+        if item is None or "value" not in item:
+            return None
+        return json.loads(zlib.decompress(item["value"]["B"]))
+
+    def put(self, key, entry):
+        value = zlib.compress(json.dumps(entry, separators=(",", ":")).encode("utf-8"))
+        if len(value) > self.max_item_bytes:
+            return False
+        self.client.put_item(TableName=self.table_name, Item={
+            "key": {"S": key},
+            "value": {"B": value},
+            "expires": {"N": str(int(time.time()) + self.ttl)},
+        })
+        return True
+
+    def acquire(self, key, lease_seconds):
+        ### returns True when this instance may run the query, False while another instance holds the lease
+        now = time.time()
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={"key": {"S": "lease#" + key}},
+                UpdateExpression="SET lease_until = :until, expires = :expires",
+                ConditionExpression="attribute_not_exists(lease_until) OR lease_until < :now",
+                ExpressionAttributeValues={
+                    ":until": {"N": repr(now + lease_seconds)},
+                    ":now": {"N": repr(now)},
+                    ":expires": {"N": str(int(now) + self.ttl)},
+                },
+            )
+            return True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def release(self, key):
+        self.client.delete_item(TableName=self.table_name, Key={"key": {"S": "lease#" + key}})
+
+
+class QueryCache:
+    ### Serves Timestream queries from dashboards that many viewers refresh at the same time:
+    ###   coalescing  - identical queries in flight share one upstream query, within this process through
+    ###                 futures and across Lambda instances through leases in the optional shared store
+    ###   alignment   - time ranges are aligned to align_seconds, see plan_query, so refreshes of different
+    ###                 viewers map to the same entry, which is fresh until the aligned range end
+    ###   tail reuse  - for queries with one row per time bucket (see TimePartition) whose window slid
+    ###                 forward, the previous result is kept and only buckets newer than its end minus
+    ###                 late_seconds are queried again, late_seconds covers ingestion delays and
+    ###                 table_late_seconds tables whose rows are updated after their timestamp, e.g. rollups
+    ###   pagination  - results larger than page_bytes are returned in pages, see response
+    ### client is a boto3 timestream-query client or any object with the same query method.
+    ### The shared store is an optimization, queries are run directly when it fails.
+
+    def __init__(self, client, store=None, shared=None, align_seconds=10, late_seconds=60, table_late_seconds=None,
+                 settled_ttl=300, reuse_seconds=3600, lease_seconds=10, page_bytes=PAGE_BYTES, clock=time.time,
+                 sleep=time.sleep):
+        self.client = client
+        self.store = store if store is not None else MemoryCacheStore()
+        self.shared = shared
+        self.align_ns = int(align_seconds * NS_PER_SECOND)
+        self.late_ns = int(late_seconds * NS_PER_SECOND)
+        self.table_late_ns = {
+            table: int(seconds * NS_PER_SECOND) for table, seconds in (table_late_seconds or {}).items()
+        }
+        self.settled_ttl_ns = int(settled_ttl * NS_PER_SECOND)
+        self.reuse_ns = int(reuse_seconds * NS_PER_SECOND)
+        self.lease_seconds = lease_seconds
+        self.page_bytes = page_bytes
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.stats = {"requests": 0, "hits": 0, "sharedHits": 0, "coalesced": 0, "incremental": 0,
+                      "upstreamQueries": 0, "upstreamRows": 0, "bytesScanned": 0, "pageMisses": 0}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def query(self, QueryString, NextToken=None, MaxRows=None, **kwargs):
+        ### same request and response shape as the Timestream Query API, pages of at most MaxRows rows
+        ### and page_bytes bytes are continued with a NextToken that refers to the cached result
+        if NextToken:
+            return self.next_page(NextToken, MaxRows)
+        now_ns = int(self.clock() * NS_PER_SECOND)
+        plan = plan_query(QueryString, now_ns, self.align_ns, self.late_ns, self.settled_ttl_ns, self.table_late_ns)
+        self.count("requests")
+
+        entry = self.store.get(plan.key)
+        if entry is not None and entry["expires"] > now_ns:
+            self.count("hits")
+            return self.response(plan.key, plan.sql, entry, 0, MaxRows)
+
+        with self.lock:
+            future = self.in_flight.get(plan.key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[plan.key] = Future()
+        if not leader:
+            self.count("coalesced")
+            return self.response(plan.key, plan.sql, future.result(), 0, MaxRows)
+
+        try:
+            entry = self.fill(plan, now_ns)
+            future.set_result(entry)
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[plan.key]
+        return self.response(plan.key, plan.sql, entry, 0, MaxRows)
+
+    def response(self, key, sql, entry, offset, max_rows=None):
+        rows = entry["rows"]
+        end = self.page_end(entry, offset, max_rows)
+        response = {
+            "QueryId": entry.get("id") or uuid.uuid4().hex,
+            "Rows": rows[offset:end] if offset or end < len(rows) else rows,
+            "ColumnInfo": entry["columns"],
+            "QueryStatus": {"ProgressPercentage": 100.0, "CumulativeBytesScanned": 0, "CumulativeBytesMetered": 0},
+        }
+        if end < len(rows):
+            ### the token carries the aligned query, so a page whose entry was evicted or replaced
+            ### can still be served by running the same query again
+            token = {"key": key, "sql": sql, "id": entry.get("id"), "offset": end, "expires": entry["expires"]}
+            response["NextToken"] = base64.urlsafe_b64encode(
+                json.dumps(token, separators=(",", ":")).encode("utf-8")).decode("ascii")
+        return response
+
+    def page_end(self, entry, offset, max_rows):
+        ### index after the last row of the page starting at offset, at least one row per page
+        rows = entry["rows"]
+        end = len(rows) if not max_rows else min(len(rows), offset + int(max_rows))
+        if offset == 0 and entry.get("bytes", self.page_bytes + 1) <= self.page_bytes:
+            return end
+        size = 0
+        for index in range(offset, end):
+            size += len(json.dumps(rows[index], separators=(",", ":")))
+            if size > self.page_bytes and index > offset:
+                return index
+        return end
+
+    def next_page(self, token, max_rows=None):
+        try:
+            page = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+            key, sql, entry_id, offset, expires = page["key"], page["sql"], page["id"], page["offset"], page["expires"]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise ValueError("Invalid NextToken")
+        entry = self.store.get(key)
+        if (entry is None or entry.get("id") != entry_id) and self.shared is not None:
+            entry = self.shared_call("get", key)
+        if entry is None or entry.get("id") != entry_id:
+            ### the first page came from an entry this instance no longer has
+            self.count("pageMisses")
+            columns, rows = self.run(sql)
+            entry = self.new_entry(columns, rows, False)
+            entry["expires"] = expires
+            self.store.put(key, entry)
+        return self.response(key, sql, entry, offset, max_rows)
+
+    def new_entry(self, columns, rows, truncated):
+        return {"id": uuid.uuid4().hex, "columns": columns, "rows": rows, "truncated": truncated,
+                "bytes": len(json.dumps(rows, separators=(",", ":")))}
+
+    def shared_call(self, method, *args):
+        try:
+            return getattr(self.shared, method)(*args)
+        except Exception as err:
+            print("Error: shared query cache %s failed:" % method, err)
+            return None
+
+    def fill(self, plan, now_ns):
+        if self.shared is None:
+            return self.execute(plan, now_ns)
+
+        entry = self.shared_call("get", plan.key)
+        if entry is not None and entry["expires"] > now_ns:
+            self.count("sharedHits")
+            self.store.put(plan.key, entry)
+            return entry
+
+        leased = self.shared_call("acquire", plan.key, self.lease_seconds)
+        if leased is False:
+            ### another instance runs this query, wait for its result until the lease runs out
+            deadline = time.monotonic() + self.lease_seconds
+            while time.monotonic() < deadline:
+                self.sleep(0.05)
+                entry = self.shared_call("get", plan.key)
+                if entry is not None and entry["expires"] > now_ns:
+                    self.count("sharedHits")
+                    self.store.put(plan.key, entry)
+                    return entry
+        try:
+            entry = self.execute(plan, now_ns)
+            self.shared_call("put", plan.key, entry)
+            if plan.partition is not None:
+                self.shared_call("put", plan.template_key, entry)
+        finally:
+            if leased:
+                self.shared_call("release", plan.key)
+        return entry
+
+    def previous_window(self, plan, now_ns):
+        ### the newest result of the same query over an earlier window, if it can be extended
+        if plan.partition is None:
+            return None
+        previous = self.store.get(plan.template_key)
+        if previous is None and self.shared is not None:
+            previous = self.shared_call("get", plan.template_key)
+        if (previous is None or previous.get("truncated") or previous["end"] < now_ns - self.reuse_ns
+                or previous["start"] > plan.start_ns or previous["end"] > plan.end_ns):
+            return None
+        return previous
+
+    def execute(self, plan, now_ns):
+        partition = plan.partition
+        previous = self.previous_window(plan, now_ns)
+        entry = None
+        if previous is not None:
+            step = max(partition.bucket_ns, NS_PER_SECOND)
+            tail_ns = previous["end"] - plan.late_ns
+            tail_ns -= tail_ns % step
+            if tail_ns > plan.start_ns:
+                columns, rows = self.run(plan.range_sql(tail_ns, plan.end_ns))
+                if partition.limit is None or len(rows) < partition.limit:
+                    entry = self.merge(plan, previous, columns, rows, tail_ns)
+                    self.count("incremental")
+        if entry is None:
+            columns, rows = self.run(plan.sql)
+            entry = self.new_entry(columns, rows,
+                                   partition is not None and partition.limit is not None and len(rows) >= partition.limit)
+        entry.update(expires=plan.expires, start=plan.start_ns, end=plan.end_ns)
+
+        self.store.put(plan.key, entry)
+        if partition is not None:
+            self.store.put(plan.template_key, entry)
+        return entry
+
+    def merge(self, plan, previous, columns, rows, tail_ns):
+        ### previous buckets inside the new window and before the tail, followed by the re-queried tail
+        partition = plan.partition
+        start, tail = timestream_time(plan.start_ns), timestream_time(tail_ns)
+        kept = [row for row in previous["rows"] if start <= partition.row_time(row) < tail]
+        merged = sorted(kept + rows, key=partition.row_time, reverse=partition.descending)
+        truncated = partition.limit is not None and len(merged) >= partition.limit
+        if partition.limit is not None:
+            merged = merged[:partition.limit]
+        return self.new_entry(columns, merged, truncated)
+
+    def run(self, sql):
+        ### runs a query upstream and collects all pages
+        request = {"QueryString": sql}
+        rows = []
+        while True:
+            response = self.client.query(**request)
+            rows.extend(response["Rows"])
+            self.count("bytesScanned", response.get("QueryStatus", {}).get("CumulativeBytesScanned", 0))
+            if not response.get("NextToken"):
+                break
+            request["NextToken"] = response["NextToken"]
+        self.count("upstreamQueries")
+        self.count("upstreamRows", len(rows))
+        return response["ColumnInfo"], rows
+
+
+def create_query_cache_from_environment():
+    ### QueryCacheAlignSeconds should match the dashboard refresh interval, QueryCacheTableLateSeconds is a
+    ### JSON object of table name to seconds, QueryCacheTable selects the shared DynamoDB store.
+    ### aws_clients.py is packaged next to this module from resources/lambda/process_iot_telemetry
+    from aws_clients import create_client
+
+    shared = None
+    table_name = os.environ.get("QueryCacheTable")
+    if table_name:
+        shared = DynamoDBCacheStore(create_client("dynamodb"), table_name)
+    return QueryCache(
+        create_client("timestream-query"),
+        MemoryCacheStore(int(os.environ.get("QueryCacheMaxEntries", "512"))),
+        shared,
+        align_seconds=float(os.environ.get("QueryCacheAlignSeconds", "10")),
+        late_seconds=float(os.environ.get("QueryCacheLateSeconds", "60")),
+        table_late_seconds=json.loads(os.environ.get("QueryCacheTableLateSeconds", "{}")),
+    )
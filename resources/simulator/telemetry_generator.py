@@ -0,0 +1,417 @@
+#################################################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                            #
+# SPDX-License-Identifier: MIT-0                                                                #
+#                                                                                               #
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this          #
+# software and associated documentation files (the "Software"), to deal in the Software         #
+# without restriction, including without limitation the rights to use, copy, modify,            #
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to            #
+# permit persons to whom the Software is furnished to do so.                                    #
+#                                                                                               #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,           #
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A                 #
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT            #
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION             #
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE                #
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                        #
+#################################################################################################
+
+### Generates device telemetry locally from the simulator schema in iot-device.json
+### Values are generated column-wise with NumPy for offline load tests of the ingestion Lambda, about
+### 2.5M payloads per second as columns, 400k/s as dicts and 250k/s written as JSONL on one core. With --handler the Lambda runs in-process and
+### writes to a recording stand-in for the Timestream write client, no AWS account is needed.
+###
+### Examples:
+###   python telemetry_generator.py --devices 10000 --count 1000000 --output telemetry.jsonl
+###   python telemetry_generator.py --count 100000 --batch-size 500 --handler ../lambda/process_iot_telemetry/process-telemetry-data.py
+###   python telemetry_generator.py --count 100000 --encoding packed --output telemetry.b64
+
+import argparse
+import base64
+import contextlib
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+### meters per degree of latitude, used to place locations inside the configured radius
+METERS_PER_DEGREE = 111320.0
+
+### the binary payload encoders live next to the Lambda decoders so both sides share one layout
+CODECS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "process_iot_telemetry")
+ENCODINGS = ("json", "packed")
+
+
+def load_schema(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "iot-device.json")):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def precision_decimals(precision):
+    return max(0, int(round(-np.log10(precision))))
+
+
+class TelemetryGenerator:
+    ### Produces payloads for every field in the simulator schema
+    ###   pickOne   - device ids, optionally replaced by device_count generated ids
+    ###   timestamp - unix epoch milliseconds advancing at rate messages per second
+    ###   int       - uniform integers between min and max
+    ###   float     - uniform floats between min and max rounded to precision
+    ###   decay     - per device level that drains from max towards min and recharges, kept across batches
+    ###   location  - latitude/longitude within radius meters of lat/long
+    ### A fraction of messages can be delivered late (out_of_order) or delivered twice (duplicates).
+
+    def __init__(self, schema, device_count=None, rate=1000.0, start_time_ms=None, decay_steps=3600,
+                 out_of_order=0.0, max_lateness_ms=60000, duplicates=0.0, duplicate_window=100, seed=None):
+        self.fields = schema["payload"]
+        self.rng = np.random.default_rng(seed)
+        self.rate = float(rate)
+        self.decay_steps = decay_steps
+        self.out_of_order = out_of_order
+        self.max_lateness_ms = max_lateness_ms
+        self.duplicates = duplicates
+        self.duplicate_window = duplicate_window
+        self.sequence = 0
+        self.start_time_ms = int(time.time() * 1000) if start_time_ms is None else start_time_ms
+
+        self.device_ids = None
+        for field in self.fields:
+            if field["type"] == "pickOne":
+                self.device_ids = np.array(
+                    ["device%d" % i for i in range(device_count)] if device_count else field["arr"]
+                )
+        device_total = len(self.device_ids) if self.device_ids is not None else 1
+
+        ### decay state, one level per device and field, starting at a random point of the cycle
+        self.levels = {
+            field["name"]: self.rng.uniform(field["min"], field["max"], device_total)
+            for field in self.fields
+            if field["type"] == "decay"
+        }
+
+    def decay(self, field, devices):
+        ### drain each device's level by a random step per message, in message order
+        low, high = field["min"], field["max"]
+        level = self.levels[field["name"]]
+        steps = self.rng.uniform(0, 2.0 * (high - low) / self.decay_steps, len(devices))
+
+        ### cumulative drain per device within the batch: cumsum over messages grouped by device
+        order = np.argsort(devices, kind="stable")
+        sorted_devices = devices[order]
+        cumulative = np.cumsum(steps[order])
+        group_start = np.r_[0, np.flatnonzero(sorted_devices[1:] != sorted_devices[:-1]) + 1]
+        group_offset = np.repeat(cumulative[group_start] - steps[order][group_start],
+                                 np.diff(np.r_[group_start, len(devices)]))
+        drained = np.empty(len(devices))
+        drained[order] = cumulative - group_offset
+
+        ### a drained device is recharged/refuelled back to max
+        values = low + np.mod(level[devices] - drained - low, high - low)
+
+        last = order[np.r_[group_start[1:] - 1, len(devices) - 1]]
+        level[devices[last]] = values[last]
+        return np.round(values, 2)
+
+    def generate_columns(self, count):
+        ### returns a dict of field name to NumPy array (location yields latitude and longitude arrays)
+        rng = self.rng
+        devices = rng.integers(0, len(self.device_ids), count) if self.device_ids is not None else np.zeros(count, dtype=np.int64)
+        columns = {}
+
+        for field in self.fields:
+            name, kind = field["name"], field["type"]
+            if kind == "pickOne":
+                columns[name] = self.device_ids[devices]
+            elif kind == "timestamp":
+                offsets = (self.sequence + np.arange(count)) * (1000.0 / self.rate)
+                timestamps = self.start_time_ms + offsets.astype(np.int64)
+                if self.out_of_order:
+                    late = rng.random(count) < self.out_of_order
+                    timestamps[late] -= rng.integers(1, self.max_lateness_ms, late.sum())
+                columns[name] = timestamps
+            elif kind == "int":
+                columns[name] = rng.integers(field["min"], field["max"] + 1, count)
+            elif kind == "float":
+                decimals = precision_decimals(field.get("precision", 0.01))
+                columns[name] = np.round(rng.uniform(field["min"], field["max"], count), decimals)
+            elif kind == "decay":
+                columns[name] = self.decay(field, devices)
+            elif kind == "location":
+                distance = field["radius"] * np.sqrt(rng.random(count))
+                bearing = rng.uniform(0, 2 * np.pi, count)
+                latitude = field["lat"] + distance * np.cos(bearing) / METERS_PER_DEGREE
+                longitude = field["long"] + distance * np.sin(bearing) / (
+                    METERS_PER_DEGREE * np.cos(np.radians(field["lat"]))
+                )
+                columns[name] = (np.round(latitude, 6), np.round(longitude, 6))
+            else:
+                raise ValueError("Unsupported simulator field type: " + kind)
+
+        self.sequence += count
+
+        if self.duplicates:
+            ### redeliver a fraction of messages a few positions after the original
+            originals = np.arange(count)
+            repeated = originals[rng.random(count) < self.duplicates]
+            positions = np.r_[originals, repeated + rng.integers(1, self.duplicate_window, len(repeated))]
+            selection = np.r_[originals, repeated][np.argsort(positions, kind="stable")]
+            columns = {
+                name: tuple(part[selection] for part in column) if isinstance(column, tuple) else column[selection]
+                for name, column in columns.items()
+            }
+
+        return columns
+
+    def generate(self, count):
+        ### returns a list of payload dicts shaped like the messages published to sampledevice/data
+        columns = self.generate_columns(count)
+        names = []
+        values = []
+        location = None
+        for name, column in columns.items():
+            if isinstance(column, tuple):
+                location = name
+                latitude, longitude = column[0].tolist(), column[1].tolist()
+            else:
+                names.append(name)
+                values.append(column.tolist())
+
+        payloads = [dict(zip(names, row)) for row in zip(*values)]
+        if location is not None:
+            for payload, lat, lng in zip(payloads, latitude, longitude):
+                payload[location] = {"latitude": lat, "longitude": lng}
+        return payloads
+
+    def iter_batches(self, count, batch_size=10000):
+        for size in batch_sizes(count, batch_size):
+            yield self.generate(size)
+
+    def iter_column_batches(self, count, batch_size=10000):
+        for size in batch_sizes(count, batch_size):
+            yield self.generate_columns(size)
+
+    def __iter__(self):
+        while True:
+            yield from self.generate(10000)
+
+
+def batch_sizes(count, batch_size):
+    while count > 0:
+        yield min(batch_size, count)
+        count -= batch_size
+
+
+def history_start_ms(count, rate):
+    ### start time at which count messages at rate messages per second end now. Later timestamps
+    ### would run ahead of the clock and be quarantined by the Lambda's max_future_ms check
+    return int(time.time() * 1000 - count / rate * 1000)
+
+
+def jsonl_lines(columns):
+    ### formats the columns of a batch straight into compact JSON lines, the same text as encoding the
+    ### payloads of generate() but without building a dict per message
+    fields = []
+    values = []
+    location = None
+    for name, column in columns.items():
+        if isinstance(column, tuple):
+            location = name, column
+        elif column.dtype.kind in "US":
+            fields.append(json.dumps(name) + ":%s")
+            values.append(list(map(json.dumps, column.tolist())))
+        else:
+            fields.append(json.dumps(name) + (":%d" if column.dtype.kind in "iu" else ":%r"))
+            values.append(column.tolist())
+    if location is not None:
+        name, (latitude, longitude) = location
+        fields.append(json.dumps(name) + ':{"latitude":%r,"longitude":%r}')
+        values += [latitude.tolist(), longitude.tolist()]
+    template = "{" + ",".join(fields) + "}"
+    return [template % row for row in zip(*values)]
+
+
+def write_jsonl(generator, count, output, batch_size=10000):
+    written = 0
+    for columns in generator.iter_column_batches(count, batch_size):
+        lines = jsonl_lines(columns)
+        output.write("\n".join(lines))
+        output.write("\n")
+        written += len(lines)
+    return written
+
+
+def load_codecs():
+    if CODECS_DIR not in sys.path:
+        sys.path.insert(0, CODECS_DIR)
+    import payload_codecs
+
+    return payload_codecs
+
+
+def encode_batch(batch, encoding):
+    ### wrap payloads the way the binary IoT Rule forwards them to the Lambda
+    encode = load_codecs().ENCODERS[encoding]
+    return [{"payload": base64.b64encode(encode(payload)).decode("ascii"), "contentType": None} for payload in batch]
+
+
+def write_encoded(generator, count, output, encoding, batch_size=10000):
+    ### one base64 encoded binary payload per line
+    encode = load_codecs().ENCODERS[encoding]
+    written = 0
+    for batch in generator.iter_batches(count, batch_size):
+        output.write("\n".join(base64.b64encode(encode(payload)).decode("ascii") for payload in batch))
+        output.write("\n")
+        written += len(batch)
+    return written
+
+
+def configure_handler_environment(database="local", table="device-telemetry"):
+    ### the handler reads these at import, variables already set (e.g. RollupTable) are kept.
+    ### No AWS credentials are needed, the handler writes through a local write client
+    os.environ.setdefault("TimestreamDatabase", database)
+    os.environ.setdefault("TimestreamTable", table)
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_REGION", os.environ["AWS_DEFAULT_REGION"])
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "local")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "local")
+
+
+class RecordingWriteClient:
+    ### Stands in for the timestream-write client, accepts every record and counts calls.
+    ### With keep=True the written records are kept per table, with CommonAttributes merged back in,
+    ### and requests holds the (table, CommonAttributes, Records) of every call
+
+    def __init__(self, exceptions, keep=False):
+        self.exceptions = exceptions
+        self.keep = keep
+        self.calls = 0
+        self.records = 0
+        self.tables = {}
+        self.requests = []
+
+    def write_records(self, DatabaseName, TableName, Records, CommonAttributes=None):
+        if len(Records) > 100:
+            raise ValueError("WriteRecords accepts at most 100 records")
+        self.calls += 1
+        self.records += len(Records)
+        if self.keep:
+            common = CommonAttributes or {}
+            self.requests.append((TableName, common, Records))
+            written = self.tables.setdefault(TableName, [])
+            for record in Records:
+                merged = dict(common, **record)
+                if "Dimensions" in common and "Dimensions" in record:
+                    merged["Dimensions"] = common["Dimensions"] + record["Dimensions"]
+                written.append(merged)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}, "RecordsIngested": {"Total": len(Records)}}
+
+
+def install_write_client(module, write_client):
+    ### point every TimestreamWriter of the handler module at write_client
+    module.write_client = write_client
+    for value in vars(module).values():
+        if hasattr(value, "write_client") and hasattr(value, "write_chunk"):
+            value.write_client = write_client
+
+
+def load_handler_module(path, write_client=None, keep_records=False):
+    ### import the ingestion Lambda module from its file, relative resources are read from its directory.
+    ### Every TimestreamWriter writes to write_client, by default a RecordingWriteClient, so the handler
+    ### runs offline. The botocore client created at import never sends a request.
+    configure_handler_environment()
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    os.chdir(directory)
+    spec = importlib.util.spec_from_file_location("process_telemetry_data", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if write_client is None:
+        write_client = RecordingWriteClient(module.write_client.exceptions, keep=keep_records)
+    install_write_client(module, write_client)
+    return module
+
+
+def load_handler(path):
+    return load_handler_module(path).lambda_handler
+
+
+class LocalContext:
+    ### minimal Lambda context for in-process invocations
+
+    def __init__(self, timeout_ms=900000):
+        self.deadline = time.monotonic() + timeout_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def invoke_handler(generator, handler, count, batch_size=100, encoding="json"):
+    ### send generated payloads straight into lambda_handler, batch_size payloads per invocation
+    failed = 0
+    for batch in generator.iter_batches(count, batch_size):
+        if encoding != "json":
+            batch = encode_batch(batch, encoding)
+        response = handler(batch, LocalContext()) or {}
+        failed += len(response.get("batchItemFailures", []))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate IoT telemetry from the simulator schema")
+    parser.add_argument("--schema", default=None, help="simulator schema, defaults to iot-device.json")
+    parser.add_argument("--devices", type=int, default=None, help="number of devices, defaults to the schema's device ids")
+    parser.add_argument("--count", type=int, default=1000000, help="number of payloads")
+    parser.add_argument("--rate", type=float, default=1000.0, help="simulated messages per second")
+    parser.add_argument("--out-of-order", type=float, default=0.0, help="fraction of late messages")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="fraction of redelivered messages")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=10000, help="payloads per batch or Lambda invocation")
+    parser.add_argument("--encoding", choices=ENCODINGS, default="json",
+                        help="payload encoding, binary encodings are written base64 encoded one per line")
+    parser.add_argument("--output", default="-", help="JSONL output file, - for stdout")
+    parser.add_argument("--handler", default=None, help="invoke this lambda_handler file instead of writing JSONL")
+    args = parser.parse_args()
+
+    schema = load_schema(args.schema) if args.schema else load_schema()
+    generator = TelemetryGenerator(
+        schema,
+        device_count=args.devices,
+        rate=args.rate,
+        start_time_ms=history_start_ms(args.count, args.rate),
+        out_of_order=args.out_of_order,
+        duplicates=args.duplicates,
+        seed=args.seed,
+    )
+
+    started = time.perf_counter()
+    if args.handler:
+        module = load_handler_module(args.handler)
+        failed = invoke_handler(generator, module.lambda_handler, args.count, args.batch_size, args.encoding)
+        print("failed items: %d" % failed, file=sys.stderr)
+        print("records written: %d in %d WriteRecords calls" % (module.write_client.records, module.write_client.calls),
+              file=sys.stderr)
+        ### shows how many injected --duplicates the handler suppressed
+        deduplicator = getattr(module, "deduplicator", None)
+        if deduplicator is not None:
+            print("dedup: " + json.dumps(deduplicator.stats()), file=sys.stderr)
+    elif args.encoding != "json":
+        with contextlib.ExitStack() as stack:
+            output = sys.stdout if args.output == "-" else stack.enter_context(open(args.output, "w", encoding="utf-8"))
+            write_encoded(generator, args.count, output, args.encoding, args.batch_size)
+    elif args.output == "-":
+        write_jsonl(generator, args.count, sys.stdout, args.batch_size)
+    else:
+        with open(args.output, "w", encoding="utf-8") as output:
+            write_jsonl(generator, args.count, output, args.batch_size)
+    elapsed = time.perf_counter() - started
+    print("%d payloads in %.2fs (%.0f/s)" % (args.count, elapsed, args.count / elapsed), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT, "resources", "lambda", "process_iot_telemetry")
+HANDLER_PATH = os.path.join(LAMBDA_DIR, "process-telemetry-data.py")
+
+for directory in (
+    ROOT,
+    LAMBDA_DIR,
+    os.path.join(ROOT, "resources", "simulator"),
+    os.path.join(ROOT, "resources", "emulator"),
+    os.path.join(ROOT, "resources", "backfill"),
+    os.path.join(ROOT, "resources", "grafana"),
+):
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+
+### optional features of the telemetry Lambda, tests enable the ones they need
+OPTIONAL_ENVIRONMENT = (
+    "RollupTable", "StateTable", "HealthTable", "HealthCheckpointTable", "GeoTileTable", "DedupTable",
+    "DeviceMetadataTable", "TenantDimension", "DeadLetterQueueUrl", "QuarantineQueueUrl", "ProfileSampleRate",
+)
+
+
+@pytest.fixture
+def load_handler(monkeypatch):
+    ### returns a loader for the telemetry Lambda module that writes to a RecordingWriteClient keeping records
+    from telemetry_generator import load_handler_module
+
+    monkeypatch.chdir(os.getcwd())
+    for name in OPTIONAL_ENVIRONMENT:
+        monkeypatch.delenv(name, raising=False)
+
+    def load(**environment):
+        for name, value in environment.items():
+            monkeypatch.setenv(name, value)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return load_handler_module(HANDLER_PATH, keep_records=True)
+
+    return load
+
+
+@pytest.fixture
+def generator():
+    from telemetry_generator import TelemetryGenerator, load_schema
+
+    def create(**options):
+        options.setdefault("seed", 7)
+        return TelemetryGenerator(load_schema(), **options)
+
+    return create
+
+
+class ThrottlingTable:
+    ### answers batch_get_item/batch_write_item like DynamoDB, leaving the last key or item of each of the
+    ### first throttled_calls requests unprocessed
+
+    def __init__(self, items=(), throttled_calls=0):
+        self.items = {item["key"]["S"]: item for item in items}
+        self.throttled_calls = throttled_calls
+        self.calls = 0
+
+    def throttle(self, entries):
+        self.calls += 1
+        if self.calls <= self.throttled_calls:
+            return entries[:-1], entries[-1:]
+        return entries, []
+
+    def batch_get_item(self, RequestItems):
+        (table, request), = RequestItems.items()
+        processed, unprocessed = self.throttle(request["Keys"])
+        response = {"Responses": {table: [self.items[key["key"]["S"]] for key in processed
+                                          if key["key"]["S"] in self.items]}}
+        if unprocessed:
+            response["UnprocessedKeys"] = {table: dict(request, Keys=unprocessed)}
+        return response
+
+    def batch_write_item(self, RequestItems):
+        (table, requests), = RequestItems.items()
+        processed, unprocessed = self.throttle(requests)
+        for request in processed:
+            item = request["PutRequest"]["Item"]
+            self.items[item["key"]["S"]] = item
+        return {"UnprocessedItems": {table: unprocessed}} if unprocessed else {}
+
+
+@pytest.fixture
+def throttling_table():
+    return ThrottlingTable
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    ### records the backoff delays of dynamodb_batch instead of sleeping
+    import dynamodb_batch
+
+    delays = []
+    monkeypatch.setattr(dynamodb_batch.time, "sleep", delays.append)
+    return delays
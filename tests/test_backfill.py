@@ -0,0 +1,222 @@
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import time
+import types
+
+import pytest
+
+import backfill_telemetry
+from backfill_telemetry import AdaptiveRateLimiter, parse_args, read_csv, read_jsonl, read_parquet
+from telemetry_generator import RecordingWriteClient
+from telemetry_schema import load_schema
+
+SCHEMA = load_schema(os.path.join(backfill_telemetry.LAMBDA_DIR, "telemetry-schema.json"))
+
+HOUR_MS = 3600 * 1000
+
+
+### exception classes the writer catches, none are raised here
+EXCEPTIONS = types.SimpleNamespace(RejectedRecordsException=type("RejectedRecordsException", (Exception,), {}))
+
+
+class Interrupted(BaseException):
+    ### stands in for the process being killed, TimestreamWriter only handles Exception
+    pass
+
+
+class InterruptedWriteClient(RecordingWriteClient):
+    def __init__(self, interrupt_call):
+        super().__init__(EXCEPTIONS, keep=True)
+        self.interrupt_call = interrupt_call
+
+    def write_records(self, **request):
+        if self.calls + 1 == self.interrupt_call:
+            raise Interrupted()
+        return super().write_records(**request)
+
+
+def payload(index, timestamp):
+    return {
+        "deviceid": "device-%d" % (index % 5),
+        "timestamp": timestamp,
+        "temperature": 20 + index % 10,
+        "signal_strength": -60.5,
+        "location": {"latitude": 40.0, "longitude": -3.0},
+        "fuel_level": 50.0,
+        "battery_level": 80.0,
+    }
+
+
+def write_jsonl(path, payloads):
+    with open(path, "w", encoding="utf-8") as f:
+        for item in payloads:
+            f.write(json.dumps(item) + "\n")
+    return str(path)
+
+
+def options(tmp_path, *arguments):
+    return parse_args(["--database", "iot", "--concurrency", "1", "--batch-size", "10", "--rate", "1000000",
+                       "--checkpoint-dir", str(tmp_path / "checkpoints"), "--staging-dir", str(tmp_path / "staging"),
+                       *arguments, "unused"])
+
+
+def run(path, options, write_client):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return backfill_telemetry.backfill_file(path, options, write_client)
+
+
+def written_keys(write_client):
+    return [(dimension["Value"], int(record["Time"])) for record in write_client.tables.get("device-telemetry", [])
+            for dimension in record["Dimensions"] if dimension["Name"] == "deviceid"]
+
+
+def staged_keys(staging_dir):
+    keys = []
+    for name in sorted(os.listdir(staging_dir)):
+        if name.endswith(".csv"):
+            with open(os.path.join(staging_dir, name), newline="", encoding="utf-8") as f:
+                keys += [(row["deviceid"], int(row["time"])) for row in csv.DictReader(f)]
+    return keys
+
+
+def test_resume_continues_after_the_last_checkpointed_batch(tmp_path):
+    now_ms = int(time.time() * 1000)
+    payloads = [payload(index, now_ms - HOUR_MS + index) for index in range(50)]
+    path = write_jsonl(tmp_path / "telemetry.jsonl", payloads)
+    settings = options(tmp_path)
+
+    ### killed while writing the third batch, the first two are checkpointed
+    interrupted = InterruptedWriteClient(interrupt_call=3)
+    with pytest.raises(Interrupted):
+        run(path, settings, interrupted)
+    assert sorted(written_keys(interrupted)) == sorted((item["deviceid"], item["timestamp"]) for item in payloads[:20])
+
+    resumed = RecordingWriteClient(EXCEPTIONS, keep=True)
+    summary = run(path, settings, resumed)
+    assert sorted(written_keys(resumed)) == sorted((item["deviceid"], item["timestamp"]) for item in payloads[20:])
+    assert summary["read"] == summary["written"] == 50
+
+    ### a finished file is skipped
+    assert run(path, settings, RecordingWriteClient(EXCEPTIONS, keep=True))["skipped"]
+
+
+def test_old_records_are_staged_once_across_an_interruption(tmp_path, monkeypatch):
+    now_ms = int(time.time() * 1000)
+    ### every third payload is older than the memory store and goes to the staging files
+    payloads = [payload(index, now_ms - (24 if index % 3 else 1) * HOUR_MS + index) for index in range(60)]
+    path = write_jsonl(tmp_path / "telemetry.jsonl", payloads)
+    settings = options(tmp_path, "--staging-rows-per-file", "7")
+    old = sorted((item["deviceid"], item["timestamp"]) for item in payloads if item["timestamp"] < now_ms - 6 * HOUR_MS)
+
+    ### killed after the third batch was staged, before its checkpoint was saved
+    save_checkpoint = backfill_telemetry.save_checkpoint
+    saved = []
+
+    def interrupted_checkpoint(path, state):
+        saved.append(state)
+        if len(saved) == 3:
+            raise Interrupted()
+        save_checkpoint(path, state)
+
+    monkeypatch.setattr(backfill_telemetry, "save_checkpoint", interrupted_checkpoint)
+    with pytest.raises(Interrupted):
+        run(path, settings, RecordingWriteClient(EXCEPTIONS, keep=True))
+    assert len(staged_keys(settings.staging_dir)) > saved[1]["staged"]
+
+    monkeypatch.setattr(backfill_telemetry, "save_checkpoint", save_checkpoint)
+    resumed = RecordingWriteClient(EXCEPTIONS, keep=True)
+    summary = run(path, settings, resumed)
+
+    assert sorted(staged_keys(settings.staging_dir)) == old
+    assert summary["staged"] == len(old)
+    assert all(timestamp >= now_ms - 6 * HOUR_MS for _, timestamp in written_keys(resumed))
+    with open(os.path.join(settings.staging_dir, "data-model.json"), encoding="utf-8") as f:
+        assert json.load(f)["TimeColumn"] == "time"
+
+
+def test_rate_halves_on_throttling_and_recovers():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    limiter = AdaptiveRateLimiter(1000, min_rate=100, max_rate=1100, cooldown=1.0,
+                                  clock=lambda: now[0], sleep=sleep)
+    limiter.acquire(500)
+    assert sleeps == [pytest.approx(0.5)]
+
+    limiter.update(True)
+    assert limiter.rate == 500
+    ### throttles within the cooldown are the same congestion
+    limiter.update(True)
+    assert limiter.rate == 500
+    for _ in range(5):
+        now[0] += 1.0
+        limiter.update(True)
+    assert limiter.rate == 100
+
+    limiter.update(False)
+    assert limiter.rate == pytest.approx(105)
+    for _ in range(100):
+        limiter.update(False)
+    assert limiter.rate == 1100
+
+
+def test_jsonl_resumes_at_a_byte_offset(tmp_path):
+    payloads = [payload(index, 1700000000000 + index) for index in range(5)]
+    path = write_jsonl(tmp_path / "telemetry.jsonl", payloads)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("\n")
+
+    batches = list(read_jsonl(path, SCHEMA, 0, 2))
+    assert [len(batch) for _, batch in batches] == [2, 2, 1]
+    assert [batch for _, batch in read_jsonl(path, SCHEMA, batches[0][0], 2)] == [payloads[2:4], payloads[4:]]
+
+
+def test_csv_columns_are_converted_to_payload_fields(tmp_path):
+    path = tmp_path / "telemetry.csv"
+    path.write_text(
+        "deviceid,timestamp,temperature,signal_strength,location.latitude,longitude,fuel_level,battery_level\n"
+        "a,1700000000000,21,-60.5,40.5,-3.25,50,80\n"
+        "b,1700000001000,22,-61,41,-3,49.5,\n"
+        "c,1700000002000,hot,-62,42,-3,49,79\n",
+        encoding="utf-8",
+    )
+
+    ((position, rows),) = list(read_csv(str(path), SCHEMA, 0, 10))
+    assert position == 3
+    assert rows[0] == {"deviceid": "a", "timestamp": 1700000000000, "temperature": 21, "signal_strength": -60.5,
+                       "location": {"latitude": 40.5, "longitude": -3.25}, "fuel_level": 50.0, "battery_level": 80.0}
+    ### empty cells are missing fields and unconvertible values are left for validation to report
+    assert "battery_level" not in rows[1]
+    assert rows[2]["temperature"] == "hot"
+
+    assert [batch for _, batch in read_csv(str(path), SCHEMA, 2, 10)] == [rows[2:]]
+
+
+def test_parquet_skips_row_groups_before_the_checkpoint(tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    start = datetime.datetime(2023, 11, 14, 22, 13, 20, tzinfo=datetime.timezone.utc)
+    rows = [{
+        "deviceid": "device-%d" % index,
+        "timestamp": start + datetime.timedelta(seconds=index),
+        "temperature": 20 + index,
+        "location.latitude": 40.0,
+        "location.longitude": -3.0,
+    } for index in range(8)]
+    path = str(tmp_path / "telemetry.parquet")
+    pyarrow_parquet.write_table(pyarrow.Table.from_pylist(rows), path, row_group_size=3)
+
+    batches = list(read_parquet(path, SCHEMA, 4, 10))
+    assert batches[-1][0] == 8
+    payloads = [item for _, batch in batches for item in batch]
+    assert [item["deviceid"] for item in payloads] == ["device-%d" % index for index in range(4, 8)]
+    assert payloads[0]["timestamp"] == 1700000004000
+    assert payloads[0]["location"] == {"latitude": 40.0, "longitude": -3.0}
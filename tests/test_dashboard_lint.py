@@ -0,0 +1,128 @@
+import json
+import os
+
+import pytest
+
+from conftest import ROOT
+from dashboard_lint import estimate_cost, lint_dashboard, lint_query, rewrite_dashboard, rewrite_query
+
+DASHBOARD_FILE = os.path.join(ROOT, "resources", "grafana", "grafana_dashboard.json")
+
+TABLE = '"iot"."device-telemetry"'
+
+
+def rules(sql, **options):
+    return sorted(item["rule"] for item in lint_query(sql, "query", **options))
+
+
+def dashboard(sql, panel_type="timeseries"):
+    return {"panels": [{"title": "panel", "type": panel_type, "targets": [{"refId": "A", "rawQuery": sql}]}]}
+
+
+@pytest.mark.parametrize("sql, cost", [
+    ("SELECT * FROM %s" % TABLE, "full-table"),
+    ("SELECT * FROM %s WHERE deviceid = 'a'" % TABLE, "full-table"),
+    ("SELECT * FROM %s WHERE $__timeFilter" % TABLE, "low"),
+    ("SELECT * FROM %s WHERE time > ago(1h)" % TABLE, "low"),
+    ("SELECT * FROM %s WHERE time > ago(12h)" % TABLE, "medium"),
+    ("SELECT * FROM %s WHERE time > ago(3d)" % TABLE, "high"),
+    ("SELECT * FROM %s WHERE time > ago(30d)" % TABLE, "very-high"),
+    ("SELECT * FROM %s WHERE time > ago(30d) and deviceid = '$deviceid'" % TABLE, "high"),
+    ("SELECT max(t) FROM (SELECT time as t FROM %s WHERE time > ago(1h))" % TABLE, "low"),
+])
+def test_scan_cost_follows_the_time_window_and_device_filter(sql, cost):
+    assert estimate_cost(sql) == cost
+
+
+def test_select_star_is_only_fixable_with_further_columns():
+    sql = "SELECT *, battery_level FROM %s WHERE $__timeFilter LIMIT 10" % TABLE
+    (item,) = lint_query(sql, "query")
+    assert (item["rule"], item["severity"], item["fixable"]) == ("SELECT_STAR", "warning", True)
+    assert rewrite_query(sql)[0] == "SELECT time, deviceid, battery_level FROM %s WHERE $__timeFilter LIMIT 10" % TABLE
+
+    bare = "SELECT * FROM %s WHERE $__timeFilter LIMIT 10" % TABLE
+    (item,) = lint_query(bare, "query")
+    assert not item["fixable"]
+    assert rewrite_query(bare)[0] == bare
+
+
+def test_unbounded_scans_are_errors_and_get_a_time_bound():
+    sql = "SELECT deviceid, temperature FROM %s WHERE deviceid = '$deviceid' LIMIT 10" % TABLE
+    (item,) = lint_query(sql, "query")
+    assert (item["rule"], item["severity"], item["cost"]) == ("UNBOUNDED_SCAN", "error", "full-table")
+    rewritten, _ = rewrite_query(sql)
+    assert "WHERE $__timeFilter and deviceid = '$deviceid'" in rewritten
+    assert rules(rewritten) == []
+
+    ### variables have no dashboard time range, they are bounded to the last day
+    variable = "select distinct deviceid from %s" % TABLE
+    assert rules(variable, is_variable=True) == ["UNBOUNDED_SCAN"]
+    rewritten, _ = rewrite_query(variable, is_variable=True)
+    assert rewritten.endswith("WHERE time > ago(1d) \n")
+    assert rules(rewritten, is_variable=True) == []
+
+
+def test_fixed_windows_become_the_time_filter_with_a_panel_time_override():
+    sql = "SELECT avg(temperature) FROM %s WHERE time between ago(7d) and now() GROUP BY deviceid" % TABLE
+    assert rules(sql) == ["MISSING_TIME_FILTER"]
+    rewritten, time_from = rewrite_query(sql)
+    assert rewritten == "SELECT avg(temperature) FROM %s WHERE $__timeFilter GROUP BY deviceid" % TABLE
+    assert time_from == "7d"
+
+    ### the panel keeps a relative time it already has
+    panel = dashboard(sql)
+    panel["panels"][0]["timeFrom"] = "1d"
+    assert rewrite_dashboard(panel)["panels"][0]["timeFrom"] == "1d"
+    assert rewrite_dashboard(dashboard(sql))["panels"][0]["timeFrom"] == "7d"
+
+
+def test_tenant_filter_goes_on_the_query_that_scans_the_table():
+    sql = "SELECT max(t) FROM (SELECT time as t FROM %s WHERE $__timeFilter)" % TABLE
+    assert rules(sql, tenant_variable="customerid") == ["MISSING_TENANT_FILTER"]
+    (item,) = lint_query(sql, "query", tenant_variable="customerid")
+    assert item["severity"] == "error"
+
+    rewritten, _ = rewrite_query(sql, tenant_variable="customerid")
+    assert "WHERE customerid = '$customerid' and $__timeFilter)" in rewritten
+    assert rules(rewritten, tenant_variable="customerid") == []
+
+    ### a customerid inside a string literal is no filter
+    literal = "SELECT time FROM %s WHERE $__timeFilter and deviceid = 'customerid = 1' LIMIT 10" % TABLE
+    assert rules(literal, tenant_variable="customerid") == ["MISSING_TENANT_FILTER"]
+
+
+def test_single_value_panels_read_the_selected_device_latest_row():
+    sql = "SELECT battery_level FROM %s WHERE $__timeFilter" % TABLE
+    assert rules(sql, panel_type="gauge", has_device_variable=True) == ["MISSING_DEVICE_FILTER", "MISSING_LIMIT"]
+    assert rules(sql, panel_type="gauge") == ["MISSING_LIMIT"]
+    assert rules(sql, panel_type="timeseries", has_device_variable=True) == ["MISSING_LIMIT"]
+
+    rewritten, _ = rewrite_query(sql, panel_type="gauge", has_device_variable=True)
+    assert rewritten == ("SELECT battery_level FROM %s WHERE deviceid = '$deviceid' and $__timeFilter \n"
+                         "ORDER BY time DESC \nLIMIT 1" % TABLE)
+    assert rules(rewritten, panel_type="gauge", has_device_variable=True) == []
+
+
+def test_unaggregated_queries_get_a_limit():
+    sql = "SELECT time, temperature FROM %s WHERE $__timeFilter ORDER BY time" % TABLE
+    assert rules(sql) == ["MISSING_LIMIT"]
+    assert rewrite_query(sql, limit=500)[0] == sql + " \nLIMIT 500"
+
+    ### aggregates return one row per group
+    assert rules("SELECT count(*) FROM %s WHERE $__timeFilter" % TABLE) == []
+    assert rules("SELECT deviceid FROM %s WHERE $__timeFilter GROUP BY deviceid" % TABLE) == []
+
+
+def test_shipped_dashboard_rewrite_fixes_every_finding_once():
+    with open(DASHBOARD_FILE, encoding="utf-8") as f:
+        shipped = json.load(f)["dashboard"]
+
+    findings = lint_dashboard(shipped)
+    assert len(findings) == 7
+    assert {item["severity"] for item in findings} == {"warning"}
+    assert all(item["fixable"] for item in findings)
+
+    rewritten = rewrite_dashboard(shipped)
+    assert lint_dashboard(rewritten) == []
+    assert rewrite_dashboard(rewritten) == rewritten
+    assert len(rewritten["panels"]) == len(shipped["panels"])
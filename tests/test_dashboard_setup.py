@@ -0,0 +1,261 @@
+import contextlib
+import importlib
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+from conftest import LAMBDA_DIR, ROOT
+
+GRAFANA_DIR = os.path.join(ROOT, "resources", "grafana")
+
+
+class FakeGrafana:
+    ### the subset of the Grafana HTTP API dashboard_setup.py uses, rejected maps (method, path) to a status
+
+    def __init__(self):
+        self.datasources = {}
+        self.dashboards = {}
+        self.folders = {}
+        self.folder_permissions = {}
+        self.plugin_installed = False
+        self.forwards_headers = True
+        self.rejected = {}
+        self.calls = []
+
+
+def handler_for(grafana):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send(self, status, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_request(self, method):
+            path = urlparse(self.path).path
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"null")
+            grafana.calls.append((method, path))
+            status = grafana.rejected.get((method, path))
+            if status:
+                return self.send(status, {"message": "rejected"})
+            return self.send(*self.route(method, path, body))
+
+        def route(self, method, path, body):
+            name = path.rsplit("/", 1)[1]
+            if path.startswith("/api/plugins/"):
+                if method == "POST":
+                    grafana.plugin_installed = True
+                return (200 if grafana.plugin_installed else 404), {}
+            if path == "/api/datasources":
+                if method == "POST":
+                    grafana.datasources[body["uid"]] = body
+                    return 200, {"datasource": body}
+                return 200, list(grafana.datasources.values())
+            if path == "/api/ds/query":
+                ### the query cache denies queries of a plugin that drops the token header
+                datasource = grafana.datasources[body["queries"][0]["datasource"]["uid"]]
+                if datasource["jsonData"].get("endpoint") and not grafana.forwards_headers:
+                    return 400, {"results": {"A": {"error": "AccessDeniedException: Invalid query cache token"}}}
+                return 200, {"results": {"A": {"frames": []}}}
+            if path.startswith("/api/datasources/uid/"):
+                if method == "PUT":
+                    grafana.datasources[name] = body
+                return (200, grafana.datasources[name]) if name in grafana.datasources else (404, {})
+            if path == "/api/dashboards/db":
+                grafana.dashboards[body["dashboard"]["uid"]] = body
+                return 200, {"url": "/d/" + body["dashboard"]["uid"]}
+            if path.startswith("/api/dashboards/uid/"):
+                if name not in grafana.dashboards:
+                    return 404, {}
+                return 200, {"dashboard": grafana.dashboards[name]["dashboard"], "meta": {"url": "/d/" + name}}
+            if path == "/api/folders":
+                grafana.folders[body["uid"]] = body
+                ### new folders are open to every viewer and editor of the org
+                grafana.folder_permissions[body["uid"]] = [{"role": "Viewer", "permission": 1},
+                                                           {"role": "Editor", "permission": 2}]
+                return 200, body
+            if path.startswith("/api/folders/") and path.endswith("/permissions"):
+                uid = path.split("/")[3]
+                if method == "POST":
+                    grafana.folder_permissions[uid] = body["items"]
+                return 200, grafana.folder_permissions.get(uid, [])
+            if path.startswith("/api/folders/"):
+                return (200, grafana.folders[name]) if name in grafana.folders else (404, {})
+            if path == "/api/search":
+                return 200, [{"uid": uid, "title": item["dashboard"]["title"]} for uid, item in grafana.dashboards.items()]
+            return 404, {}
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+        def do_PUT(self):
+            self.handle_request("PUT")
+
+    return Handler
+
+
+@pytest.fixture
+def grafana():
+    grafana = FakeGrafana()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_for(grafana))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    grafana.url = "http://127.0.0.1:%d" % server.server_address[1]
+    yield grafana
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def setup(grafana, monkeypatch):
+    ### dashboard_setup pointed at the fake server, without the query cache
+    monkeypatch.chdir(GRAFANA_DIR)
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    monkeypatch.setenv("GrafanaUrl", grafana.url)
+    monkeypatch.setenv("TimestreamDatabase", "iot")
+    monkeypatch.setenv("TimestreamTable", "device-telemetry")
+    monkeypatch.setenv("DeviceMetadataFile", os.path.join(LAMBDA_DIR, "device-meta.json"))
+    for name in ("QueryCacheEndpoint", "DeviceMetadataTable", "DashboardLint"):
+        monkeypatch.delenv(name, raising=False)
+
+    import dashboard_setup
+
+    dashboard_setup = importlib.reload(dashboard_setup)
+    monkeypatch.setattr(dashboard_setup, "query_cache_endpoint", lambda: (None, None))
+    return dashboard_setup
+
+
+def writes(grafana):
+    return [call for call in grafana.calls if call[0] != "GET"]
+
+
+def quietly(function, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args)
+
+
+def test_provisioning_twice_changes_nothing(setup, grafana):
+    http = setup.create_http("key")
+    uid = quietly(setup.create_timestream_data_source, "ws", http)
+    urls = quietly(setup.provision_dashboards, "ws", http, uid)
+    assert grafana.plugin_installed
+    assert list(grafana.datasources) == [uid]
+    assert urls == ["/d/" + dashboard_uid for dashboard_uid in grafana.dashboards]
+
+    grafana.calls = []
+    assert quietly(setup.create_timestream_data_source, "ws", http) == uid
+    assert quietly(setup.provision_dashboards, "ws", http, uid) == urls
+    assert writes(grafana) == []
+
+
+def test_changed_data_source_is_updated_in_place(setup, grafana, monkeypatch):
+    http = setup.create_http("key")
+    uid = quietly(setup.create_timestream_data_source, "ws", http)
+    monkeypatch.setenv("TimestreamTable", "other")
+    grafana.calls = []
+
+    assert quietly(setup.create_timestream_data_source, "ws", http) == uid
+    assert writes(grafana) == [("PUT", "/api/datasources/uid/" + uid)]
+    assert grafana.datasources[uid]["jsonData"]["defaultTable"] == "other"
+
+
+def test_rejected_data_source_writes_raise(setup, grafana, monkeypatch):
+    http = setup.create_http("key")
+    grafana.rejected[("POST", "/api/datasources")] = 409
+    with pytest.raises(RuntimeError, match="data source create failed with status 409"):
+        quietly(setup.create_timestream_data_source, "ws", http)
+
+    del grafana.rejected[("POST", "/api/datasources")]
+    uid = quietly(setup.create_timestream_data_source, "ws", http)
+    monkeypatch.setenv("TimestreamTable", "other")
+    grafana.rejected[("PUT", "/api/datasources/uid/" + uid)] = 400
+    with pytest.raises(RuntimeError, match="data source update failed with status 400"):
+        quietly(setup.create_timestream_data_source, "ws", http)
+
+
+def test_query_cache_token_is_sent_as_a_secure_header(setup, grafana, monkeypatch):
+    http = setup.create_http("key")
+    monkeypatch.setattr(setup, "query_cache_endpoint", lambda: ("https://cache.example", "secret"))
+    uid = quietly(setup.create_timestream_data_source, "ws", http)
+
+    datasource = grafana.datasources[uid]
+    assert datasource["jsonData"]["endpoint"] == "https://cache.example"
+    assert datasource["jsonData"]["httpHeaderName1"] == "x-query-cache-token"
+    assert datasource["secureJsonData"] == {"httpHeaderValue1": "secret"}
+    assert "secret" not in json.dumps(datasource["jsonData"])
+    assert ("POST", "/api/ds/query") in grafana.calls
+
+
+def test_data_source_queries_timestream_directly_when_the_token_is_not_forwarded(setup, grafana, monkeypatch):
+    http = setup.create_http("key")
+    monkeypatch.setattr(setup, "query_cache_endpoint", lambda: ("https://cache.example", "secret"))
+    grafana.forwards_headers = False
+    uid = quietly(setup.create_timestream_data_source, "ws", http)
+
+    datasource = grafana.datasources[uid]
+    assert "endpoint" not in datasource["jsonData"]
+    assert "httpHeaderName1" not in datasource["jsonData"]
+    assert "secureJsonData" not in datasource
+
+    ### once the plugin sends the header the next deployment switches to the cache
+    grafana.forwards_headers = True
+    assert quietly(setup.create_timestream_data_source, "ws", http) == uid
+    assert grafana.datasources[uid]["jsonData"]["endpoint"] == "https://cache.example"
+
+
+def test_tenant_dashboards_are_provisioned_once(setup, grafana):
+    http = setup.create_http("key")
+    uid = quietly(setup.create_timestream_data_source, "ws", http)
+    count = quietly(setup.provision_tenant_dashboards, "ws", http, uid, "customerid")
+
+    customers = setup.list_customers("customerid")
+    assert count == len(customers) == len(grafana.dashboards)
+    assert len(grafana.folders) == 1
+    assert list(grafana.folder_permissions.values()) == [[]]
+    for item in grafana.dashboards.values():
+        assert item["folderUid"] in grafana.folders
+
+    grafana.calls = []
+    assert quietly(setup.provision_tenant_dashboards, "ws", http, uid, "customerid") == count
+    assert writes(grafana) == []
+
+
+def panel_tables(dashboard, setup):
+    return {table for panel in dashboard["panels"] for target in panel.get("targets", [])
+            for table in setup.query_tables(target.get("rawQuery"), "iot")}
+
+
+def test_panels_of_tables_that_are_not_deployed_are_dropped(setup, monkeypatch):
+    everything = setup.load_dashboard("grafana_dashboard.json", "ds")["dashboard"]
+    monkeypatch.setenv("TimestreamTables", json.dumps(sorted(panel_tables(everything, setup))))
+    assert setup.load_dashboard("grafana_dashboard.json", "ds")["dashboard"]["panels"] == everything["panels"]
+
+    monkeypatch.setenv("TimestreamTables", json.dumps(sorted(panel_tables(everything, setup) - {"device-telemetry-rollup"})))
+    dashboard = quietly(setup.load_dashboard, "grafana_dashboard.json", "ds")["dashboard"]
+    assert "device-telemetry-rollup" not in panel_tables(dashboard, setup)
+    assert len(dashboard["panels"]) == len(everything["panels"]) - 2
+
+
+def test_panels_of_the_state_table_read_telemetry_when_it_is_not_deployed(setup, monkeypatch):
+    everything = setup.load_dashboard("grafana_dashboard.json", "ds")["dashboard"]
+    monkeypatch.setenv("TimestreamTables", json.dumps(sorted(panel_tables(everything, setup) - {"device-state"})))
+    dashboard = quietly(setup.load_dashboard, "grafana_dashboard.json", "ds")["dashboard"]
+
+    assert len(dashboard["panels"]) == len(everything["panels"])
+    assert "device-state" not in json.dumps(dashboard)
+    assert "device-state" not in panel_tables(dashboard, setup)
+    (variable,) = [variable for variable in dashboard["templating"]["list"] if variable["name"] == "deviceid"]
+    assert setup.query_tables(variable["query"], "iot") == ["device-telemetry"]
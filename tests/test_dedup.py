@@ -0,0 +1,77 @@
+import contextlib
+import io
+
+import pytest
+
+from dedup import Deduplicator, DynamoDBDedupBackend
+from dynamodb_batch import UnprocessedItemsError
+from telemetry_generator import LocalContext, invoke_handler
+
+
+def written_keys(module, table="device-telemetry"):
+    ### dimensions hoisted into CommonAttributes come first in the merged records
+    return [(dimension_value(record, "deviceid"), record["Time"]) for record in module.write_client.tables[table]]
+
+
+def dimension_value(record, name):
+    return next(dimension["Value"] for dimension in record["Dimensions"] if dimension["Name"] == name)
+
+
+def test_injected_duplicates_are_written_once(load_handler, generator):
+    module = load_handler()
+    source = generator(device_count=50, duplicates=0.2)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        failed = invoke_handler(source, module.lambda_handler, 4000, batch_size=200)
+
+    keys = written_keys(module)
+    assert failed == 0
+    assert module.deduplicator.duplicates > 0
+    assert len(keys) == len(set(keys)) == 4000
+
+
+def test_redelivery_after_failed_write_is_written(load_handler, generator):
+    module = load_handler()
+    batch = generator(device_count=5).generate(20)
+    recording = module.write_client
+
+    class ThrottledClient:
+        exceptions = recording.exceptions
+
+        def write_records(self, **request):
+            raise recording.exceptions.ThrottlingException(
+                {"Error": {"Code": "ThrottlingException", "Message": "slow down"}}, "WriteRecords")
+
+    module.writer.write_client = ThrottledClient()
+    module.writer.max_attempts = 1
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = module.lambda_handler(batch, LocalContext())
+    assert len(response["batchItemFailures"]) == 20
+
+    module.writer.write_client = recording
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = module.lambda_handler(batch, LocalContext())
+        module.lambda_handler(batch, LocalContext())
+    assert response["batchItemFailures"] == []
+    assert len(written_keys(module)) == 20
+
+
+def test_shared_lookup_raises_on_unprocessed_keys(sleeps, throttling_table):
+    table = throttling_table(throttled_calls=10)
+    with pytest.raises(UnprocessedItemsError):
+        DynamoDBDedupBackend(table, "dedup").seen_many({("a", "1"), ("b", "2")})
+
+
+def test_messages_are_written_when_the_shared_lookup_is_unresolved(sleeps, throttling_table):
+    table = throttling_table(throttled_calls=0)
+    backend = DynamoDBDedupBackend(table, "dedup", max_attempts=2)
+    backend.remember_many([("a", "1"), ("b", "2")])
+
+    table.throttled_calls = table.calls + 10
+    deduplicator = Deduplicator(backend=backend)
+    messages = [(0, {"deviceid": "a", "timestamp": 1}), (1, {"deviceid": "b", "timestamp": 2})]
+    assert deduplicator.filter(messages) == messages
+    assert deduplicator.shared_duplicates == 0
+
+    table.throttled_calls = 0
+    assert Deduplicator(backend=backend).filter(messages) == []
@@ -0,0 +1,40 @@
+from device_health import DeviceHealthScorer
+
+
+class MemoryStore:
+    def __init__(self):
+        self.saved = {}
+
+    def load(self, device_ids):
+        return {device: self.saved[device] for device in device_ids if device in self.saved}
+
+    def save(self, states):
+        self.saved.update(states)
+
+
+def measure(record, name):
+    return next(value["Value"] for value in record["MeasureValues"] if value["Name"] == name)
+
+
+def test_failed_health_write_keeps_anomalies():
+    store = MemoryStore()
+    scorer = DeviceHealthScorer(interval=300, z_warmup=5, store=store)
+    for index in range(20):
+        scorer.update({"deviceid": "a", "timestamp": 1000 + index, "temperature": 20 + index % 2})
+    scorer.update({"deviceid": "a", "timestamp": 2000, "temperature": 500})
+
+    records = scorer.flush()
+    anomalies = measure(records[0], "anomalies")
+    assert int(anomalies) >= 1
+    scorer.commit(records, failed={0})
+    assert scorer.pending == {"a"}
+    assert scorer.devices["a"]["anomalies"] == int(anomalies)
+    assert "a" in store.saved
+
+    records = scorer.flush()
+    assert measure(records[0], "anomalies") == anomalies
+    scorer.commit(records)
+    assert scorer.pending == set()
+    assert scorer.devices["a"]["anomalies"] == 0
+    assert scorer.devices["a"]["flags"] == 0
+    assert scorer.devices["a"]["written_time"] == 2000
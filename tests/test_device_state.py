@@ -0,0 +1,37 @@
+from device_state import DeviceStateTracker
+
+
+def message(device, timestamp, battery):
+    return {"deviceid": device, "timestamp": timestamp, "battery_level": battery}
+
+
+def measure(record, name):
+    return next(value["Value"] for value in record["MeasureValues"] if value["Name"] == name)
+
+
+def test_failed_state_write_stays_pending():
+    tracker = DeviceStateTracker(heartbeat=300)
+    tracker.update(message("a", 1000, 90.0))
+    tracker.update(message("b", 1000, 80.0))
+
+    records = tracker.flush()
+    failed = {index for index, record in enumerate(records) if record["Dimensions"][0]["Value"] == "a"}
+    tracker.commit(records, failed)
+    assert tracker.pending == {"a"}
+    assert tracker.devices["b"]["written"] == {"battery_level": 80.0}
+    assert tracker.devices["a"]["written"] == {}
+
+    tracker.update(message("a", 2000, 90.0))
+    records = tracker.flush()
+    assert [measure(record, "messages") for record in records] == ["2"]
+    tracker.commit(records)
+    assert tracker.pending == set()
+    assert tracker.devices["a"]["messages"] == 0
+    assert tracker.devices["a"]["written_time"] == 2000
+
+
+def test_flush_without_commit_is_written_again():
+    tracker = DeviceStateTracker()
+    tracker.update(message("a", 1000, 90.0))
+    assert len(tracker.flush()) == 1
+    assert len(tracker.flush()) == 1
@@ -0,0 +1,85 @@
+import contextlib
+import io
+
+import pytest
+
+from device_metadata import DynamoDBBackend, MetadataResolver
+from dynamodb_batch import UnprocessedItemsError, batch_get_items, batch_write_items
+
+
+def keys(count):
+    return [{"key": {"S": "k%d" % index}} for index in range(count)]
+
+
+def test_unprocessed_keys_are_retried(sleeps, throttling_table):
+    table = throttling_table(keys(150), throttled_calls=2)
+    items = batch_get_items(table, "dedup", keys(150))
+    assert sorted(item["key"]["S"] for item in items) == sorted("k%d" % index for index in range(150))
+    assert table.calls == 4
+    assert len(sleeps) == 2
+
+
+def test_unprocessed_keys_raise_after_last_attempt_without_sleeping(sleeps, throttling_table):
+    table = throttling_table(keys(10), throttled_calls=10)
+    with pytest.raises(UnprocessedItemsError) as raised:
+        batch_get_items(table, "dedup", keys(10), max_attempts=3)
+    assert raised.value.unprocessed == [{"key": {"S": "k9"}}]
+    assert table.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_unprocessed_items_raise_after_last_attempt(sleeps, throttling_table):
+    table = throttling_table(throttled_calls=10)
+    requests = [{"PutRequest": {"Item": key}} for key in keys(30)]
+    with pytest.raises(UnprocessedItemsError):
+        batch_write_items(table, "dedup", requests, max_attempts=2)
+    assert table.calls == 2
+    assert len(sleeps) == 1
+
+    table = throttling_table(throttled_calls=1)
+    batch_write_items(table, "dedup", requests)
+    assert len(table.items) == 30
+
+
+def test_metadata_lookup_raises_on_unprocessed_keys(sleeps, throttling_table):
+    table = throttling_table(throttled_calls=10)
+    with pytest.raises(UnprocessedItemsError):
+        DynamoDBBackend(table, "metadata", key_name="key").batch_get(["a", "b"])
+
+
+def test_unprocessed_keys_keep_the_items_of_every_chunk(sleeps, throttling_table):
+    table = throttling_table(keys(150), throttled_calls=10)
+    with pytest.raises(UnprocessedItemsError) as raised:
+        batch_get_items(table, "dedup", keys(150), max_attempts=2)
+    assert raised.value.unprocessed == [{"key": {"S": "k99"}}, {"key": {"S": "k149"}}]
+    assert len(raised.value.items) == 148
+    assert table.calls == 4
+
+
+def test_metadata_of_devices_read_before_throttling_is_kept(sleeps, throttling_table):
+    items = [{"key": {"S": device}, "customerid": {"S": "acme"}} for device in ("a", "b")]
+    table = throttling_table(items, throttled_calls=2)
+    requested = []
+    batch_get_item = table.batch_get_item
+
+    def recording_batch_get_item(RequestItems):
+        requested.append(sorted(key["key"]["S"] for key in RequestItems["metadata"]["Keys"]))
+        return batch_get_item(RequestItems)
+
+    table.batch_get_item = recording_batch_get_item
+    resolver = MetadataResolver(DynamoDBBackend(table, "metadata", key_name="key", max_attempts=2))
+    with contextlib.redirect_stdout(io.StringIO()):
+        resolved = resolver.resolve_many(["a", "b", "c"])
+
+    ### the key left by the first attempt is left again by the retry
+    assert requested[0] == ["a", "b", "c"]
+    ((unresolved,),) = requested[1:]
+    assert resolved[unresolved] is None
+    for device in {"a", "b", "c"} - {unresolved}:
+        assert resolved[device] == ({"customerid": "acme"} if device != "c" else None)
+
+    ### only the unresolved device is looked up again, the others were cached
+    requested.clear()
+    resolved = resolver.resolve_many(["a", "b", "c"])
+    assert requested == [[unresolved]]
+    assert resolved == {"a": {"customerid": "acme"}, "b": {"customerid": "acme"}, "c": None}
@@ -0,0 +1,121 @@
+from collections import defaultdict
+
+import pytest
+
+from geo_tiles import TileAggregator, geohash
+
+
+class Clock:
+    def __init__(self, now=1700000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def measure(record, name):
+    return next((value["Value"] for value in record["MeasureValues"] if value["Name"] == name), None)
+
+
+def dimension(record, name):
+    return next((value["Value"] for value in record["Dimensions"] if value["Name"] == name), None)
+
+
+def message(device, latitude, longitude, timestamp=1700000000000):
+    return {"deviceid": device, "timestamp": timestamp, "location": {"latitude": latitude, "longitude": longitude}}
+
+
+@pytest.mark.parametrize("latitude, longitude, expected", [
+    (42.6, -5.6, "ezs42"),
+    (57.64911, 10.40744, "u4pruydqqvj"),
+    (-25.382708, -49.265506, "6gkzwgjzn820"),
+    (0.0, 0.0, "s0000"),
+    (-90.0, -180.0, "00000"),
+    (90.0, 180.0, "zzzzz"),
+])
+def test_geohash_matches_known_vectors(latitude, longitude, expected):
+    assert geohash(latitude, longitude, len(expected)) == expected
+
+
+def test_tile_codes_are_prefixes_of_the_device_geohash():
+    aggregator = TileAggregator(clock=Clock())
+    aggregator.add(message("a", 57.64911, 10.40744))
+    assert sorted(code for _, code, _ in aggregator.tiles) == ["u4", "u4p", "u4pr"]
+
+
+def merge(records):
+    ### what the fleet map queries do: add up the partials of each tile
+    tiles = defaultdict(lambda: [0, 0.0, 0.0])
+    for record in records:
+        key = (dimension(record, "tile_precision"), dimension(record, "tile"))
+        count = int(measure(record, "devices"))
+        tiles[key][0] += count
+        if count:
+            tiles[key][1] += float(measure(record, "latitude")) * count
+            tiles[key][2] += float(measure(record, "longitude")) * count
+    return {key: (count, round(latitude / count, 4), round(longitude / count, 4))
+            for key, (count, latitude, longitude) in tiles.items() if count}
+
+
+def test_partials_add_up_to_the_whole_fleet():
+    positions = [("d%d" % index, 40.0 + index * 0.37, -3.0 + index * 0.91) for index in range(40)]
+    clock = Clock()
+    whole = TileAggregator(partial_id="whole", clock=clock)
+    partials = [TileAggregator(partial_id="p%d" % index, clock=clock) for index in range(3)]
+    for index, (device, latitude, longitude) in enumerate(positions):
+        whole.add(message(device, latitude, longitude))
+        partials[index % 3].add(message(device, latitude, longitude))
+
+    records = [record for partial in partials for record in partial.flush(force=True)]
+    assert {dimension(record, "partial") for record in records} == {"p0", "p1", "p2"}
+    assert merge(records) == merge(whole.flush(force=True))
+    assert sum(count for (precision, _), (count, _, _) in merge(records).items() if precision == "2") == 40
+
+
+def test_moved_device_leaves_its_old_tile_once():
+    clock = Clock()
+    aggregator = TileAggregator(flush_interval=60, clock=clock)
+    aggregator.add(message("a", 42.6, -5.6, 1700000000000))
+    aggregator.flush(force=True)
+
+    aggregator.add(message("a", -25.38, -49.26, 1700000001000))
+    clock.now += 60
+    records = aggregator.flush()
+    counts = {(dimension(record, "tile_precision"), dimension(record, "tile")): measure(record, "devices")
+              for record in records}
+    assert counts == {("2", "ez"): "0", ("3", "ezs"): "0", ("4", "ezs4"): "0",
+                      ("2", "6g"): "1", ("3", "6gk"): "1", ("4", "6gkz"): "1"}
+    assert sorted(code for _, code, _ in aggregator.tiles) == ["6g", "6gk", "6gkz"]
+
+    ### an out of order message does not move the device back
+    aggregator.add(message("a", 42.6, -5.6, 1700000000500))
+    clock.now += 60
+    assert aggregator.flush() == []
+
+
+def test_inactive_devices_stop_counting():
+    clock = Clock()
+    aggregator = TileAggregator(active_seconds=60, clock=clock)
+    aggregator.add(message("a", 42.6, -5.6, 1700000000000))
+    aggregator.add(message("b", -25.38, -49.26, 1700000100000))
+    merged = merge(aggregator.flush(force=True))
+    assert merged[("2", "6g")][0] == 1
+    assert ("2", "ez") not in merged
+    assert list(aggregator.devices) == ["b"]
+
+
+def test_tenants_are_written_as_their_own_partials():
+    aggregator = TileAggregator(partial_id="p", tenant_dimension="customerid", clock=Clock())
+    aggregator.add(message("a", 42.6, -5.6), "acme")
+    aggregator.add(message("b", 42.6, -5.6), "")
+    aggregator.add(message("c", 42.6, -5.6), None)
+
+    records = aggregator.flush(force=True)
+    assert all(item["Value"] for record in records for item in record["Dimensions"])
+    series = [(dimension(record, "partial"), dimension(record, "tile_precision")) for record in records]
+    assert len(series) == len(set(series))
+
+    partials = defaultdict(int)
+    for record in records:
+        partials[dimension(record, "partial"), dimension(record, "customerid")] += int(measure(record, "devices"))
+    assert partials == {("p-acme", "acme"): 3, ("p", None): 6}
@@ -0,0 +1,40 @@
+import json
+
+from metrics import InvocationMetrics
+
+
+def emitted(metrics):
+    lines = []
+    metrics.emit = lines.append
+    metrics.finish()
+    return [json.loads(line) for line in lines]
+
+
+def test_metrics_line_is_an_emf_document():
+    metrics = InvocationMetrics("IoTTelemetry", {"FunctionName": "ingest"})
+    metrics.begin()
+    metrics.checkpoint("Parse")
+    metrics.count("Records", 3)
+    metrics.set("RequestId", "abc")
+
+    document, = emitted(metrics)
+    directive, = document["_aws"]["CloudWatchMetrics"]
+    assert directive["Namespace"] == "IoTTelemetry"
+    assert directive["Dimensions"] == [["FunctionName"]]
+    assert {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]} == {
+        "ParseTime": "Milliseconds", "TotalTime": "Milliseconds", "Records": "Count"}
+    assert document["FunctionName"] == "ingest"
+    assert document["Records"] == 3
+    assert document["RequestId"] == "abc"
+    assert isinstance(document["_aws"]["Timestamp"], int)
+
+
+def test_metrics_line_without_values_is_valid_json():
+    metrics = InvocationMetrics("IoTTelemetry")
+    metrics.begin()
+    document = json.loads(metrics.serialize())
+    assert set(document) == {"_aws"}
+    assert document["_aws"]["CloudWatchMetrics"] == [{"Namespace": "IoTTelemetry", "Dimensions": [[]], "Metrics": []}]
+
+    document, = emitted(metrics)
+    assert set(document) == {"_aws", "TotalTime"}
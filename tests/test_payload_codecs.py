@@ -0,0 +1,100 @@
+import base64
+import json
+import time
+
+import pytest
+
+import payload_codecs
+from payload_codecs import PayloadError, decode_envelope, decode_payload, detect_encoding, encode_payload
+
+PAYLOAD = {
+    "deviceid": "device-0042",
+    "timestamp": 1700000000123,
+    "temperature": -12,
+    "signal_strength": -71.25,
+    "location": {"latitude": 47.6062095, "longitude": -122.3320708},
+    "fuel_level": 63.5,
+    "battery_level": 98.25,
+}
+
+
+@pytest.mark.parametrize("encoding", payload_codecs.ENCODERS)
+def test_generated_payloads_round_trip(encoding, generator):
+    for payload in generator(device_count=20).generate(200) + [PAYLOAD]:
+        encoded = encode_payload(payload, encoding)
+        assert detect_encoding(encoded) == encoding
+        assert decode_payload(encoded) == payload
+        assert decode_payload(memoryview(encoded)) == payload
+
+
+def test_content_type_wins_over_the_first_byte():
+    encoded = encode_payload(PAYLOAD, "packed")
+    assert decode_payload(encoded, "application/vnd.iot-telemetry.packed; v=1") == PAYLOAD
+    with pytest.raises(ValueError):
+        decode_payload(encoded, "application/json")
+
+
+def test_envelope_of_the_binary_rule_is_decoded():
+    envelope = {"payload": base64.b64encode(encode_payload(PAYLOAD, "packed")).decode("ascii"), "contentType": None}
+    assert decode_envelope(envelope) == PAYLOAD
+
+
+@pytest.mark.parametrize("data, encoding", [
+    (b"\x01", "packed"),
+    (b'{"deviceid": "a"}', "json"),
+    (b"[1]", "json"),
+    (b"\x02\x00", "json"),
+])
+def test_detect_encoding(data, encoding):
+    assert detect_encoding(data) == encoding
+
+
+def test_empty_payload_is_rejected():
+    with pytest.raises(PayloadError, match="empty payload"):
+        detect_encoding(b"")
+    with pytest.raises(PayloadError, match="empty payload"):
+        decode_payload(b"")
+
+
+@pytest.mark.parametrize("mutate, message", [
+    (lambda data: data[:10], "truncated payload"),
+    (lambda data: data[:-1], "length does not match"),
+    (lambda data: data + b"x", "length does not match"),
+    (lambda data: b"\x02" + data[1:], "unsupported packed payload version 2"),
+])
+def test_malformed_packed_payloads_are_rejected(mutate, message):
+    with pytest.raises(PayloadError, match=message):
+        payload_codecs.decode_packed(mutate(encode_payload(PAYLOAD, "packed")))
+
+
+@pytest.mark.parametrize("field, value", [
+    ("temperature", 40000),
+    ("timestamp", -1),
+    ("fuel_level", 700),
+])
+def test_values_outside_the_packed_layout_are_rejected(field, value):
+    with pytest.raises(PayloadError, match="does not fit the packed layout"):
+        encode_payload(dict(PAYLOAD, **{field: value}), "packed")
+
+
+@pytest.mark.parametrize("data", [b'{"deviceid": ', b"\xff\xfe", b"not json"])
+def test_malformed_json_payloads_are_rejected(data):
+    with pytest.raises(ValueError):
+        decode_payload(data)
+
+
+def test_malformed_binary_payloads_are_quarantined(load_handler):
+    module = load_handler()
+    current = dict(PAYLOAD, timestamp=int(time.time() * 1000))
+    valid = base64.b64encode(encode_payload(current, "packed")).decode("ascii")
+    truncated = base64.b64encode(encode_payload(PAYLOAD, "packed")[:12]).decode("ascii")
+    sent = []
+    module.quarantine_sink.send = lambda items, database, table: sent.extend(items)
+
+    module.lambda_handler([{"payload": valid, "contentType": None}, {"payload": truncated, "contentType": None}],
+                          None)
+
+    assert [reason for _, reason, _ in sent] == ["INVALID_PAYLOAD"]
+    assert "truncated payload" in sent[0][2]
+    assert json.dumps(sent[0][0])
+    assert module.write_client.records == 1
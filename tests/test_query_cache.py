@@ -0,0 +1,193 @@
+import os
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+sys.path.insert(0, os.path.join(ROOT, "resources", "lambda", "query_cache"))
+
+from query_cache import MemoryCacheStore, QueryCache, normalize_query, plan_query  # noqa: E402
+from timestream_local import LocalTimestream  # noqa: E402
+
+NS = 10 ** 9
+ALIGN_NS = 10 * NS
+LATE_NS = 60 * NS
+SETTLED_NS = 300 * NS
+### a multiple of every alignment used below
+NOW = 1700000040.0
+BINNED = ('SELECT bin(time, 1m) AS t, count(*) AS n FROM "iot"."telemetry" '
+          'WHERE time > ago(10m) GROUP BY bin(time, 1m) ORDER BY t')
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def plan(sql, now=NOW, table_late_ns=None):
+    return plan_query(sql, int(now * NS), ALIGN_NS, LATE_NS, SETTLED_NS, table_late_ns)
+
+
+def test_normalize_collapses_whitespace_and_comments_only():
+    sql = "SELECT  *\n  FROM t -- latest\n WHERE a = 'x  --  y' /* block */ AND \"b  c\" = 1 ;"
+    assert normalize_query(sql) == "SELECT * FROM t WHERE a = 'x  --  y' AND \"b  c\" = 1"
+
+
+def test_refreshes_within_an_interval_share_one_aligned_query():
+    first, second = plan(BINNED, NOW + 1), plan(BINNED, NOW + 9.5)
+    assert first.key == second.key
+    assert first.sql == second.sql
+    ### the start moves down to the 1m bin, the end up to the next 10s boundary
+    assert first.start_ns == int(NOW - 600) * NS
+    assert first.end_ns == int(NOW + 10) * NS
+    assert first.expires == first.end_ns
+    assert "from_iso8601_timestamp('2023-11-14T22:04:00.000Z')" in first.sql
+    assert plan(BINNED, NOW + 10.5).key != first.key
+
+
+def test_fixed_ranges_settle_after_the_late_window():
+    sql = ("SELECT time, temperature FROM \"iot\".\"telemetry\" WHERE time BETWEEN "
+           "from_milliseconds(1699990000000) AND from_milliseconds(1699990300000)")
+    settled = plan(sql)
+    assert settled.expires == int(NOW * NS) + SETTLED_NS
+
+    recent = plan(sql, now=1699990300 + 30)
+    assert recent.expires == recent.end_ns
+
+    late = plan(sql, table_late_ns={"telemetry": 3 * 3600 * NS})
+    assert late.expires == late.end_ns
+
+
+def test_queries_without_one_time_range_are_cached_for_the_interval():
+    sql = 'SELECT count(*) FROM "iot"."telemetry"'
+    assert plan(sql).expires == int(NOW * NS) + ALIGN_NS
+    assert plan(sql).key == plan(sql, NOW + 9).key != plan(sql, NOW + 10).key
+
+    volatile = plan('SELECT time FROM "iot"."telemetry" WHERE time > ago(1h) AND time < now() - 5m')
+    assert volatile.partition is None
+
+
+@pytest.mark.parametrize("sql, bucket_s, descending, limit", [
+    (BINNED, 60, False, None),
+    ('SELECT time, temperature FROM "iot"."telemetry" WHERE time > ago(1h) ORDER BY time DESC LIMIT 10',
+     0, True, 10),
+    ("SELECT date_trunc('hour', time) AS h, avg(temperature) FROM \"iot\".\"telemetry\" "
+     "WHERE time > ago(1d) GROUP BY 1", 3600, False, None),
+])
+def test_time_partitioned_queries(sql, bucket_s, descending, limit):
+    partition = plan(sql).partition
+    assert (partition.bucket_ns, partition.descending, partition.limit) == (bucket_s * NS, descending, limit)
+
+
+@pytest.mark.parametrize("sql", [
+    'SELECT avg(temperature) FROM "iot"."telemetry" WHERE time > ago(1h)',
+    'SELECT deviceid, max(time) FROM "iot"."telemetry" WHERE time > ago(1h) GROUP BY deviceid',
+    'SELECT * FROM "iot"."telemetry" WHERE time > ago(1h)',
+    'SELECT bin(time, 1m), count(*) FROM "iot"."telemetry" WHERE time > ago(1h) GROUP BY 1 ORDER BY 2',
+])
+def test_other_queries_are_not_time_partitioned(sql):
+    assert plan(sql).partition is None
+
+
+@pytest.fixture
+def local():
+    clock = Clock(NOW)
+    local = LocalTimestream(clock=clock.time)
+    local.clock_source = clock
+    return local
+
+
+def ingest(local, start, end, step=5):
+    records = [{
+        "Dimensions": [{"Name": "deviceid", "Value": "device-%d" % (second % 3)}],
+        "MeasureName": "telemetry", "MeasureValueType": "MULTI",
+        "MeasureValues": [{"Name": "temperature", "Type": "DOUBLE", "Value": str(second % 40)}],
+        "Time": str(second * 1000),
+    } for second in range(int(start), int(end), step)]
+    for index in range(0, len(records), 100):
+        local.write_records(DatabaseName="iot", TableName="telemetry", Records=records[index:index + 100])
+
+
+def values(rows):
+    return [tuple(datum.get("ScalarValue") for datum in row["Data"]) for row in rows]
+
+
+def test_sliding_window_only_queries_the_tail(local):
+    clock = local.clock_source
+    cache = QueryCache(local, clock=clock.time)
+    ingest(local, NOW - 1800, NOW)
+    cache.query(BINNED)
+
+    for minute in range(1, 4):
+        previous = clock.now
+        clock.now = NOW + minute * 60
+        ingest(local, previous, clock.now)
+        response = cache.query(BINNED)
+        expected = local.query(plan(BINNED, clock.now).sql)
+        assert values(response["Rows"]) == values(expected["Rows"])
+
+    assert cache.stats["upstreamQueries"] == 4
+    assert cache.stats["incremental"] == 3
+    ### each tail re-reads the late window and the new minute, not the whole ten minutes
+    assert cache.stats["upstreamRows"] < 11 + 3 * 4
+
+
+def test_late_rows_inside_the_late_window_are_picked_up(local):
+    clock = local.clock_source
+    cache = QueryCache(local, clock=clock.time)
+    ingest(local, NOW - 1800, NOW)
+    cache.query(BINNED)
+
+    clock.now = NOW + 60
+    ingest(local, NOW - 30, NOW + 60, step=1)
+    response = cache.query(BINNED)
+    assert cache.stats["incremental"] == 1
+    assert values(response["Rows"]) == values(local.query(plan(BINNED, clock.now).sql)["Rows"])
+
+
+def read_pages(cache, sql, **kwargs):
+    pages = [cache.query(sql, **kwargs)]
+    while "NextToken" in pages[-1]:
+        pages.append(cache.query(sql, NextToken=pages[-1]["NextToken"], **kwargs))
+    return pages
+
+
+def test_large_results_are_returned_in_pages(local):
+    clock = local.clock_source
+    ingest(local, NOW - 1800, NOW, step=1)
+    sql = 'SELECT time, deviceid, temperature FROM "iot"."telemetry" WHERE time > ago(30m) ORDER BY time'
+    expected = values(local.query(plan(sql).sql)["Rows"])
+
+    cache = QueryCache(local, page_bytes=20000, clock=clock.time)
+    pages = read_pages(cache, sql)
+    assert len(pages) > 3
+    assert sum((values(page["Rows"]) for page in pages), []) == expected
+    assert len({page["QueryId"] for page in pages}) == 1
+    assert cache.stats["upstreamQueries"] == 1
+
+    pages = read_pages(cache, sql, MaxRows=500)
+    assert [len(page["Rows"]) for page in pages[:-1]] == [len(pages[0]["Rows"])] * (len(pages) - 1)
+    assert sum((values(page["Rows"]) for page in pages), []) == expected
+
+
+def test_pages_are_served_after_the_entry_was_evicted(local):
+    clock = local.clock_source
+    ingest(local, NOW - 1800, NOW, step=1)
+    sql = 'SELECT time, deviceid, temperature FROM "iot"."telemetry" WHERE time > ago(30m) ORDER BY time'
+
+    first = QueryCache(local, page_bytes=20000, clock=clock.time).query(sql)
+    ### another instance without the entry continues the pages
+    other = QueryCache(local, MemoryCacheStore(), page_bytes=20000, clock=clock.time)
+    second = other.query(sql, NextToken=first["NextToken"])
+    assert other.stats["pageMisses"] == 1
+    assert values(second["Rows"])[0] > values(first["Rows"])[-1]
+
+
+def test_invalid_tokens_are_rejected(local):
+    cache = QueryCache(local)
+    with pytest.raises(ValueError, match="Invalid NextToken"):
+        cache.query("SELECT 1", NextToken="not-a-token")
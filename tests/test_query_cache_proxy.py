@@ -0,0 +1,65 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+from conftest import ROOT
+
+PROXY_PATH = os.path.join(ROOT, "resources", "lambda", "query_cache", "query-cache-proxy.py")
+
+
+class StaticQueryCache:
+    def query(self, sql, NextToken=None, MaxRows=None):
+        return {"QueryId": "1", "Rows": [], "ColumnInfo": []}
+
+
+@pytest.fixture
+def load_proxy(monkeypatch):
+    monkeypatch.syspath_prepend(os.path.dirname(PROXY_PATH))
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    for name in ("QueryCacheToken", "QueryCacheTokenSecret", "QueryCacheTable"):
+        monkeypatch.delenv(name, raising=False)
+
+    def load(token=None):
+        if token:
+            monkeypatch.setenv("QueryCacheToken", token)
+        spec = importlib.util.spec_from_file_location("query_cache_proxy", PROXY_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.query_cache = StaticQueryCache()
+        return module
+
+    return load
+
+
+def query_event(headers=None, path="/"):
+    return {
+        "rawPath": path,
+        "headers": dict({"X-Amz-Target": "Timestream_20181101.Query", "Host": "cache.example"}, **(headers or {})),
+        "body": json.dumps({"QueryString": "SELECT 1"}),
+    }
+
+
+def test_requests_are_denied_without_a_configured_token(load_proxy):
+    proxy = load_proxy()
+    response = proxy.lambda_handler(query_event({"X-Query-Cache-Token": ""}), None)
+    assert response["statusCode"] == 403
+
+
+def test_token_is_read_from_the_header_only(load_proxy):
+    proxy = load_proxy("secret")
+    assert proxy.lambda_handler(query_event(), None)["statusCode"] == 403
+    assert proxy.lambda_handler(query_event(path="/secret/"), None)["statusCode"] == 403
+    assert proxy.lambda_handler(query_event({"X-Query-Cache-Token": "wrong"}), None)["statusCode"] == 403
+
+    response = proxy.lambda_handler(query_event({"X-Query-Cache-Token": "secret"}), None)
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"])["QueryId"] == "1"
+
+
+def test_endpoint_discovery_does_not_expose_the_token(load_proxy):
+    proxy = load_proxy("secret")
+    event = query_event({"X-Amz-Target": "Timestream_20181101.DescribeEndpoints", "X-Query-Cache-Token": "secret"})
+    body = json.loads(proxy.lambda_handler(event, None)["body"])
+    assert body["Endpoints"][0]["Address"] == "cache.example"
@@ -0,0 +1,44 @@
+import contextlib
+import io
+
+import pytest
+
+from telemetry_generator import LocalContext
+
+
+class ThrottledClient:
+    ### write client whose every call is throttled
+
+    def __init__(self, exceptions):
+        self.exceptions = exceptions
+
+    def write_records(self, **request):
+        raise self.exceptions.ThrottlingException(
+            {"Error": {"Code": "ThrottlingException", "Message": "slow down"}}, "WriteRecords")
+
+
+def measure(record, name):
+    return next(float(value["Value"]) for value in record["MeasureValues"] if value["Name"] == name)
+
+
+def test_redelivered_failed_batch_is_aggregated_once(load_handler, generator):
+    module = load_handler(RollupTable="device-telemetry-rollup")
+    batch = generator(device_count=3).generate(30)
+    recording = module.write_client
+
+    module.writer.write_client = ThrottledClient(recording.exceptions)
+    module.writer.max_attempts = 1
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = module.lambda_handler({"Records": [
+            {"messageId": str(index), "body": payload} for index, payload in enumerate(batch)]}, LocalContext())
+    assert len(response["batchItemFailures"]) == 30
+
+    module.writer.write_client = recording
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.lambda_handler(batch, LocalContext())
+    rollups = [record for record in module.rollup_aggregator.flush(force=True)
+               if record["Dimensions"][1]["Value"] == "1m"]
+
+    assert sum(measure(record, "battery_level_count") for record in rollups) == 30
+    assert sum(measure(record, "battery_level_sum") for record in rollups) == pytest.approx(
+        sum(payload["battery_level"] for payload in batch))
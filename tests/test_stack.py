@@ -0,0 +1,169 @@
+import json
+
+import aws_cdk as cdk
+import pytest
+from aws_cdk.assertions import Match, Template
+
+from conftest import ROOT
+
+
+@pytest.fixture
+def synth(monkeypatch):
+    ### asset paths of the stack are relative to the repository root
+    monkeypatch.chdir(ROOT)
+    from cdkstack.monitor_iot_with_grafana import monitor_iot_with_grafana
+
+    def create(**context):
+        app = cdk.App(context=context)
+        return Template.from_stack(monitor_iot_with_grafana(app, "monitor-iot-with-grafana"))
+
+    return create
+
+
+def logical_id(template, resource_type, prefix):
+    found = [name for name in template.find_resources(resource_type) if name.startswith(prefix)]
+    assert len(found) == 1, found
+    return found[0]
+
+
+def arn_of(name):
+    return {"Fn::GetAtt": [name, "Arn"]}
+
+
+def assert_writer_dead_letter_queue(template):
+    ### records Timestream rejected are sent by the function itself, in the dead_letter.py format
+    queue = logical_id(template, "AWS::SQS::Queue", "telemetrydeadletterqueue")
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "process-telemetry-data.lambda_handler",
+        "Environment": {"Variables": Match.object_like({"DeadLetterQueueUrl": {"Ref": queue}})},
+    })
+    return queue
+
+
+def test_direct_mode_invokes_the_function_from_the_rules(synth):
+    template = synth(ingestion_mode="direct")
+
+    assert_writer_dead_letter_queue(template)
+    template.resource_count_is("AWS::Kinesis::Stream", 0)
+    template.resource_count_is("AWS::Lambda::EventSourceMapping", 0)
+    template.resource_count_is("AWS::SQS::Queue", 2)
+    template.resource_properties_count_is("AWS::Lambda::Permission", {"Principal": "iot.amazonaws.com"}, 2)
+    template.has_resource_properties("AWS::IoT::TopicRule", {
+        "TopicRulePayload": Match.object_like({"Actions": [{"Lambda": Match.any_value()}]}),
+    })
+
+
+def test_kinesis_failures_go_to_the_buffer_dead_letter_queue(synth):
+    template = synth(ingestion_mode="kinesis", batch_size="500", kinesis_shards="2")
+
+    writer_queue = assert_writer_dead_letter_queue(template)
+    buffer_queue = logical_id(template, "AWS::SQS::Queue", "telemetryingestionbufferbufferdeadletterqueue")
+    stream = logical_id(template, "AWS::Kinesis::Stream", "telemetryingestionbuffertelemetrystream")
+    assert buffer_queue != writer_queue
+
+    template.has_resource_properties("AWS::Kinesis::Stream", {"ShardCount": 2})
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "EventSourceArn": arn_of(stream),
+        "BatchSize": 500,
+        "FunctionResponseTypes": ["ReportBatchItemFailures"],
+        "BisectBatchOnFunctionError": True,
+        "DestinationConfig": {"OnFailure": {"Destination": arn_of(buffer_queue)}},
+    })
+    template.has_resource_properties("AWS::IoT::TopicRule", {
+        "TopicRulePayload": Match.object_like({
+            "Actions": [{"Kinesis": Match.object_like({"PartitionKey": "${deviceid}"})}],
+        }),
+    })
+    template.resource_count_is("AWS::Lambda::Permission", 0)
+
+
+def test_sqs_redrive_goes_to_the_buffer_dead_letter_queue(synth):
+    template = synth(ingestion_mode="sqs")
+
+    writer_queue = assert_writer_dead_letter_queue(template)
+    buffer_queue = logical_id(template, "AWS::SQS::Queue", "telemetryingestionbufferbufferdeadletterqueue")
+    queue = logical_id(template, "AWS::SQS::Queue", "telemetryingestionbuffertelemetryqueue")
+    assert buffer_queue != writer_queue
+
+    template.has_resource_properties("AWS::SQS::Queue", {
+        "RedrivePolicy": {"deadLetterTargetArn": arn_of(buffer_queue), "maxReceiveCount": 5},
+    })
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "EventSourceArn": arn_of(queue),
+        "FunctionResponseTypes": ["ReportBatchItemFailures"],
+    })
+    template.has_resource_properties("AWS::IoT::TopicRule", {
+        "TopicRulePayload": Match.object_like({"Actions": [{"Sqs": Match.object_like({"UseBase64": False})}]}),
+    })
+
+
+def test_unknown_ingestion_mode_is_rejected(synth):
+    with pytest.raises(ValueError, match="ingestion_mode"):
+        synth(ingestion_mode="firehose")
+
+
+def timestream_tables(template):
+    return sorted(table["Properties"]["TableName"] for table in template.find_resources("AWS::Timestream::Table").values())
+
+
+def telemetry_environment(template):
+    (function,) = [function for function in template.find_resources("AWS::Lambda::Function").values()
+                   if function["Properties"].get("Handler") == "process-telemetry-data.lambda_handler"]
+    return function["Properties"]["Environment"]["Variables"]
+
+
+def setup_environment(template):
+    (function,) = [function for function in template.find_resources("AWS::Lambda::Function").values()
+                   if function["Properties"].get("Handler") == "dashboard_setup.lambda_handler"]
+    return function["Properties"]["Environment"]["Variables"]
+
+
+def test_rollups_are_opt_in(synth):
+    template = synth()
+    assert "device-telemetry-rollup" not in timestream_tables(template)
+    assert "RollupTable" not in telemetry_environment(template)
+    assert "device-telemetry-rollup" not in json.loads(setup_environment(template)["TimestreamTables"])
+
+    template = synth(rollups="true")
+    assert "device-telemetry-rollup" in timestream_tables(template)
+    assert telemetry_environment(template)["RollupTable"] == "device-telemetry-rollup"
+    assert "device-telemetry-rollup" in json.loads(setup_environment(template)["TimestreamTables"])
+
+
+def test_device_state_is_opt_in(synth):
+    template = synth()
+    assert "device-state" not in timestream_tables(template)
+    assert "StateTable" not in telemetry_environment(template)
+    assert "device-state" not in json.loads(setup_environment(template)["TimestreamTables"])
+
+    template = synth(device_state="true")
+    assert "device-state" in timestream_tables(template)
+    assert telemetry_environment(template)["StateTable"] == "device-state"
+    assert "device-state" in json.loads(setup_environment(template)["TimestreamTables"])
+
+
+def test_device_health_is_opt_in(synth):
+    template = synth()
+    assert "device-health" not in timestream_tables(template)
+    assert not {"HealthTable", "HealthCheckpointTable", "HealthIntervalSeconds"} & set(telemetry_environment(template))
+    assert not [name for name in template.find_resources("AWS::DynamoDB::Table") if name.startswith("devicehealthcheckpoint")]
+
+    template = synth(health="true", health_interval_seconds="60")
+    assert "device-health" in timestream_tables(template)
+    environment = telemetry_environment(template)
+    assert environment["HealthTable"] == "device-health"
+    assert environment["HealthCheckpointTable"] == {"Ref": logical_id(template, "AWS::DynamoDB::Table", "devicehealthcheckpoint")}
+    assert environment["HealthIntervalSeconds"] == "60"
+    assert "device-health" in json.loads(setup_environment(template)["TimestreamTables"])
+
+
+def test_geo_tiles_are_opt_in(synth):
+    template = synth()
+    assert "device-geo-tiles" not in timestream_tables(template)
+    assert "GeoTileTable" not in telemetry_environment(template)
+    assert "device-geo-tiles" not in json.loads(setup_environment(template)["TimestreamTables"])
+
+    template = synth(geo_tiles="true")
+    assert "device-geo-tiles" in timestream_tables(template)
+    assert telemetry_environment(template)["GeoTileTable"] == "device-geo-tiles"
+    assert "device-geo-tiles" in json.loads(setup_environment(template)["TimestreamTables"])
@@ -0,0 +1,24 @@
+import io
+import json
+import time
+
+from telemetry_generator import history_start_ms, jsonl_lines, write_jsonl
+
+
+def test_jsonl_lines_match_the_encoded_payloads(generator):
+    options = {"device_count": 50, "start_time_ms": 1700000000000, "out_of_order": 0.1, "duplicates": 0.1}
+    dumps = json.JSONEncoder(separators=(",", ":")).encode
+    expected = [dumps(payload) for payload in generator(**options).generate(2000)]
+    assert jsonl_lines(generator(**options).generate_columns(2000)) == expected
+
+
+def test_generated_history_ends_now(generator):
+    output = io.StringIO()
+    now_ms = int(time.time() * 1000)
+    source = generator(rate=100.0, start_time_ms=history_start_ms(5000, 100.0))
+    assert write_jsonl(source, 5000, output, batch_size=1000) == 5000
+
+    timestamps = [json.loads(line)["timestamp"] for line in output.getvalue().splitlines()]
+    assert len(timestamps) == 5000
+    assert now_ms - 50000 - 1000 <= timestamps[0] <= now_ms - 49000
+    assert max(timestamps) <= int(time.time() * 1000)
@@ -0,0 +1,58 @@
+import contextlib
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+from conftest import LAMBDA_DIR, ROOT
+from cdkstack.telemetry_package import BOTOCORE_VERSION, LAMBDA_CLIENT_SERVICES, build_package
+
+
+def test_requirements_pin_the_vendored_botocore():
+    with open(os.path.join(ROOT, "requirements.txt"), encoding="utf-8") as f:
+        pins = dict(re.findall(r"^([\w.-]+)==(\S+)$", f.read(), re.MULTILINE))
+    assert pins["botocore"] == BOTOCORE_VERSION
+
+
+def test_package_vendors_trimmed_botocore(tmp_path):
+    build_package(LAMBDA_DIR, str(tmp_path))
+
+    data_dir = tmp_path / "botocore" / "data"
+    models = sorted(path.name for path in data_dir.iterdir() if path.is_dir())
+    assert models == sorted(LAMBDA_CLIENT_SERVICES)
+    with open(data_dir / "endpoints.json", encoding="utf-8") as f:
+        services = {name for partition in json.load(f)["partitions"] for name in partition["services"]}
+    assert services == {"ingest.timestream", "dynamodb", "sqs"}
+    assert (tmp_path / "device-meta.marshal").exists()
+
+    ### the function's clients are created from the vendored botocore, not the build environment's
+    probe = (
+        "import aws_clients, botocore\n"
+        "print(botocore.__version__, botocore.__file__)\n"
+        "for service in %r: aws_clients.create_client(service, region_name='us-east-1')\n" % (LAMBDA_CLIENT_SERVICES,)
+    )
+    output = subprocess.run([sys.executable, "-c", probe], cwd=str(tmp_path), capture_output=True, text=True,
+                            check=True, env=dict(os.environ, PYTHONPATH=str(tmp_path))).stdout.split()
+    assert output[0] == BOTOCORE_VERSION
+    assert output[1].startswith(str(tmp_path))
+
+
+def test_package_is_only_built_by_the_runtime_python(tmp_path, monkeypatch):
+    import aws_cdk as cdk
+
+    from cdkstack import telemetry_package
+    from cdkstack.lambda_packaging import TelemetryLambdaBundler
+
+    assert cdk.aws_lambda.Runtime.PYTHON_3_11.name == "python%d.%d" % telemetry_package.LAMBDA_PYTHON_VERSION
+    monkeypatch.setattr(telemetry_package, "LAMBDA_PYTHON_VERSION", (3, 99))
+    with pytest.raises(telemetry_package.PythonVersionError, match="built with Python 3.99"):
+        build_package(LAMBDA_DIR, str(tmp_path))
+    assert list(tmp_path.iterdir()) == []
+
+    ### local bundling then falls back to the docker bundling image
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert TelemetryLambdaBundler(LAMBDA_DIR).try_bundle(str(tmp_path)) is False
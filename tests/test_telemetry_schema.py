@@ -0,0 +1,278 @@
+import contextlib
+import io
+import os
+import time
+
+import pytest
+
+from conftest import LAMBDA_DIR
+from telemetry_schema import PayloadValidator, RecordEncoder, load_schema
+
+SCHEMA = {
+    "measure_name": "telemetry",
+    "time": {"source": "timestamp"},
+    "dimensions": [
+        {"name": "deviceid", "source": "deviceid"},
+        {"name": "site", "source": "location.site"},
+    ],
+    "measures": [
+        {"name": "temperature", "source": "temperature", "type": "BIGINT"},
+        {"name": "latitude", "source": "location.latitude", "type": "DOUBLE"},
+        {"name": "ignition", "source": "ignition", "type": "BOOLEAN"},
+        {"name": "firmware", "source": "firmware", "type": "VARCHAR", "required": False},
+        {"name": "last_service", "source": "service.last", "type": "TIMESTAMP", "required": False},
+        {"name": "odometer", "source": "odometer", "type": "DOUBLE", "required": False},
+    ],
+    "metadata": [
+        {"name": "equipmentid", "type": "VARCHAR"},
+        {"name": "customerid", "type": "VARCHAR"},
+        {"name": "capacity", "type": "BIGINT"},
+    ],
+}
+
+TIMESTREAM_TEXT = {
+    "BIGINT": str,
+    "DOUBLE": repr,
+    "BOOLEAN": lambda value: "true" if value else "false",
+    "VARCHAR": str,
+    "TIMESTAMP": str,
+}
+
+
+def lookup(telemetry, source):
+    value = telemetry
+    for key in source.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def reference_record(schema, telemetry, metadata, dimension_metadata=()):
+    ### the record written out field by field, without compiled code or caching
+    dimensions = [{"Name": dimension["name"], "Value": str(lookup(telemetry, dimension["source"]))}
+                  for dimension in schema["dimensions"]]
+    dimensions += [{"Name": name, "Value": str(metadata[name])}
+                   for name in dimension_metadata if metadata.get(name) not in (None, "")]
+    values = []
+    for measure in schema["measures"]:
+        value = lookup(telemetry, measure["source"])
+        if value is None and not measure.get("required", True):
+            continue
+        values.append({"Name": measure["name"], "Value": TIMESTREAM_TEXT[measure["type"]](value),
+                       "Type": measure["type"]})
+    for field in schema["metadata"]:
+        if field["name"] not in dimension_metadata and metadata.get(field["name"]) is not None:
+            values.append({"Name": field["name"], "Value": str(metadata[field["name"]]), "Type": field["type"]})
+    return {"Dimensions": dimensions, "MeasureName": schema["measure_name"], "MeasureValues": values,
+            "MeasureValueType": "MULTI", "Time": str(telemetry["timestamp"])}
+
+
+def payload(device, index, **fields):
+    telemetry = {
+        "deviceid": device,
+        "timestamp": 1700000000000 + index,
+        "temperature": 20 + index,
+        "location": {"latitude": 47.5 + index / 1000, "site": "plant-1"},
+        "ignition": index % 2 == 0,
+        "firmware": "1.%d" % index,
+        "service": {"last": 1690000000000 + index},
+        "odometer": 1000.25 + index,
+    }
+    telemetry.update(fields)
+    return telemetry
+
+
+def assert_same_records(encoder, messages, dimension_metadata=()):
+    for telemetry, metadata in messages:
+        expected = reference_record(SCHEMA, telemetry, metadata, dimension_metadata)
+        assert encoder.encode(telemetry, metadata) == expected
+
+
+def test_every_value_type_matches_the_reference():
+    encoder = RecordEncoder(SCHEMA)
+    metadata = {"equipmentid": "eq-1", "customerid": "c-1", "capacity": 40}
+    record = encoder.encode(payload("d-1", 3), metadata)
+
+    assert {value["Name"]: (value["Type"], value["Value"]) for value in record["MeasureValues"]} == {
+        "temperature": ("BIGINT", "23"),
+        "latitude": ("DOUBLE", "47.503"),
+        "ignition": ("BOOLEAN", "false"),
+        "firmware": ("VARCHAR", "1.3"),
+        "last_service": ("TIMESTAMP", "1690000000003"),
+        "odometer": ("DOUBLE", "1003.25"),
+        "equipmentid": ("VARCHAR", "eq-1"),
+        "customerid": ("VARCHAR", "c-1"),
+        "capacity": ("BIGINT", "40"),
+    }
+    assert_same_records(encoder, [(payload("d-1", index), metadata) for index in range(10)])
+
+
+@pytest.mark.parametrize("missing", [
+    {"firmware": None},
+    {"service": {}},
+    {"service": None},
+    {"service": "not an object"},
+    {"odometer": None, "firmware": None, "service": {"last": None}},
+])
+def test_missing_optional_fields_are_left_out(missing):
+    encoder = RecordEncoder(SCHEMA)
+    metadata = {"equipmentid": "eq-1"}
+    telemetry = payload("d-1", 1, **missing)
+    names = [value["Name"] for value in encoder.encode(telemetry, metadata)["MeasureValues"]]
+
+    assert "temperature" in names and "equipmentid" in names
+    assert_same_records(encoder, [(telemetry, metadata), (payload("d-1", 2), metadata)])
+
+
+def test_missing_required_fields_raise():
+    encoder = RecordEncoder(SCHEMA)
+    telemetry = payload("d-1", 1)
+    del telemetry["temperature"]
+    with pytest.raises(KeyError):
+        encoder.encode(telemetry, {})
+
+
+def test_changed_metadata_of_a_device_is_encoded():
+    encoder = RecordEncoder(SCHEMA, dimension_metadata=("customerid",))
+    first = {"equipmentid": "eq-1", "customerid": "c-1", "capacity": 40}
+    changed = {"equipmentid": "eq-2", "customerid": "c-2"}
+    cleared = {"equipmentid": None, "customerid": ""}
+    messages = [
+        (payload("d-1", 0), first),
+        (payload("d-2", 1), changed),
+        (payload("d-1", 2), first),
+        (payload("d-1", 3), changed),
+        (payload("d-1", 4), dict(changed)),
+        (payload("d-1", 5), cleared),
+        (payload("d-1", 6), {}),
+        (payload("d-1", 7), first),
+    ]
+    assert_same_records(encoder, messages, dimension_metadata=("customerid",))
+
+    dimensions = [encoder.encode(telemetry, metadata)["Dimensions"][-1]["Value"] for telemetry, metadata in messages]
+    assert dimensions == ["c-1", "c-2", "c-1", "c-2", "c-2", "plant-1", "plant-1", "c-1"]
+
+
+def test_static_parts_are_shared_while_metadata_is_unchanged():
+    encoder = RecordEncoder(SCHEMA)
+    metadata = {"equipmentid": "eq-1"}
+    first = encoder.encode(payload("d-1", 0), metadata)
+    second = encoder.encode(payload("d-1", 1), metadata)
+    assert first["Dimensions"] is second["Dimensions"]
+
+    third = encoder.encode(payload("d-1", 2), {"equipmentid": "eq-1"})
+    assert third["Dimensions"] is not first["Dimensions"]
+    assert third["Dimensions"] == first["Dimensions"]
+
+
+NOW_MS = 1700000000000
+HOUR_MS = 3600 * 1000
+
+
+@pytest.fixture
+def validator():
+    schema = load_schema(os.path.join(LAMBDA_DIR, "telemetry-schema.json"))
+    return PayloadValidator(schema, memory_store_hours=6, clock=lambda: NOW_MS / 1000)
+
+
+def valid_payload(**fields):
+    telemetry = {
+        "deviceid": "device-1",
+        "timestamp": NOW_MS,
+        "temperature": 21,
+        "signal_strength": -70.5,
+        "location": {"latitude": 47.6, "longitude": -122.3},
+        "fuel_level": 50.0,
+        "battery_level": 99.5,
+    }
+    telemetry.update(fields)
+    return telemetry
+
+
+def without(name):
+    telemetry = valid_payload()
+    del telemetry[name]
+    return telemetry
+
+
+@pytest.mark.parametrize("telemetry, reasons", [
+    (valid_payload(), []),
+    (valid_payload(temperature=-100, battery_level=100, fuel_level=0, signal_strength=0), []),
+    (valid_payload(signal_strength=-70), []),
+    ([1, 2], ["payload: expected a JSON object"]),
+    ("text", ["payload: expected a JSON object"]),
+    (without("deviceid"), ["deviceid: missing"]),
+    (valid_payload(deviceid=""), ["deviceid: empty"]),
+    (valid_payload(deviceid=7), ["deviceid: expected str, got int"]),
+    (without("timestamp"), ["timestamp: missing"]),
+    (valid_payload(timestamp="1700000000000"), ["timestamp: expected int, got str"]),
+    (valid_payload(timestamp=1.7e12), ["timestamp: expected int, got float"]),
+    (without("temperature"), ["temperature: missing"]),
+    (valid_payload(temperature=21.5), ["temperature: expected int, got float"]),
+    (valid_payload(temperature=True), ["temperature: expected int, got bool"]),
+    (valid_payload(temperature=None), ["temperature: expected int, got NoneType"]),
+    (valid_payload(temperature=-101), ["temperature: -101 is below -100"]),
+    (valid_payload(temperature=301), ["temperature: 301 is above 300"]),
+    (valid_payload(signal_strength="-70"), ["signal_strength: expected int/float, got str"]),
+    (valid_payload(signal_strength=0.5), ["signal_strength: 0.5 is above 0"]),
+    (valid_payload(signal_strength=float("nan")), ["signal_strength: not a finite number"]),
+    (valid_payload(fuel_level=float("inf")), ["fuel_level: not a finite number"]),
+    (valid_payload(fuel_level=-0.1), ["fuel_level: -0.1 is below 0"]),
+    (valid_payload(battery_level=100.5), ["battery_level: 100.5 is above 100"]),
+    (valid_payload(location={"latitude": 91, "longitude": -181}),
+     ["latitude: 91 is above 90", "longitude: -181 is below -180"]),
+    (valid_payload(location={"latitude": 47.6}), ["longitude: missing"]),
+    (valid_payload(location=None), ["latitude: missing", "longitude: missing"]),
+    (valid_payload(location="47.6,-122.3"), ["latitude: missing", "longitude: missing"]),
+    (valid_payload(temperature="hot", battery_level=-1),
+     ["temperature: expected int, got str", "battery_level: -1 is below 0"]),
+])
+def test_rejection_reasons(validator, telemetry, reasons):
+    assert validator.validate(telemetry) == reasons
+
+
+@pytest.mark.parametrize("offset_ms, reason", [
+    (-6 * HOUR_MS, None),
+    (-6 * HOUR_MS - 1, "timestamp: %d is older than the memory store window"),
+    (-24 * HOUR_MS, "timestamp: %d is older than the memory store window"),
+    (15 * 60 * 1000, None),
+    (15 * 60 * 1000 + 1, "timestamp: %d is too far in the future"),
+])
+def test_timestamp_window(validator, offset_ms, reason):
+    timestamp = NOW_MS + offset_ms
+    assert validator.validate(valid_payload(timestamp=timestamp)) == ([reason % timestamp] if reason else [])
+
+
+def test_window_follows_the_memory_store_retention():
+    schema = load_schema(os.path.join(LAMBDA_DIR, "telemetry-schema.json"))
+    validator = PayloadValidator(schema, memory_store_hours=24, clock=lambda: NOW_MS / 1000)
+    assert validator.window() == (NOW_MS - 24 * HOUR_MS, NOW_MS + 15 * 60 * 1000)
+    assert validator.validate(valid_payload(timestamp=NOW_MS - 12 * HOUR_MS)) == []
+
+
+def test_invalid_payloads_are_quarantined_by_the_handler(load_handler):
+    module = load_handler(MemoryStoreRetentionHours="6")
+    sent = []
+    module.quarantine_sink.send = lambda items, database, table: sent.extend(items)
+    now_ms = int(time.time() * 1000)
+    valid = dict(valid_payload(timestamp=now_ms), deviceid="device-ok")
+    event = [
+        valid,
+        dict(valid, timestamp=now_ms - 7 * HOUR_MS),
+        dict(valid, timestamp=now_ms + HOUR_MS),
+        dict(valid, temperature="hot"),
+        '{"deviceid": ',
+    ]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.lambda_handler(event, None)
+
+    assert module.write_client.records == 1
+    assert [reason for _, reason, _ in sent] == ["INVALID_PAYLOAD"] * 4
+    details = [detail for _, _, detail in sent]
+    assert "older than the memory store window" in details[0]
+    assert "too far in the future" in details[1]
+    assert details[2] == "temperature: expected int, got str"
+    assert details[3].startswith("payload: ")
+    assert sent[0][0] == event[1]
@@ -0,0 +1,64 @@
+import json
+import os
+import re
+import sys
+
+import pytest
+
+from conftest import LAMBDA_DIR, ROOT
+from dashboard_lint import iter_queries
+from tenant_dashboards import load_customers, main, scope_dashboard, tenant_dashboard, tenant_uid
+
+DASHBOARD_FILE = os.path.join(ROOT, "resources", "grafana", "grafana_dashboard.json")
+DEVICE_METADATA_FILE = os.path.join(LAMBDA_DIR, "device-meta.json")
+
+
+@pytest.fixture
+def scoped():
+    with open(DASHBOARD_FILE, encoding="utf-8") as f:
+        dashboard = json.load(f)["dashboard"]
+    return scope_dashboard(dict(dashboard, uid="iot-fleet"))
+
+
+def interpolate(sql, variable):
+    return sql.replace("$" + variable["name"], variable["query"])
+
+
+def test_every_scoped_query_filters_on_the_customer(scoped):
+    queries = list(iter_queries(scoped))
+    assert queries
+    for location, _, owner, key, _ in queries:
+        assert re.search(r"\bcustomerid\s*=\s*'\$customerid'", owner[key]), location
+
+
+def test_customer_ids_cannot_end_the_string_literal(scoped):
+    dashboard = tenant_dashboard(scoped, "o'brien' or customerid <> '")
+    (variable,) = [variable for variable in dashboard["templating"]["list"] if variable["name"] == "customerid"]
+    assert variable["query"] == "o''brien'' or customerid <> ''"
+    assert variable["current"] == {"text": "o'brien' or customerid <> '", "value": variable["query"]}
+    assert dashboard["title"].endswith("(o'brien' or customerid <> ')")
+
+    ### the interpolated literal holds the whole customer id, quotes included
+    for _, _, owner, key, _ in iter_queries(dashboard):
+        literal = re.search(r"customerid\s*=\s*('(?:[^']|'')*')", interpolate(owner[key], variable)).group(1)
+        assert literal == "'o''brien'' or customerid <> '''"
+
+
+def test_standalone_files_use_the_provisioned_uids(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["tenant_dashboards.py", DASHBOARD_FILE, DEVICE_METADATA_FILE,
+                                      "--uid", "iot-fleet", "--output", str(tmp_path)])
+    main()
+
+    customers = load_customers(DEVICE_METADATA_FILE)
+    assert sorted(os.listdir(tmp_path)) == sorted("%s.json" % tenant_uid("iot-fleet", customer) for customer in customers)
+    for customer in customers:
+        with open(tmp_path / ("%s.json" % tenant_uid("iot-fleet", customer)), encoding="utf-8") as f:
+            assert json.load(f)["dashboard"]["uid"] == tenant_uid("iot-fleet", customer)
+
+
+def test_standalone_needs_a_uid(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["tenant_dashboards.py", DASHBOARD_FILE, DEVICE_METADATA_FILE,
+                                      "--output", str(tmp_path)])
+    with pytest.raises(SystemExit):
+        main()
+    assert "pass --uid" in capsys.readouterr().err
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from timestream_local import LocalTimestream
+
+
+def records(count, start_ms):
+    return [{
+        "Dimensions": [{"Name": "deviceid", "Value": "device-%d" % index}],
+        "MeasureName": "telemetry",
+        "MeasureValueType": "MULTI",
+        "MeasureValues": [{"Name": "temperature", "Type": "DOUBLE", "Value": str(20.0 + index)}],
+        "Time": str(start_ms + index),
+    } for index in range(count)]
+
+
+def write_concurrently(local, chunks, concurrency):
+    now_ms = int(time.time() * 1000)
+    errors = []
+    pending = list(range(chunks))
+    guard = threading.Lock()
+
+    def worker():
+        while True:
+            with guard:
+                if not pending:
+                    return
+                chunk = pending.pop()
+            try:
+                local.write_records(DatabaseName="iot", TableName="telemetry",
+                                    Records=records(10, now_ms + chunk * 10))
+            except Exception as err:
+                errors.append(err)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, errors
+
+
+def test_concurrent_writes_overlap_their_latency():
+    local = LocalTimestream(latency_ms=50)
+    elapsed, errors = write_concurrently(local, 16, concurrency=8)
+
+    assert errors == []
+    assert local.stats["records_written"] == 160
+    ### serialized the 16 writes would take at least 0.8s, with 8 in flight they take about 0.1s
+    assert elapsed < 0.5
+
+
+def test_lock_is_not_held_while_sleeping():
+    local = LocalTimestream(latency_ms=10)
+    held = []
+    local.sleep = lambda seconds: held.append(local.lock._is_owned())
+
+    local.write_records(DatabaseName="iot", TableName="telemetry", Records=records(1, int(time.time() * 1000)))
+    local.query("SELECT 1")
+    assert held == [False, False]
+
+
+def test_throttled_writes_raise_throttling_exception():
+    local = LocalTimestream(write_rate=10)
+    now_ms = int(time.time() * 1000)
+    local.write_records(DatabaseName="iot", TableName="telemetry", Records=records(10, now_ms))
+
+    with pytest.raises(local.exceptions.ThrottlingException):
+        local.write_records(DatabaseName="iot", TableName="telemetry", Records=records(10, now_ms + 10))
+    assert local.stats["throttled"] == 1
+    assert local.stats["records_written"] == 10
+
+
+def test_throttled_queries_raise_throttling_exception():
+    local = LocalTimestream(query_rate=1)
+    local.query("SELECT 1")
+
+    with pytest.raises(local.query_exceptions.ThrottlingException):
+        local.query("SELECT 1")
+    assert local.stats["throttled"] == 1
+
+
+def test_injected_errors_raise_internal_server_exception():
+    local = LocalTimestream(error_rate=1.0, seed=1)
+    with pytest.raises(local.exceptions.InternalServerException):
+        local.write_records(DatabaseName="iot", TableName="telemetry", Records=records(1, int(time.time() * 1000)))
+    assert local.stats["errors"] == 1
+    assert local.stats["records_written"] == 0
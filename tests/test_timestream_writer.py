@@ -0,0 +1,80 @@
+import contextlib
+import io
+
+from telemetry_generator import RecordingWriteClient, invoke_handler
+from timestream_writer import TimestreamWriter, build_common_attributes
+
+
+def record(device, customer, time):
+    return {
+        "Dimensions": [{"Name": "deviceid", "Value": device}, {"Name": "customerid", "Value": customer}],
+        "MeasureName": "telemetry",
+        "MeasureValueType": "MULTI",
+        "MeasureValues": [{"Name": "temperature", "Value": "20", "Type": "DOUBLE"}],
+        "Time": str(time),
+    }
+
+
+def merged(common, records):
+    return [
+        {**common, **record, "Dimensions": common.get("Dimensions", []) + record.get("Dimensions", [])}
+        for record in records
+    ]
+
+
+def sort_dimensions(records):
+    return [dict(record, Dimensions=sorted(record["Dimensions"], key=lambda d: d["Name"])) for record in records]
+
+
+def test_dimensions_shared_by_every_record_are_hoisted():
+    records = [record("a", "acme", 1), record("a", "acme", 2), record("b", "acme", 3)]
+    common, stripped = build_common_attributes(records)
+
+    assert common == {
+        "MeasureName": "telemetry",
+        "MeasureValueType": "MULTI",
+        "Dimensions": [{"Name": "customerid", "Value": "acme"}],
+    }
+    assert [item["Dimensions"] for item in stripped] == [[{"Name": "deviceid", "Value": device}] for device in "aab"]
+    assert sort_dimensions(merged(common, stripped)) == sort_dimensions(records)
+    assert records[0]["Dimensions"][1] == {"Name": "customerid", "Value": "acme"}
+
+
+def test_records_of_one_device_share_all_dimensions():
+    records = [record("a", "acme", time) for time in range(3)]
+    common, stripped = build_common_attributes(records)
+
+    assert common["Dimensions"] == records[0]["Dimensions"]
+    assert all("Dimensions" not in item for item in stripped)
+    assert merged(common, stripped) == records
+
+
+def test_chunk_requests_carry_the_shared_dimensions():
+    client = RecordingWriteClient(exceptions=None, keep=True)
+    writer = TimestreamWriter(client, "iot", "telemetry", max_concurrency=1)
+    records = [record("d%03d" % (index // 10), "c%d" % (index // 100), index) for index in range(250)]
+
+    result = writer.write(records)
+    assert result.written == 250
+    assert [len(request[2]) for request in client.requests] == [100, 100, 50]
+    for (_, common, chunk), customer in zip(client.requests, ("c0", "c1", "c2")):
+        assert common["Dimensions"] == [{"Name": "customerid", "Value": customer}]
+        assert all(item["Dimensions"][0]["Name"] == "deviceid" for item in chunk)
+    assert sort_dimensions(client.tables["telemetry"]) == sort_dimensions(records)
+
+
+def test_handler_requests_hoist_the_tenant_dimension(load_handler, generator):
+    module = load_handler(TenantDimension="customerid")
+    with contextlib.redirect_stdout(io.StringIO()):
+        invoke_handler(generator(device_count=4), module.lambda_handler, 400, batch_size=400)
+
+    requests = [request for request in module.write_client.requests if request[0] == "device-telemetry"]
+    assert sum(len(request[2]) for request in requests) == 400
+    hoisted = set()
+    for _, common, chunk in requests:
+        dimensions = [item["Dimensions"] for item in merged(common, chunk)]
+        shared = [dimension for dimension in dimensions[0] if all(dimension in other for other in dimensions)]
+        assert common.get("Dimensions", []) == shared
+        hoisted.update(dimension["Name"] for dimension in shared)
+    ### records are grouped by customer first, so some chunk lies within one customer
+    assert "customerid" in hoisted